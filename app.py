@@ -9,15 +9,27 @@ from flask_cors import CORS, cross_origin
 from io import StringIO
 import logging as log
 import time
+import math
+import calendar
 import hashlib
 import uuid
 
+import numpy as np
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
 from bokeh.embed import components
 from bokeh.resources import Resources, JS_RESOURCES, CSS_RESOURCES
 from bokeh.models.sources import ColumnDataSource, AjaxDataSource
-from util import error, internal_error, tz_offset_seconds
+from util import error, internal_error, tz_offset_seconds, parse_interval
 from user import *
 import plot
+import batch
+import formats
+import downsample
+import rollup
+import config
+import cache
+import metrics
 
 import sstsp
 
@@ -26,148 +38,451 @@ fromtimestamp = dt.datetime.fromtimestamp
 app = Flask("sstsp")
 CORS(app)
 
+# the bokeh resources are the same on every plot page, render them once
+_CDN = Resources(mode="cdn", minified=True,)
+_JS_RESOURCES = JS_RESOURCES.render(js_raw=_CDN.js_raw, js_files=_CDN.js_files)
+_CSS_RESOURCES = CSS_RESOURCES.render(css_raw=_CDN.css_raw, css_files=_CDN.css_files)
+
+# rendered plot pages, see newplot
+_plot_pages = cache.PageCache(config.PLOT_CACHE_ENTRIES)
+
+# with a writer process the writer compacts the stores
+if not config.WRITER_ADDRESS:
+    start_compactor()
+metrics.add_stats('plot_cache', _plot_pages.stats)
+
+@app.before_request
+def _start_timer():
+    flask.g.request_start = time.time()
+
+def _observe_request(status):
+    """ the request's latency by route.  Streamed responses are timed up
+    to the start of the stream """
+    start = flask.g.pop('request_start', None)
+    if start is None:
+        return
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.observe('request_seconds', time.time() - start, route=route,
+            method=request.method, status=str(status))
+
+@app.after_request
+def _time_request(response):
+    _observe_request(response.status_code)
+    return response
+
+@app.teardown_request
+def _time_failed_request(exc):
+    # after_request isn't called when a view raised
+    if exc is not None:
+        _observe_request(500)
+
 @app.errorhandler(401)
 def custom_401(error):
     return Response('Valid API key required to update data', 401, {'WWWAuthenticate':'Basic realm="Valid API Key required"'})
 
-@app.route('/d/<user_id>/<data_id>/latest', methods=['GET', 'PUT'])
-def latest_data(user_id, data_id):
+def _check_key(user_id, key):
+    """ the API key must be a UUID whose sha256 hash starts with user_id """
+    try:
+        key_uid = uuid.UUID(key)
+    except (TypeError, ValueError, AttributeError):
+        # AttributeError for a key that isn't a string, e.g. a number in json
+        error(400, "badly formed hexadecimal UUID string") 
+        
+    hash_id = hashlib.sha256(key_uid.bytes).hexdigest()[:sstsp.USER_ID_LEN]
+
+    if hash_id != user_id:
+        error(401, "API key hash does not match user_id")
+
+def _check_user_id(user_id):
     if len(user_id) != sstsp.USER_ID_LEN:
         abort(400, "invalid user id - expecting {} char string".format(sstsp.USER_ID_LEN))
 
+def _float_arg(name):
+    """ an epoch seconds argument, which like the stored times must fit
+    datetime64[ns] """
+    val = request.args.get(name, None)
+    if val is None or val == '':
+        return None
+    try:
+        t = float(val)
+    except ValueError:
+        error(400, "expecting float or int for {} - got {}".format(name, val))
+    if not batch.MIN_TIME <= t <= batch.MAX_TIME:
+        # NaN and inf as well
+        error(400, "{} {} out of range - expecting epoch seconds between {} and {}".format(
+            name, val, batch.MIN_TIME, batch.MAX_TIME))
+    return t
+
+def _int_arg(name, default=None, minimum=0):
+    val = request.args.get(name, None)
+    if val is None or val == '':
+        return default
+    try:
+        val = int(val)
+    except ValueError:
+        val = None
+    if val is None or val < minimum:
+        error(400, "expecting int >= {} for {}".format(minimum, name))
+    return val
+
+def _format_arg():
+    """ response format from the 'format' argument or the Accept header """
+    fmt = formats.negotiate(request.args.get('format', None), request.accept_mimetypes)
+    if fmt is None:
+        error(406, "unknown format {}".format(request.args.get('format')))
+    if not formats.available(fmt):
+        error(406, "{} format is not available on this server".format(fmt))
+    return fmt
+
+def _freq_arg():
+    """ the sampling interval 'f' of a PUT, kept in the catalog if it is an
+    interval like '15s' or a pandas offset alias like '1min'.  Other
+    values are ignored, as they always were """
+    freq = request.form.get("f", None)
+    if not freq:
+        return None
+    try:
+        parse_interval(freq)
+        return freq
+    except ValueError:
+        pass
+    try:
+        to_offset(freq)
+        return freq
+    except ValueError:
+        log.debug("ignoring sampling interval f={}".format(freq))
+        return None
+
+def _data_ids_arg():
+    """ the comma separated data_id argument, each data_id once """
+    data_ids = []
+    for data_id in request.args.get('data_id', '').split(','):
+        data_id = data_id.strip()
+        if data_id and data_id not in data_ids:
+            data_ids.append(data_id)
+    if not data_ids:
+        error(400, "expecting one or more comma separated data_ids")
+    return data_ids
+
+def _every_arg():
+    """ the 'every' interval argument in seconds, None if not given """
+    if not request.args.get('every', None):
+        return None
+    try:
+        return parse_interval(request.args['every'])
+    except ValueError as e:
+        error(400, str(e))
+
+def _method_arg():
+    method = request.args.get('method', 'lttb')
+    if method not in downsample.METHODS:
+        error(400, "method must be one of {}".format(", ".join(downsample.METHODS)))
+    return method
+
+def _batch_response(b):
+    body = {
+        'success': b.rejected == 0,
+        'accepted': b.accepted,
+        'rejected': b.rejected,
+        'results': b.results,
+    }
+    status = 400 if b.accepted == 0 and b.rejected > 0 else 200
+    return json.dumps(body), status, {'Content-Type':'application/json'}
+
+def _conditional(user_id, data_id, respond):
+    """ answer a GET of a series with 304 if the client's copy is still
+    current, otherwise with respond().  Only the series version is looked
+    up before deciding, the data isn't read for a 304 """
+    version, modified = series_version(user_id, data_id)
+    # one etag per representation: the query and Accept header select it
+    key = "{} {} {}".format(version, request.full_path, request.headers.get('Accept', ''))
+    etag = hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+    # Last-Modified has whole seconds, and another write may follow in the
+    # second of the last one.  Until that second is over no date is given
+    # or trusted, so a date the client has is from before any later write
+    settled = int(modified) < int(time.time())
+
+    if request.if_none_match.star_tag:
+        # any current representation: only if the series exists
+        current = data_page_exists(user_id, data_id)
+    elif request.if_none_match:
+        current = request.if_none_match.contains(etag)
+    elif request.if_modified_since is not None:
+        current = settled and int(modified) <= calendar.timegm(
+                request.if_modified_since.utctimetuple())
+    else:
+        current = False
+
+    resp = Response(status=304) if current else flask.make_response(respond())
+    resp.set_etag(etag)
+    if settled:
+        resp.last_modified = int(modified)
+    # let browsers and proxies keep the copy but revalidate every time
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.vary.add('Accept')
+    return resp
+
+def _put_data(user_id, data_id):
+    """ store the point(s) of a form PUT.  'v' and the optional 't' may be
+    repeated to send several points in one request"""
+    if 'v' not in request.form:
+        error(400, "data post missing required value field 'v'")
+
+    log.debug("Received PUT to {}/{} form:{}".format(user_id, data_id, request.form))
+    _check_key(user_id, request.form.get('key', None))
+
+    v_raw = request.form.getlist('v')
+    t_raw = request.form.getlist('t') or [None] * len(v_raw)
+    if len(t_raw) != len(v_raw):
+        error(400, "expecting one 't' per 'v' - got {} and {}".format(len(t_raw), len(v_raw)))
+
+    # checks the data_id as well, see batch.data_id_error
+    b = batch.Batch()
+    b.add(data_id, t_raw, v_raw)
+    if b.rejected:
+        error(400, "; ".join(r for r in b.results[data_id] if r is not None))
+
+    freq = _freq_arg()
+    log.debug("valid api key.  storing {} point(s) freq={}".format(b.accepted, freq))
+    write_points(user_id, b.points, {data_id: freq} if freq else None)
+    
+    return json.dumps({'success':True}), 200, {'ContentType':'application/json'} 
+
+@app.route('/d/<user_id>/<data_id>/latest', methods=['GET', 'PUT'])
+def latest_data(user_id, data_id):
+    _check_user_id(user_id)
+
     if request.method == 'GET':# or request.method == 'POST':
-        start = time.time()
-        d = get_data_page_latest(user_id, data_id)
-        log.debug("data page retrieve took {} ms".format(1000*(time.time() - start)))
-        return d.to_json(orient='split')
+        fmt = _format_arg()
+        n = _int_arg('n', 5, minimum=1)
+
+        def respond():
+            start = time.time()
+            d = get_data_page_latest(user_id, data_id, n)
+            log.debug("data page retrieve took {} ms".format(1000*(time.time() - start)))
+            return formats.encode(fmt, d), 200, {'Content-Type':formats.MIMETYPES[fmt]}
+        return _conditional(user_id, data_id, respond)
     elif request.method == 'PUT':
-        if 'v' not in request.form:
-            error(400, "data post missing required value field 'v'")
-
-        key = request.form.get('key', None)
-        log.debug("Received PUT to {}/{} form:{}".format(user_id, data_id, request.form))
-        try:
-            key_uid = uuid.UUID(key)
-        except ValueError:
-            error(400, "badly formed hexadecimal UUID string") 
-            
-        hash_id = hashlib.sha256(key_uid.bytes).hexdigest()[:sstsp.USER_ID_LEN]
-
-        if hash_id != user_id:
-            error(401, "API key hash does not match user_id")
-       
-
-        v_str = request.form['v']
-        try: 
-            v = float(v_str)
-        except ValueError:
-            error(400, "expecting float for value - got {}".format(v_str))
-        
-        if "t" not in request.form:
-            t = time.time()
-        else:
-            t_str = request.form['t']
-            try:
-                t = float(t_str)
-            except ValueError:
-                error(400, "expecting float or int for time - got {}".format(t_str))
-
-        freq = request.form.get("f", "1s")
-        log.debug("valid api key.  storing ({},{})".format(t,v))
-        
-        if not user_store_exists(user_id):
-            log.debug("creating data store for new user {}".format(user_id))
-            store = create_user_store(user_id)
-            store.close()
-
-        if not data_page_exists(user_id, data_id):
-            log.debug("creating new data series '{}'".format(data_id))
-            create_data_page(user_id, data_id, freq, t, v)
-        else:
-            append_data(user_id, data_id, t, v)
-        
-        return json.dumps({'success':True}), 200, {'ContentType':'application/json'} 
+        return _put_data(user_id, data_id)
 
 @app.route('/d/<user_id>/<data_id>', methods=['GET', 'PUT'])
 def data(user_id, data_id):
-    if len(user_id) != sstsp.USER_ID_LEN:
-        abort(400, "invalid user id - expecting {} char string".format(sstsp.USER_ID_LEN))
+    _check_user_id(user_id)
 
     if request.method == 'GET':# or request.method == 'POST':
-        start = time.time()
-        d = get_data_page(user_id, data_id)
-        log.debug("data page retrieve took {} ms".format(1000*(time.time() - start)))
-        return d.to_json(orient='split')
+        t_start = _float_arg('start')
+        t_end = _float_arg('end')
+        limit = _int_arg('limit', minimum=1)
+        cursor = _int_arg('cursor', 0)
+        max_points = _int_arg('max_points', minimum=3)
+        fmt = _format_arg()
+        method = _method_arg()
+
+        def respond():
+            if fmt in formats.STREAMED and limit is None and cursor == 0 and max_points is None:
+                if not data_page_exists(user_id, data_id):
+                    error(404, "unknown data_id {}".format(data_id))
+                chunks = iter_data_page(user_id, data_id, t_start, t_end)
+                return Response(formats.encode_chunks(fmt, chunks), mimetype=formats.MIMETYPES[fmt])
+
+            start = time.time()
+            if max_points is not None and limit is None:
+                d, next_cursor = get_plot_series(user_id, data_id, t_start, t_end,
+                        max_points, method), None
+            else:
+                d, next_cursor = query_data_page(user_id, data_id, t_start, t_end, limit, cursor)
+                if max_points is not None:
+                    # a page decimated for plotting, which drops NaNs
+                    d = downsample.decimate(d, max_points, method)
+            log.debug("data page retrieve took {} ms".format(1000*(time.time() - start)))
+            headers = {'Content-Type':formats.MIMETYPES[fmt]}
+            if next_cursor is not None:
+                headers['X-Next-Cursor'] = str(next_cursor)
+            return formats.encode(fmt, d), 200, headers
+        return _conditional(user_id, data_id, respond)
     elif request.method == 'PUT':
-        #FIXME -- this should allow post of more than 1 data point
-        if 'v' not in request.form:
-            error(400, "data post missing required value field 'v'")
-
-        key = request.form.get('key', None)
-        log.debug("Received PUT to {}/{} form:{}".format(user_id, data_id, request.form))
-        try:
-            key_uid = uuid.UUID(key)
-        except ValueError:
-            error(400, "badly formed hexadecimal UUID string") 
-            
-        hash_id = hashlib.sha256(key_uid.bytes).hexdigest()[:sstsp.USER_ID_LEN]
-
-        if hash_id != user_id:
-            error(401, "API key hash does not match user_id")
-       
-
-        v_str = request.form['v']
-        try: 
-            v = float(v_str)
-        except ValueError:
-            error(400, "expecting float for value - got {}".format(v_str))
-        
-        if "t" not in request.form:
-            t = time.time()
-        else:
-            t_str = request.form['t']
-            try:
-                t = float(t_str)
-            except ValueError:
-                error(400, "expecting float or int for time - got {}".format(t_str))
-
-        freq = request.form.get("f", "1s")
-        log.debug("valid api key.  storing ({},{})".format(t,v))
-        
-        if not user_store_exists(user_id):
-            log.debug("creating data store for new user {}".format(user_id))
-            store = create_user_store(user_id)
-            store.close()
-
-        if not data_page_exists(user_id, data_id):
-            log.debug("creating new data series '{}'".format(data_id))
-            create_data_page(user_id, data_id, freq, t, v)
-        else:
-            append_data(user_id, data_id, t, v)
-        
-        return json.dumps({'success':True}), 200, {'ContentType':'application/json'} 
+        return _put_data(user_id, data_id)
+
+@app.route('/d/<user_id>/<data_id>/events', methods=['GET'])
+def data_events(user_id, data_id):
+    """ server-sent events carrying the points written to a series from
+    now on, each event's data a series in the 'json' format """
+    _check_user_id(user_id)
+    if not data_page_exists(user_id, data_id):
+        error(404, "unknown data_id {}".format(data_id))
+
+    def stream():
+        with subscribe(user_id, data_id) as sub:
+            # opens the stream at once rather than at the first point
+            yield b": subscribed\n\n"
+            while True:
+                events = sub.get(config.LIVE_KEEPALIVE)
+                # the keepalive also notices closed connections
+                yield b"".join(events) if events else b": keepalive\n\n"
+
+    return Response(stream(), mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/d/<user_id>/<data_id>/details', methods=['GET'])
+def data_details(user_id, data_id):
+    """ how a range of a series is decimated for plotting:
+    ?start=&end=&max_points=&method= as for the data endpoint """
+    _check_user_id(user_id)
+    t_start = _float_arg('start')
+    t_end = _float_arg('end')
+    max_points = _int_arg('max_points', plot.POINTS_PER_PIXEL * plot.DEFAULT_WIDTH, minimum=3)
+    method = _method_arg()
+    if not data_page_exists(user_id, data_id):
+        error(404, "unknown data_id {}".format(data_id))
+
+    original = count_range(user_id, data_id, t_start, t_end)
+    samples = len(get_plot_series(user_id, data_id, t_start, t_end, max_points, method))
+    if t_start is None or t_end is None:
+        first, last = series_span(user_id, data_id)
+        t_start = first if t_start is None else t_start
+        t_end = last if t_end is None else t_end
+    details = {
+        'start': None if t_start is None else float(t_start),
+        'end': None if t_end is None else float(t_end),
+        'original_samples_no': int(original),
+        'samples_no': samples,
+        'factor': original / float(samples) if samples else 1.0,
+    }
+    return json.dumps(details), 200, {'Content-Type':'application/json'}
+
+@app.route('/d/<user_id>/<data_id>/agg', methods=['GET'])
+def agg_data(user_id, data_id):
+    """ aggregates of a series over fixed buckets, e.g.
+    ?fn=mean,max&every=5m&start=&end= """
+    _check_user_id(user_id)
+    fns = [f.strip() for f in request.args.get('fn', 'mean').split(',') if f.strip()]
+    for fn in fns:
+        if fn not in rollup.FUNCTIONS:
+            error(400, "fn must be one of {}".format(", ".join(rollup.FUNCTIONS)))
+    every = _every_arg()
+    if every is None:
+        error(400, "aggregation requires an 'every' interval like 5m")
+
+    fmt = request.args.get('format', 'json')
+    if fmt not in ('json', 'csv'):
+        error(406, "aggregates are available as json or csv")
+
+    start = time.time()
+    d = aggregate(user_id, data_id, every, fns, _float_arg('start'), _float_arg('end'))
+    log.debug("aggregation took {} ms".format(1000*(time.time() - start)))
+    if fmt == 'csv':
+        return d.to_csv(index_label='t'), 200, {'Content-Type':formats.MIMETYPES['csv']}
+    return d.to_json(orient='split'), 200, {'Content-Type':formats.MIMETYPES['json']}
+
+def post_batch(user_id):
+    """ store a batch of points for one or more series in a single store
+    write.  See batch.py for the accepted body formats; for csv and line
+    protocol bodies the API key is passed as the 'key' query argument"""
+    key = request.args.get('key', None)
+    try:
+        b = batch.parse(request.content_type, request.get_data(as_text=True), key)
+    except batch.BatchError as e:
+        error(400, str(e))
+
+    _check_key(user_id, b.key)
+    log.debug("batch for {}: {} accepted {} rejected".format(user_id, b.accepted, b.rejected))
+    if b.points:
+        write_points(user_id, b.points)
 
-@app.route('/d/<user_id>', methods=['GET', 'OPTIONS'])
+    return _batch_response(b)
+
+@app.route('/d/<user_id>', methods=['GET', 'OPTIONS', 'POST'])
 def get_user(user_id):
+    if request.method == 'POST':
+        _check_user_id(user_id)
+        return post_batch(user_id)
+
     log.debug("request args is {}".format(request.args))
-    data_id = request.args.get("data_id", None)
-    if data_id is None:
-        return get_user_page(user_id) 
+    _check_user_id(user_id)
+    if request.args.get("data_id", None) is None:
+        return json.dumps(get_user_page(user_id)), 200, {'Content-Type':'application/json'}
+    return get_frame(user_id)
+
+def get_frame(user_id):
+    """ several series aligned on one time index, e.g.
+    ?data_id=temp,wind&start=&end=&every=5m&fn=mean.  Without 'every' the
+    series are outer joined on their timestamps """
+    data_ids = _data_ids_arg()
+    every = _every_arg()
+    fn = request.args.get('fn', 'mean')
+    if fn not in rollup.FUNCTIONS:
+        error(400, "fn must be one of {}".format(", ".join(rollup.FUNCTIONS)))
+    fmt = request.args.get('format', 'json')
+    if fmt not in ('json', 'csv'):
+        error(406, "aligned series are available as json or csv")
+
+    start = time.time()
+    d = get_data_frame(user_id, data_ids, _float_arg('start'), _float_arg('end'), every, fn)
+    log.debug("aligned fetch of {} series took {} ms".format(len(data_ids),
+        1000*(time.time() - start)))
+    if fmt == 'csv':
+        return d.to_csv(index_label='t'), 200, {'Content-Type':formats.MIMETYPES['csv']}
+    return d.to_json(orient='split'), 200, {'Content-Type':formats.MIMETYPES['json']}
+
+def get_plot_series(user_id, data_id, start=None, end=None, max_points=None, method='lttb'):
+    """ at most max_points points of a series for plotting.  Series longer
+    than PLOT_RAW_MAX_POINTS are drawn from a rollup tier rather than from
+    the raw points """
+    if max_points is None or \
+            count_points(user_id, data_id) <= max(max_points, config.PLOT_RAW_MAX_POINTS):
+        return downsample.decimate(get_data_page(user_id, data_id, start, end), max_points, method)
+
+    first, last = series_span(user_id, data_id)
+    if first is None:
+        return get_data_page(user_id, data_id, start, end)
+    span = (end if end is not None else last) - (start if start is not None else first)
+    # allow a finer tier with more buckets than max_points, the result is
+    # decimated anyway and keeps more of the shape
+    max_buckets = 10 * max_points
+    tier = rollup.choose_tier(span, max_buckets, config.ROLLUP_TIERS)
+    if tier is None or rollup.tier_seconds(tier) * max_buckets < span:
+        # no tier is coarse enough, decimate the raw points
+        d = get_data_page(user_id, data_id, start, end)
+        return downsample.decimate(d, max_points, method)
+
+    p = get_rollup(user_id, data_id, tier, start, end)
+    if method == 'minmax':
+        d = pd.concat([p['min'], p['max']]).sort_index(kind='mergesort')
     else:
-        log.debug("getting {} for {}".format(data_id, user_id))
-    return str(user_id) + "." + data_id
+        d = rollup.finish(p, ['mean'])['mean']
+    d.name = data_id
+    return downsample.decimate(d, max_points, method)
+
+def get_overlay_frame(user_id, data_ids, start=None, end=None, max_points=None, every=None):
+    """ the series averaged over buckets of `every` seconds, by default
+    wide enough for at most max_points per series going by the catalog """
+    entries = get_user_page(user_id)
+    known = [entries[k] for k in data_ids if k in entries and entries[k]['first'] is not None]
+    if every is not None:
+        return get_data_frame(user_id, data_ids, start, end, every)
+    every = 1
+    if known and max_points is not None:
+        first = start if start is not None else min(e['first'] for e in known)
+        last = end if end is not None else max(e['last'] for e in known)
+        every = max(1, int(math.ceil((last - first) / float(max_points))))
+    return get_data_frame(user_id, data_ids, start, end, every)
 
-def get_data_source(user_id, data_id, tz_str=None):
+def get_data_source(user_id, data_id, tz_str=None, max_points=None, method='lttb'):
   
-    d = get_data_page(user_id, data_id)
-    d.name = 'data'
-    
+    d = get_plot_series(user_id, data_id, max_points=max_points, method=method)
+    return _plot_source(d, tz_str)
+
+def _plot_source(d, tz_str=None):
+    """ a data source of series d with its times shifted to tz_str.  Only
+    the index is shifted, the values are passed on without a copy """
+    index = d.index.values
     if tz_str is not None:
         offset_s = tz_offset_seconds(tz_str)
         log.debug("offseting date with {} seconds for  {}".format(offset_s, tz_str))
-        d = d.tshift(offset_s, freq='s')
-    
-    source = ColumnDataSource(pd.DataFrame(d))
+        index = index + np.timedelta64(int(offset_s), 's')
+
+    source = ColumnDataSource(data={'index': index, 'data': d.values})
     
     def on_latest_change(attr, old, new):
         log.info('on_latest_change {}  old={} new={}'.format(attr, old, new))
@@ -176,32 +491,15 @@ def get_data_source(user_id, data_id, tz_str=None):
 
     return source
 
-@app.route("/p/<user_id>/<data_id>")
-def newplot(user_id, data_id):
-    theme = request.args.get('theme', 'default')
-    CDN = Resources(mode="cdn", minified=True,)
+def _plot_page(theme, p, live_script="", selection_plot=None):
+    """ the plot page around plot p and the overview above it """
     templname = "plot.html"
 
-    js_resources = JS_RESOURCES.render(
-        js_raw=CDN.js_raw,
-        js_files=CDN.js_files
-    )
+    plots = {"main_plot": p}
+    if selection_plot is not None:
+        plots["selection_plot"] = selection_plot
+    plot_script, extra_divs = components(plots)
 
-    css_resources = CSS_RESOURCES.render(
-        css_raw=CDN.css_raw,
-        css_files=CDN.css_files
-    )
-    
-    tz = request.args.get("tz", None)
-    source = get_data_source(user_id, data_id, tz)
-    #ajax_source = get_ajax_latest_source(user_id, data_id)
-    p = plot.create_main_plot(theme, source)
-    plot_script, extra_divs = components(
-        {
-            "main_plot": p,
-        }
-    )
-    
     themes = ["default", "dark"]
     options = { k: 'selected="selected"' if theme == k else "" for k in themes}
 
@@ -210,11 +508,77 @@ def newplot(user_id, data_id):
         theme = theme,
         extra_divs = extra_divs,
         plot_script = plot_script,
-        js_resources=js_resources,
-        css_resources=css_resources,
+        live_script = live_script,
+        js_resources=_JS_RESOURCES,
+        css_resources=_CSS_RESOURCES,
         theme_options=options,
     )
 
+@app.route("/p/<user_id>/<data_id>")
+def newplot(user_id, data_id):
+    theme = request.args.get('theme', 'default')
+    tz = request.args.get("tz", None)
+    width = _int_arg('width', plot.DEFAULT_WIDTH, minimum=1)
+    max_points = _int_arg('max_points', plot.POINTS_PER_PIXEL * width, minimum=3)
+    method = _method_arg()
+    overview = request.args.get('overview', '1') not in ('0', 'false', 'no')
+
+    def render():
+        source = get_data_source(user_id, data_id, tz, max_points, method)
+        #ajax_source = get_ajax_latest_source(user_id, data_id)
+        p = plot.create_main_plot(theme, source)
+        offset_ms = 1000 * tz_offset_seconds(tz) if tz is not None else 0
+        data_url = request.url_root + "d/{}/{}".format(user_id, data_id)
+        plot.add_zoom_refetch(p, source, data_url, max_points, method, offset_ms)
+        live_script = plot.live_stream_script(source, data_url + "/events", offset_ms)
+        selection_plot = None
+        if overview:
+            d = get_plot_series(user_id, data_id, max_points=plot.OVERVIEW_POINTS, method='minmax')
+            details_url = data_url + "/details?max_points={}&method={}".format(max_points, method)
+            selection_plot = plot.create_selection_plot(p, theme, _plot_source(d, tz),
+                    details_url, offset_ms)
+        return _plot_page(theme, p, live_script, selection_plot)
+
+    def respond():
+        # the version is taken before reading, a write meanwhile only
+        # makes the cached page newer than its key
+        version, modified = series_version(user_id, data_id)
+        key = (user_id, data_id, theme, tz, version, request.url_root,
+                max_points, method, overview)
+        page = _plot_pages.get(key)
+        if page is None:
+            page = render()
+            _plot_pages.put(key, page)
+        return page
+    return _conditional(user_id, data_id, respond)
+
+@app.route("/p/<user_id>")
+def overlay_plot(user_id):
+    """ several series of a user overlaid in one plot drawn from a single
+    aligned fetch, e.g. /p/<user_id>?data_id=temp,wind """
+    _check_user_id(user_id)
+    data_ids = _data_ids_arg()
+    theme = request.args.get('theme', 'default')
+    tz = request.args.get("tz", None)
+    width = _int_arg('width', plot.DEFAULT_WIDTH, minimum=1)
+    max_points = _int_arg('max_points', plot.POINTS_PER_PIXEL * width, minimum=3)
+
+    d = get_overlay_frame(user_id, data_ids, _float_arg('start'), _float_arg('end'),
+            max_points, _every_arg())
+    if tz is not None:
+        d.index = d.index + pd.Timedelta(seconds=tz_offset_seconds(tz))
+    p = plot.create_overlay_plot(theme, ColumnDataSource(d), data_ids)
+    return _plot_page(theme, p)
+
+@app.route("/metrics")
+def get_metrics():
+    """ request latency histograms per route, store timings and the
+    counters of the caches and buffers, see metrics.py.  Prometheus text
+    format, or json with ?format=json """
+    if request.args.get('format', None) == 'json':
+        return json.dumps(metrics.snapshot()), 200, {'Content-Type':'application/json'}
+    return metrics.render(), 200, {'Content-Type':'text/plain; version=0.0.4'}
+
 if __name__ == '__main__':
     log.basicConfig(level=log.DEBUG)
     app.run(debug=True)
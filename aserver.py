@@ -0,0 +1,249 @@
+""" asyncio front end serving the same routes as app.py
+
+    python aserver.py [--host HOST] [--port PORT] [--log-level LEVEL]
+
+Connections are held by an aiohttp event loop, so idle and slow clients
+cost no thread.  Requests are handled by the Flask app of app.py on a
+pool of ASYNC_WORKERS threads, which is where the blocking store reads
+and writes happen.  Once every worker is busy and ASYNC_QUEUE requests
+are waiting for one, further requests are refused with 503 and
+Retry-After instead of queueing without bound.
+
+Event streams (/d/<user_id>/<data_id>/events) are served on the loop
+itself: a publish wakes the loop once per series and every viewer of it
+is written from there, so live viewers hold no worker either.
+"""
+import io
+import sys
+import time
+import asyncio
+import argparse
+import logging as log
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from aiohttp import web
+
+import config
+import sstsp
+import user
+import metrics
+import app as flask_app
+
+# not passed on from the WSGI response, aiohttp sets its own
+HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'content-length')
+
+
+class Overloaded(Exception):
+    pass
+
+
+class BoundedExecutor(object):
+    """ thread pool running at most `workers` calls at once, with at most
+    `queue` more waiting.  Only used from the event loop thread """
+    def __init__(self, workers, queue):
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='sstsp-worker')
+        self.slots = workers + queue
+        self.active = 0
+        self.counters = dict(run=0, rejected=0)
+
+    async def run(self, fn, *args, admitted=False):
+        """ fn(*args) on a worker.  Raises Overloaded if there is no room,
+        unless the call continues a request that was already admitted """
+        if not admitted and self.active >= self.slots:
+            self.counters['rejected'] += 1
+            raise Overloaded()
+        self.active += 1
+        self.counters['run'] += 1
+        submitted = time.time()
+
+        def run():
+            if not admitted:
+                metrics.observe('async_queue_seconds', time.time() - submitted)
+            return fn(*args)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, run)
+        finally:
+            self.active -= 1
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+
+def _environ(request, body):
+    """ WSGI environ of an aiohttp request whose body has been read """
+    host, _, port = request.host.partition(':')
+    env = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': request.query_string,
+        'SERVER_NAME': host,
+        'SERVER_PORT': port or ('443' if request.secure else '80'),
+        'SERVER_PROTOCOL': 'HTTP/{}.{}'.format(*request.version),
+        'REMOTE_ADDR': request.remote or '',
+        'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for k, v in request.headers.items():
+        k = 'HTTP_' + k.upper().replace('-', '_')
+        if k in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+            continue
+        env[k] = env[k] + ',' + v if k in env else v
+    return env
+
+def _start(environ):
+    """ call the Flask app.  Responses of known length are read whole,
+    others are returned as an iterator to be read chunk by chunk """
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+    body = flask_app.app(environ, start_response)
+    status, headers = started
+    if any(k.lower() == 'content-length' for k, v in headers):
+        try:
+            return status, headers, b"".join(body), None
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+    return status, headers, None, body
+
+def _next_chunk(body):
+    for chunk in body:
+        if chunk:
+            return chunk
+    if hasattr(body, 'close'):
+        body.close()
+    return None
+
+def _overloaded():
+    return web.Response(status=503, text="server busy, retry shortly\n",
+            headers={'Retry-After': '1'})
+
+
+class Server(object):
+    def __init__(self, workers=config.ASYNC_WORKERS, queue=config.ASYNC_QUEUE):
+        self.executor = BoundedExecutor(workers, queue)
+        # per series: [asyncio.Event, subscriber count, ExitStack]
+        self._relays = {}
+        metrics.add_stats('async', self.stats)
+
+    async def wsgi(self, request):
+        """ any route of app.py, run on a worker """
+        body = await request.read()
+        try:
+            status, headers, content, stream = await self.executor.run(
+                    _start, _environ(request, body))
+        except Overloaded:
+            return _overloaded()
+
+        code, _, reason = status.partition(' ')
+        out = [(k, v) for k, v in headers if k.lower() not in HOP_HEADERS]
+        if stream is None:
+            return web.Response(status=int(code), reason=reason, headers=out, body=content)
+
+        resp = web.StreamResponse(status=int(code), reason=reason, headers=out)
+        await resp.prepare(request)
+        try:
+            while True:
+                chunk = await self.executor.run(_next_chunk, stream, admitted=True)
+                if chunk is None:
+                    break
+                await resp.write(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+        finally:
+            if hasattr(stream, 'close'):
+                self.executor.pool.submit(stream.close)
+        await resp.write_eof()
+        return resp
+
+    def _relay(self, key):
+        """ an asyncio.Event set, and replaced, after each publish to key.
+        One per series however many viewers are waiting on it """
+        relay = self._relays.get(key)
+        if relay is None:
+            loop = asyncio.get_running_loop()
+            relay = self._relays[key] = [asyncio.Event(), 0, ExitStack()]
+
+            def wake():
+                ev, relay[0] = relay[0], asyncio.Event()
+                ev.set()
+            relay[2].enter_context(user.subscribe(key[0], key[1],
+                lambda: loop.call_soon_threadsafe(wake)))
+        relay[1] += 1
+        return relay
+
+    def _release(self, key):
+        relay = self._relays[key]
+        relay[1] -= 1
+        if relay[1] == 0:
+            del self._relays[key]
+            relay[2].close()
+
+    async def events(self, request):
+        """ /d/<user_id>/<data_id>/events, see app.data_events """
+        user_id = request.match_info['user_id']
+        data_id = request.match_info['data_id']
+        if len(user_id) != sstsp.USER_ID_LEN:
+            return web.Response(status=400, text="invalid user id - expecting {} char string\n".format(
+                sstsp.USER_ID_LEN))
+        try:
+            exists = await self.executor.run(user.data_page_exists, user_id, data_id)
+        except Overloaded:
+            return _overloaded()
+        if not exists:
+            return web.Response(status=404, text="unknown data_id {}\n".format(data_id))
+
+        key = (user_id, data_id)
+        resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        await resp.prepare(request)
+        relay = self._relay(key)
+        try:
+            with user.subscribe(user_id, data_id) as sub:
+                await resp.write(b": subscribed\n\n")
+                while True:
+                    ev = relay[0]
+                    events = sub.get(0)
+                    if not events:
+                        try:
+                            await asyncio.wait_for(ev.wait(), config.LIVE_KEEPALIVE)
+                            continue
+                        except asyncio.TimeoutError:
+                            events = [b": keepalive\n\n"]
+                    await resp.write(b"".join(events))
+        except ConnectionError:
+            pass
+        finally:
+            self._release(key)
+        return resp
+
+    def stats(self):
+        return dict(self.executor.counters, active=self.executor.active,
+                live_series=len(self._relays))
+
+    def make_app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get('/d/{user_id}/{data_id}/events', self.events)
+        app.router.add_route('*', '/{path:.*}', self.wsgi)
+        app.on_shutdown.append(self._shutdown)
+        return app
+
+    async def _shutdown(self, app):
+        self.executor.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--log-level', default='info')
+    args = parser.parse_args()
+    log.basicConfig(level=getattr(log, args.log_level.upper()))
+    web.run_app(Server().make_app(), host=args.host, port=args.port)
@@ -0,0 +1,211 @@
+""" parsing of multi-point batch writes
+
+A batch maps each data_id to arrays of epoch second timestamps and float
+values.  Three body formats are accepted by parse():
+
+  application/json  {"key": "<api key>",
+                     "data": {"<data_id>": {"t": [...], "v": [...]}, ...}}
+                    "t" may be omitted to stamp every point with the
+                    receive time
+  text/csv          one "data_id,t,v" point per line, t may be empty
+  text/plain        line protocol, one "data_id v [t]" point per line,
+                    blank lines and lines starting with '#' are skipped
+
+Every point gets a result: None if it was accepted, otherwise the reason
+it was rejected.  Rejected points never stop the rest of the batch.  A
+value may be NaN only if it was sent as such, a missing value is rejected.
+The data_ids are checked as those of single point writes are, see
+data_id_error.
+"""
+import json
+import time
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+import rollup
+
+JSON_TYPES = ('application/json',)
+CSV_TYPES = ('text/csv',)
+LINE_TYPES = ('text/plain', 'application/x-sstsp-lines')
+# whole epoch seconds representable as datetime64[ns], about 1677 to 2262
+MIN_TIME = pd.Timestamp.min.value // 10**9 + 1
+MAX_TIME = pd.Timestamp.max.value // 10**9
+# the endpoints below /d/<user_id>/<data_id>, not to be mistaken for series
+RESERVED_IDS = ('latest', 'events', 'details', 'agg')
+
+
+class BatchError(ValueError):
+    """ the body as a whole could not be parsed """
+    pass
+
+
+class Batch(object):
+    def __init__(self, key=None):
+        self.key = key
+        self.points = {}
+        self.results = {}
+
+    @property
+    def accepted(self):
+        return sum(len(t) for t, v in self.points.values())
+
+    @property
+    def rejected(self):
+        return sum(sum(r is not None for r in res) for res in self.results.values())
+
+    def add(self, data_id, t_raw, v_raw):
+        """ add the valid points of parallel raw t/v sequences, recording a
+        result for every point.  A missing (None or empty) t is stamped
+        with the receive time"""
+        reason = data_id_error(data_id)
+        if reason is not None:
+            self.reject(data_id, len(v_raw), reason)
+            return
+        t = _to_float(t_raw)
+        v = _to_float(v_raw)
+        results = [None] * len(v)
+        # only the NaNs need a closer look at what was sent
+        bad_v = np.isnan(v)
+        bad_t = np.isnan(t)
+        for i in np.flatnonzero(bad_v):
+            bad_v[i] = not _is_nan_literal(v_raw[i])
+        for i in np.flatnonzero(bad_t):
+            bad_t[i] = not _is_missing(t_raw[i])
+        for i in np.flatnonzero(bad_v):
+            results[i] = "expecting float for value - got {}".format(v_raw[i])
+        for i in np.flatnonzero(bad_t):
+            results[i] = "expecting float or int for time - got {}".format(t_raw[i])
+        with np.errstate(invalid='ignore'):
+            out_of_range = ~np.isnan(t) & ~((t >= MIN_TIME) & (t < MAX_TIME))
+        for i in np.flatnonzero(out_of_range & ~bad_v):
+            results[i] = "time {} out of range - expecting epoch seconds between {} and {}".format(
+                t_raw[i], MIN_TIME, MAX_TIME)
+        bad_t |= out_of_range
+
+        ok = ~(bad_v | bad_t)
+        t = np.where(np.isnan(t), time.time(), t)[ok]
+        v = v[ok]
+        self.results.setdefault(data_id, []).extend(results)
+
+        if len(v) == 0:
+            return
+        if data_id in self.points:
+            old_t, old_v = self.points[data_id]
+            t = np.concatenate([old_t, t])
+            v = np.concatenate([old_v, v])
+        self.points[data_id] = (t, v)
+
+    def reject(self, data_id, n, reason):
+        self.results.setdefault(data_id, []).extend([reason] * n)
+
+
+def data_id_error(data_id):
+    """ why data_id can't name a series, None if it can.  A data_id is a
+    single URL path segment and an HDF5 node name """
+    if not isinstance(data_id, str) or data_id.strip() == '':
+        return "data_id may not be empty"
+    if data_id in ('.', '..') or data_id in RESERVED_IDS:
+        return "data_id may not be {}".format(data_id)
+    if '/' in data_id or any(c.isspace() or not c.isprintable() for c in data_id):
+        return "data_id may not contain '/', spaces or control characters - got {!r}".format(
+            data_id)
+    if rollup.is_rollup_key(data_id):
+        return "data_id may not start with {}".format(rollup.PREFIX)
+    return None
+
+def _is_missing(x):
+    return x is None or (isinstance(x, float) and np.isnan(x)) or str(x).strip() == ''
+
+def _is_nan_literal(x):
+    """ the client explicitly sent NaN, which is a valid value.  A NaN
+    float is not, it stands for a missing value """
+    return isinstance(x, str) and x.strip().lower() == 'nan'
+
+def _to_float(raw):
+    """ vectorized float conversion; unparseable entries, and lists or
+    objects nested in JSON, become NaN """
+    try:
+        out = np.asarray([np.nan if x is None else x for x in raw], dtype=float)
+        if out.ndim == 1:
+            return out
+    except (TypeError, ValueError, OverflowError):
+        pass
+    raw = [_scalar(x) for x in raw]
+    return pd.to_numeric(pd.Series(raw, dtype=object), errors='coerce').values.astype(float)
+
+def _scalar(x):
+    """ x if it may be a number, else None """
+    if isinstance(x, (str, float)):
+        return x
+    if isinstance(x, int):
+        try:
+            return float(x)
+        except OverflowError:
+            return None
+    return None
+
+
+def parse_json(body):
+    try:
+        # NaN and Infinity are kept as sent, as text would be
+        doc = json.loads(body, parse_constant=str)
+    except ValueError as e:
+        raise BatchError("invalid json - {}".format(e))
+    if not isinstance(doc, dict) or not isinstance(doc.get('data'), dict):
+        raise BatchError("expecting object with a 'data' mapping of data_id to points")
+
+    batch = Batch(doc.get('key'))
+    for data_id, pts in doc['data'].items():
+        if not isinstance(pts, dict) or not isinstance(pts.get('v'), list):
+            batch.reject(data_id, 1, "expecting {'t': [...], 'v': [...]}")
+            continue
+        v_raw = pts['v']
+        t_raw = pts.get('t', [None] * len(v_raw))
+        if not isinstance(t_raw, list) or len(t_raw) != len(v_raw):
+            batch.reject(data_id, len(v_raw), "'t' and 'v' must be lists of the same length")
+            continue
+        batch.add(data_id, t_raw, v_raw)
+    return batch
+
+def _parse_table(df, key):
+    batch = Batch(key)
+    if len(df) == 0:
+        return batch
+    # fields missing from the end of a line
+    df = df.fillna('')
+    for data_id, g in df.groupby('data_id', sort=False):
+        batch.add(data_id, g['t'].values, g['v'].values)
+    return batch
+
+def parse_csv(body, key=None):
+    try:
+        df = pd.read_csv(StringIO(body), header=None, names=['data_id', 't', 'v'],
+                dtype=str, keep_default_na=False, skip_blank_lines=True)
+    except (ValueError, pd.errors.ParserError) as e:
+        raise BatchError("invalid csv - {}".format(e))
+    return _parse_table(df, key)
+
+def parse_lines(body, key=None):
+    try:
+        df = pd.read_csv(StringIO(body), header=None, names=['data_id', 'v', 't'],
+                sep=r'\s+', dtype=str, keep_default_na=False, comment='#',
+                skip_blank_lines=True)
+    except (ValueError, pd.errors.ParserError) as e:
+        raise BatchError("invalid line protocol - {}".format(e))
+    return _parse_table(df, key)
+
+def parse(content_type, body, key=None):
+    """ parse a batch body according to its mimetype """
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in CSV_TYPES:
+        return parse_csv(body, key)
+    if content_type in LINE_TYPES:
+        return parse_lines(body, key)
+    if content_type in JSON_TYPES or not content_type:
+        batch = parse_json(body)
+        if batch.key is None:
+            batch.key = key
+        return batch
+    raise BatchError("unsupported batch content type {}".format(content_type))
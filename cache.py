@@ -0,0 +1,298 @@
+""" in-memory caches in front of the user stores """
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from util import epoch_ns
+
+
+class _Ring(object):
+    """ fixed size ring of (ns timestamp, value) pairs """
+    def __init__(self, size):
+        self.t = np.zeros(size, dtype=np.int64)
+        self.v = np.zeros(size, dtype=np.float64)
+        self.head = 0
+        self.count = 0
+
+    def extend(self, t, v):
+        size = len(self.t)
+        if len(t) >= size:
+            t, v = t[-size:], v[-size:]
+        idx = (self.head + np.arange(len(t))) % size
+        self.t[idx] = t
+        self.v[idx] = v
+        self.head = (self.head + len(t)) % size
+        self.count = min(self.count + len(t), size)
+
+    def last(self, n):
+        n = min(n, self.count)
+        idx = (self.head - n + np.arange(n)) % len(self.t)
+        return self.t[idx], self.v[idx]
+
+
+class TailCache(object):
+    """ the most recent points of each series, kept in a ring buffer per
+    (user_id, data_id) so the latest values are served without a read
+
+    A series is warmed lazily from the store on its first read.  Writes
+    only extend series that are already warm.  Writers hold write_lock
+    across making points readable and calling extend(), and warming holds
+    it too, so a warm can't miss or repeat the written points.
+    """
+    def __init__(self, size, write_lock):
+        self.size = size
+        self.write_lock = write_lock
+        self._lock = threading.Lock()
+        self._rings = {}
+
+    def latest(self, key, n, load):
+        """ the last n points of a series as (ns times, values), or None if
+        n is beyond the ring size.  load(size) returns the last `size`
+        points as a Series and is only called to warm the ring """
+        if n > self.size:
+            return None
+        with self._lock:
+            ring = self._rings.get(key, None)
+            if ring is not None:
+                return ring.last(n)
+
+        with self.write_lock:
+            with self._lock:
+                ring = self._rings.get(key, None)
+            if ring is None:
+                ring = _Ring(self.size)
+                s = load(self.size)
+                ring.extend(epoch_ns(s.index), s.values.astype(np.float64))
+            with self._lock:
+                self._rings[key] = ring
+                return ring.last(n)
+
+    def extend(self, key, t_ns, v):
+        with self._lock:
+            ring = self._rings.get(key, None)
+            if ring is not None:
+                ring.extend(np.asarray(t_ns, dtype=np.int64), np.asarray(v, dtype=np.float64))
+
+    def discard(self, key):
+        with self._lock:
+            self._rings.pop(key, None)
+
+    def discard_user(self, user_id):
+        """ drop every series of a user, e.g. after another process wrote
+        to its store """
+        with self.write_lock:
+            with self._lock:
+                for key in [k for k in self._rings if k[0] == user_id]:
+                    del self._rings[key]
+
+
+class AggCache(object):
+    """ aggregation partials (see rollup.partials) of closed buckets, per
+    (user_id, data_id, bucket seconds).  Each entry covers whole buckets
+    from lo to hi epoch seconds; lo is None when it starts at the first
+    point.
+
+    A write of points older than an entry's hi makes it stale, write
+    paths call invalidate(), or discard_user() when they don't know what
+    was written.  A computation takes generation() of its series before
+    reading and passes it to put(), which drops the result if a write
+    invalidated the series in the meantime.  Entries are
+    evicted least recently used first beyond max_entries.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._user_generations = {}
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key):
+        """ (lo, hi, partials) or None """
+        with self.lock:
+            e = self._entries.get(key, None)
+            if e is None:
+                self.counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return e
+
+    def generation(self, user_id, data_id):
+        with self.lock:
+            return self._generation(user_id, data_id)
+
+    def _generation(self, user_id, data_id):
+        return (self._user_generations.get(user_id, 0),
+                self._generations.get((user_id, data_id), 0))
+
+    def put(self, key, lo, hi, partials, generation):
+        with self.lock:
+            if self._generation(*key[:2]) != generation:
+                return
+            self._entries[key] = (lo, hi, partials)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def invalidate(self, user_id, data_id, t_min, horizon):
+        """ drop entries of a series with buckets at or after t_min.
+        Points at or after horizon are too recent to be in closed buckets
+        and can't make anything stale """
+        if t_min >= horizon:
+            return
+        with self.lock:
+            key = (user_id, data_id)
+            self._generations[key] = self._generations.get(key, 0) + 1
+            stale = [k for k, (lo, hi, p) in self._entries.items()
+                    if k[0] == user_id and k[1] == data_id and hi > t_min]
+            for k in stale:
+                del self._entries[k]
+            self.counters['invalidations'] += len(stale)
+
+    def discard_user(self, user_id):
+        with self.lock:
+            self._user_generations[user_id] = self._user_generations.get(user_id, 0) + 1
+            stale = [k for k in self._entries if k[0] == user_id]
+            for k in stale:
+                del self._entries[k]
+            self.counters['invalidations'] += len(stale)
+
+
+class SeriesCache(object):
+    """ whole series, as returned by user.get_data_page, in an LRU bounded
+    by their memory use
+
+    Writes extend cached series through extend(); the appended parts are
+    only concatenated when the series is next read.  Writers hold
+    write_lock across making points readable and calling extend().  A
+    reader loading a series takes generation() first and passes it to
+    put(), which drops the series if a write, or a discard_user() of its
+    user, happened in the meantime.
+    """
+    def __init__(self, max_bytes, write_lock):
+        self.max_bytes = max_bytes
+        self.write_lock = write_lock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._user_generations = {}
+        self.nbytes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def generation(self, key):
+        with self.write_lock:
+            with self._lock:
+                return self._generation(key)
+
+    def _generation(self, key):
+        return self._user_generations.get(key[0], 0), self._generations.get(key, 0)
+
+    def get(self, key):
+        with self._lock:
+            e = self._entries.get(key, None)
+            if e is None:
+                self.counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters['hits'] += 1
+            parts = e[0]
+            if len(parts) > 1:
+                parts[:] = [pd.concat(parts)]
+            return parts[0].copy(deep=False)
+
+    def put(self, key, s, generation):
+        nbytes = _nbytes(s)
+        with self.write_lock:
+            with self._lock:
+                if self._generation(key) != generation or nbytes > self.max_bytes:
+                    return
+                self._remove(key)
+                self._entries[key] = ([s], nbytes)
+                self.nbytes += nbytes
+                self._evict()
+
+    def extend(self, key, s):
+        """ append newly written points s to a cached series """
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            e = self._entries.get(key, None)
+            if e is None:
+                return
+            parts, nbytes = e
+            parts.append(s)
+            added = _nbytes(s)
+            self._entries[key] = (parts, nbytes + added)
+            self.nbytes += added
+            self._evict()
+
+    def discard(self, key):
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._remove(key)
+
+    def discard_user(self, user_id):
+        with self._lock:
+            self._user_generations[user_id] = self._user_generations.get(user_id, 0) + 1
+            for key in [k for k in self._entries if k[0] == user_id]:
+                self._remove(key)
+
+    def _remove(self, key):
+        e = self._entries.pop(key, None)
+        if e is not None:
+            self.nbytes -= e[1]
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self._entries:
+            key, (parts, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+            self.counters['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            s = dict(self.counters)
+            s['entries'] = len(self._entries)
+            s['bytes'] = self.nbytes
+        return s
+
+
+def _nbytes(s):
+    return int(s.memory_usage(index=True, deep=False))
+
+
+class PageCache(object):
+    """ rendered pages in an LRU of max_entries.  Keys include the
+    version of the series a page shows, so pages of changed series are
+    never hit again and age out """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key):
+        with self._lock:
+            page = self._entries.get(key, None)
+            if page is None:
+                self.counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return page
+
+    def put(self, key, page):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = page
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries))
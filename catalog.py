@@ -0,0 +1,187 @@
+""" catalog of each user's series
+
+One entry per series with
+
+  created  epoch seconds the series was first written
+  first    earliest and
+  last     latest point time, epoch seconds
+  count    number of points
+  freq     sampling interval given by the writer ('f'), or None
+  version  number of writes to the series
+
+kept in memory and saved to <user_id>.catalog.json, so listings and
+existence checks don't touch the store.  The catalog is updated as
+points are accepted, including points still in the ingest buffer.
+
+New series are saved at once, other changes at most every save_interval
+seconds and on close.  The file records whether it was saved by close;
+after a crash the catalog is rebuilt from the store by scan(user_id),
+keeping created, freq and version of series found in the old copy.
+
+A read-only catalog (web workers next to a writer process, which owns
+the catalog) never saves and rereads the file when it changed.
+"""
+import os
+import json
+import time
+import threading
+import logging as log
+
+import numpy as np
+
+FIELDS = ('created', 'first', 'last', 'count', 'freq', 'version')
+
+
+def entry(created=None, first=None, last=None, count=0, freq=None, version=0):
+    return {'created': created, 'first': first, 'last': last, 'count': count,
+            'freq': freq, 'version': version}
+
+
+class Catalog(object):
+    def __init__(self, scan, root='', save_interval=5.0, readonly=False):
+        """ scan(user_id) gives {data_id: entry} from the user's store """
+        self.scan = scan
+        self.root = root
+        self.save_interval = save_interval
+        self.readonly = readonly
+        self._lock = threading.RLock()
+        # user_id -> {data_id: entry}
+        self._users = {}
+        # user_id -> file mtime_ns when loaded, last save time
+        self._loaded = {}
+        self._saved = {}
+        self._dirty = set()
+
+    def path(self, user_id):
+        return os.path.join(self.root, str(user_id) + ".catalog.json")
+
+    def _mtime(self, user_id):
+        try:
+            return os.stat(self.path(user_id)).st_mtime_ns
+        except OSError:
+            return None
+
+    def _series(self, user_id, create=False):
+        """ the user's entries, loaded or rebuilt on first use.  A user
+        with neither a catalog file nor series in the store is only kept,
+        to be saved, with create; lookups of unknown users leave no trace """
+        with self._lock:
+            series = self._users.get(user_id, None)
+            if series is not None and not (self.readonly and
+                    self._loaded[user_id] != self._mtime(user_id)):
+                return series
+            mtime = self._mtime(user_id)
+            series, clean = self._load(user_id)
+            rebuild = not clean and not self.readonly
+            if rebuild:
+                old, series = series, self.scan(user_id)
+                # what the store doesn't know survives from the old copy
+                for data_id, e in series.items():
+                    if data_id in old:
+                        for k in ('created', 'freq', 'version'):
+                            e[k] = old[data_id].get(k, e[k])
+            if mtime is None and not series and not create:
+                return series
+            if rebuild:
+                log.info("rebuilt series catalog of {}".format(user_id))
+                self._dirty.add(user_id)
+            self._users[user_id] = series
+            self._loaded[user_id] = mtime
+            return series
+
+    def _load(self, user_id):
+        """ ({data_id: entry}, clean) from the saved file, not clean if
+        there is none """
+        try:
+            with open(self.path(user_id)) as f:
+                saved = json.load(f)
+        except IOError:
+            return {}, False
+        except ValueError:
+            log.warning("ignoring unreadable catalog {}".format(self.path(user_id)))
+            return {}, False
+        return saved.get('series', {}), saved.get('clean', False)
+
+    def load(self, user_id):
+        """ make sure the user's catalog is in memory.  Rebuilding it reads
+        the store, so writers call this before taking their locks """
+        self._series(user_id)
+
+    def get(self, user_id, data_id):
+        """ a copy of the entry of a series, None if unknown """
+        with self._lock:
+            e = self._series(user_id).get(data_id, None)
+            return dict(e) if e is not None else None
+
+    def listing(self, user_id):
+        """ {data_id: entry} of all the user's series """
+        with self._lock:
+            return {k: dict(e) for k, e in self._series(user_id).items()}
+
+    def record(self, user_id, points, freqs=None, now=None):
+        """ account for accepted points, {data_id: (t, v)} as for
+        user.write_points.  freqs optionally maps data_id to the sampling
+        interval the writer gave """
+        now = time.time() if now is None else now
+        freqs = freqs or {}
+        with self._lock:
+            series = self._series(user_id, create=True)
+            created = False
+            for data_id, (t, v) in points.items():
+                e = series.get(data_id, None)
+                if e is None:
+                    e = series[data_id] = entry(created=now)
+                    created = True
+                if len(t):
+                    lo, hi = float(np.min(t)), float(np.max(t))
+                    e['first'] = lo if e['first'] is None else min(e['first'], lo)
+                    e['last'] = hi if e['last'] is None else max(e['last'], hi)
+                e['count'] += len(t)
+                e['version'] += 1
+                if freqs.get(data_id, None) is not None:
+                    e['freq'] = freqs[data_id]
+            self._dirty.add(user_id)
+            if created or now - self._saved.get(user_id, 0) >= self.save_interval:
+                self.save(user_id)
+
+    def trim(self, user_id, data_id, removed, first):
+        """ account for points removed by compaction, first being the
+        time of the earliest point left """
+        with self._lock:
+            e = self._series(user_id).get(data_id, None)
+            if e is None:
+                return
+            e['count'] = max(e['count'] - removed, 0)
+            if first is not None:
+                e['first'] = first
+            self._dirty.add(user_id)
+            self.save(user_id)
+
+    def save(self, user_id, clean=False):
+        """ write the user's entries to the catalog file, by rename so a
+        crash leaves the old copy """
+        if self.readonly:
+            return
+        with self._lock:
+            if user_id not in self._users:
+                return
+            path = self.path(user_id)
+            tmp = path + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump({'clean': clean, 'series': self._users[user_id]}, f)
+            os.replace(tmp, path)
+            self._loaded[user_id] = self._mtime(user_id)
+            self._saved[user_id] = time.time()
+            self._dirty.discard(user_id)
+
+    def close(self):
+        """ save every catalog changed since it was loaded, as clean """
+        with self._lock:
+            for user_id in list(self._users):
+                if user_id in self._dirty or user_id in self._saved:
+                    self.save(user_id, clean=True)
+
+    def stats(self):
+        with self._lock:
+            return {'users': len(self._users), 'dirty': len(self._dirty),
+                    'series': sum(len(s) for s in self._users.values())}
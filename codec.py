@@ -0,0 +1,118 @@
+""" compressed blocks of points, after Gorilla (Pelkonen et al. 2015)
+
+Timestamps are stored as delta-of-deltas: regularly sampled series turn
+into runs of zeros and small jitter.  Values are stored XORed with the
+previous value's bits, so repeated and slowly changing readings leave
+mostly zero bytes.  Gorilla packs both into variable length bit fields,
+which can only be decoded one point at a time.  Here they are zigzag
+encoded, cut to the bytes the largest one needs, split into byte planes
+(all first bytes, then all second bytes, ...) and deflated.  That gets
+the zero runs to zlib, and both directions are a handful of numpy
+operations on whole arrays.
+
+A block is
+
+  header   '<4sBBxxQqq': b'SSTB', version, timestamp byte width, point
+           count n, first timestamp, first delta
+  lengths  '<II': bytes of the compressed timestamp and value sections
+  t        deflated byte planes of the n - 2 zigzagged delta-of-deltas
+  v        deflated byte planes of the n XORed float64 bit patterns
+
+Timestamps are int64 epoch ns.  Blocks can be concatenated; decode_all
+reads back a sequence of them.  Only numpy is needed, so clients can
+decode blocks too, see sstsp.decode.
+"""
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b'SSTB'
+VERSION = 1
+_HEADER = struct.Struct('<4sBBxxQqq')
+_LENGTHS = struct.Struct('<II')
+
+
+def _zigzag(x):
+    return ((x << 1) ^ (x >> 63)).view('<u8')
+
+def _unzigzag(u):
+    return ((u >> np.uint64(1)) ^ (np.uint64(0) - (u & np.uint64(1)))).view('<i8')
+
+def _width(u):
+    """ bytes needed for the largest of u """
+    if len(u) == 0:
+        return 0
+    return (int(u.max()).bit_length() + 7) // 8
+
+def _planes(u, width):
+    """ the low width bytes of each uint64, as byte planes """
+    if width == 0:
+        return b""
+    return np.ascontiguousarray(u.view(np.uint8).reshape(-1, 8)[:, :width].T).tobytes()
+
+def _unplanes(b, n, width):
+    out = np.zeros((n, 8), dtype=np.uint8)
+    if width:
+        out[:, :width] = np.frombuffer(b, dtype=np.uint8).reshape(width, n).T
+    return out.view('<u8').reshape(n)
+
+def encode(t, v, level=6):
+    """ a block of int64 ns timestamps t and float64 values v """
+    t = np.asarray(t, dtype='<i8')
+    v = np.asarray(v, dtype='<f8')
+    if len(t) != len(v):
+        raise ValueError("{} timestamps for {} values".format(len(t), len(v)))
+    n = len(t)
+    t0 = int(t[0]) if n else 0
+    d = np.diff(t)
+    d0 = int(d[0]) if n > 1 else 0
+    dod = _zigzag(np.diff(d))
+    width = _width(dod)
+
+    bits = v.view('<u8')
+    x = bits.copy()
+    x[1:] ^= bits[:-1]
+
+    tb = zlib.compress(_planes(dod, width), level)
+    vb = zlib.compress(_planes(x, 8), level)
+    return _HEADER.pack(MAGIC, VERSION, width, n, t0, d0) + _LENGTHS.pack(len(tb), len(vb)) + tb + vb
+
+def decode(body, offset=0):
+    """ (t, v, end) of the block at offset, end being the offset after it """
+    magic, version, width, n, t0, d0 = _HEADER.unpack_from(body, offset)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a version {} block at offset {}".format(VERSION, offset))
+    pos = offset + _HEADER.size
+    tlen, vlen = _LENGTHS.unpack_from(body, pos)
+    pos += _LENGTHS.size
+    tb = zlib.decompress(body[pos:pos + tlen])
+    pos += tlen
+    vb = zlib.decompress(body[pos:pos + vlen])
+    pos += vlen
+
+    t = np.empty(n, dtype='<i8')
+    if n:
+        dod = _unzigzag(_unplanes(tb, max(n - 2, 0), width))
+        d = np.empty(max(n - 1, 0), dtype='<i8')
+        if n > 1:
+            d[0] = d0
+            np.cumsum(dod, out=d[1:])
+            d[1:] += d0
+        t[0] = t0
+        np.cumsum(d, out=t[1:])
+        t[1:] += t0
+    v = np.bitwise_xor.accumulate(_unplanes(vb, n, 8)).view('<f8')
+    return t, v, pos
+
+def decode_all(body):
+    """ (t, v) of all the blocks in body, concatenated """
+    ts, vs = [], []
+    pos = 0
+    while pos < len(body):
+        t, v, pos = decode(body, pos)
+        ts.append(t)
+        vs.append(v)
+    if not ts:
+        return np.zeros(0, dtype='<i8'), np.zeros(0, dtype='<f8')
+    return np.concatenate(ts), np.concatenate(vs)
@@ -0,0 +1,445 @@
+""" memory-mapped columnar storage engine, see engine.py
+
+Each series is a directory <user_id>.cols/<data_id>/ holding
+
+  t.i8          int64 epoch ns timestamps, one per row, in write order
+  v.f8          float64 values
+  <tier>.rollup one record per bucket of a rollup tier: int64 bucket
+                start then count, sum, min, max, first, last as float64
+  unsorted      present once a point was written out of time order
+
+Appends write to the end of the column files, so they cost the same
+however long the series is.  Reads map the files with numpy.memmap and
+slice them without copying; while the timestamps are in order a time
+range is found by binary search.  The column files only ever grow: a
+reader's map stays valid while later points are appended.  Rollup
+records are rewritten in place from the first bucket an append touches,
+which never shortens the file either.
+
+A crash between writing t.i8 and v.f8 leaves t.i8 longer; the extra
+rows are ignored and cut off by the next append.
+
+Compaction (see engine.py) is the only rewrite.  It writes t.i8.tmp and
+v.f8.tmp and renames them over the columns, t.i8 first; while only
+v.f8.tmp is left it holds the values of the new t.i8, and the next
+append finishes the rename.  Rollup files are replaced by rename too.
+"""
+import os
+import threading
+import logging as log
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from urllib.parse import quote, unquote
+
+import numpy as np
+import pandas as pd
+
+import config
+import rollup
+import retention
+import metrics
+from util import epoch_ns, time_index
+
+T_FILE = "t.i8"
+V_FILE = "v.f8"
+UNSORTED_FILE = "unsorted"
+TMP = ".tmp"
+ROLLUP_DTYPE = np.dtype([('t', '<i8')] + [(f, '<f8') for f in rollup.FIELDS])
+
+
+def _series_dir(data_id):
+    # no '/' and no '.' or '..' names
+    return quote(data_id, safe='').replace('.', '%2E')
+
+def _ns(t):
+    """ epoch seconds to int64 ns, converted as the stored times are so
+    bounds fall on the same side of them as in the HDF5 engine.  None
+    stays None """
+    return None if t is None else int(epoch_ns(time_index(t))[0])
+
+def _size(path):
+    """ bytes of the files under path """
+    return sum(os.path.getsize(os.path.join(d, name))
+            for d, dirs, names in os.walk(path) for name in names)
+
+def _write(path, a):
+    with open(path, 'wb') as f:
+        f.write(np.ascontiguousarray(a).tobytes())
+
+def _append(path, a):
+    with open(path, 'ab') as f:
+        f.write(np.ascontiguousarray(a).tobytes())
+
+def _finish_rename(d):
+    """ complete a compaction that crashed between its two renames """
+    t_tmp, v_tmp = os.path.join(d, T_FILE + TMP), os.path.join(d, V_FILE + TMP)
+    if os.path.exists(v_tmp) and not os.path.exists(t_tmp):
+        os.replace(v_tmp, os.path.join(d, V_FILE))
+
+def _clean_tmp(d):
+    """ finish or drop what a crashed compaction left in a series dir """
+    _finish_rename(d)
+    for name in os.listdir(d):
+        if name.endswith(TMP):
+            os.remove(os.path.join(d, name))
+
+def _series(data_id, t, v):
+    s = pd.Series(v, index=pd.DatetimeIndex(t.view('datetime64[ns]'), copy=False),
+            copy=False)
+    s.name = data_id
+    return s
+
+
+class MemmapEngine(object):
+    name = 'memmap'
+
+    def __init__(self, root='', max_maps=1024):
+        self.root = root
+        self.max_maps = max_maps
+        self._lock = threading.Lock()
+        self._user_locks = {}
+        # path -> (inode, rows, array)
+        self._maps = OrderedDict()
+        self.counters = {'maps': 0, 'hits': 0}
+
+    def path(self, user_id):
+        return os.path.join(self.root, str(user_id) + ".cols")
+
+    def exists(self, user_id):
+        return os.path.isdir(self.path(user_id))
+
+    def users(self):
+        root = self.root or os.curdir
+        return sorted(name[:-len(".cols")] for name in os.listdir(root)
+                if name.endswith(".cols") and os.path.isdir(os.path.join(root, name)))
+
+    @contextmanager
+    def session(self, user_id, mode='r'):
+        with self._lock:
+            lock = self._user_locks.setdefault(user_id, threading.RLock())
+        with lock:
+            path = self.path(user_id)
+            if mode != 'r' and not os.path.isdir(path):
+                os.makedirs(path)
+            yield MemmapSession(self, path)
+
+    def version(self, user_id, data_id):
+        try:
+            return os.stat(os.path.join(self.path(user_id), _series_dir(data_id),
+                V_FILE)).st_mtime_ns
+        except OSError:
+            return 0
+
+    def migrate(self, user_id):
+        return []
+
+    def compact(self, user_id, cutoffs, swap=nullcontext):
+        """ rewrite the columns and rollup files losing rows.  The kept
+        rows are written from the maps without holding the user's
+        session; the session doing the renames adds the rows committed
+        meanwhile.  Nothing else is rewritten, there is no space to reclaim
+        but the expired rows' """
+        path = self.path(user_id)
+        before = _size(path)
+        reader = MemmapSession(self, path)
+        with self.session(user_id, 'a') as store:
+            maps = {}
+            for data_id in store.series_ids():
+                _clean_tmp(store._dir(data_id))
+                tiers = {tier: self.column(store._tier_path(data_id, tier), ROLLUP_DTYPE)
+                        for tier in config.ROLLUP_TIERS
+                        if os.path.exists(store._tier_path(data_id, tier))}
+                maps[data_id] = store._columns(data_id) + (tiers,)
+
+        # data_id -> (rows when copied, raw cutoff ns or None, {tier: cutoff ns})
+        plans = {}
+        removed = {}
+        for data_id, (t, v, tiers) in maps.items():
+            d = reader._dir(data_id)
+            cuts = cutoffs(data_id)
+            raw = cuts.get(retention.RAW, None)
+            if raw is not None and len(tiers) == len(config.ROLLUP_TIERS) and len(t):
+                # the latest point is kept
+                raw = min(_ns(raw), int(t[-1]))
+                keep = t >= raw
+                if keep.all():
+                    raw = None
+                else:
+                    _write(os.path.join(d, T_FILE + TMP), t[keep])
+                    _write(os.path.join(d, V_FILE + TMP), v[keep])
+                    removed[data_id] = {'removed': int(len(t) - keep.sum()),
+                            'first': int(t[keep].min()) / 1e9}
+            else:
+                raw = None
+            tier_cuts = {}
+            for tier, rows in tiers.items():
+                if cuts.get(tier, None) is None:
+                    continue
+                seconds = rollup.tier_seconds(tier)
+                cut = _ns(cuts[tier] // seconds * seconds)
+                p = int(np.searchsorted(rows['t'], cut, 'left'))
+                if p:
+                    _write(self._tmp(reader, data_id, tier), rows[p:])
+                    tier_cuts[tier] = cut
+            if raw is not None or tier_cuts:
+                plans[data_id] = (len(t), raw, tier_cuts)
+
+        with swap():
+            with self.session(user_id, 'a') as store:
+                for data_id, (n0, raw, tier_cuts) in plans.items():
+                    late = self._swap_series(store, data_id, n0, raw, tier_cuts)
+                    if late:
+                        removed[data_id]['removed'] += late
+        after = _size(path)
+        return {'bytes_before': before, 'bytes_after': after, 'series': removed}
+
+    def _tmp(self, session, data_id, tier):
+        return session._tier_path(data_id, tier) + TMP
+
+    def _swap_series(self, store, data_id, n0, raw, tier_cuts):
+        """ catch up the rewritten files of a series with the rows
+        committed since they were written, and rename them into place.
+        Returns the number of those rows that expired already """
+        d = store._dir(data_id)
+        t, v = store._columns(data_id)
+        new_t = t[n0:]
+        late = 0
+        if raw is not None:
+            keep = new_t >= raw
+            t_tmp, v_tmp = os.path.join(d, T_FILE + TMP), os.path.join(d, V_FILE + TMP)
+            _append(t_tmp, new_t[keep])
+            _append(v_tmp, v[n0:][keep])
+            late = int(len(keep) - keep.sum())
+            os.replace(t_tmp, os.path.join(d, T_FILE))
+            os.replace(v_tmp, os.path.join(d, V_FILE))
+        for tier, cut in tier_cuts.items():
+            tmp = self._tmp(store, data_id, tier)
+            if len(new_t):
+                # rollup updates rewrite the records from the bucket the
+                # first new point falls in
+                step = rollup.tier_seconds(tier) * 1000000000
+                lo = int(new_t.min()) // step * step
+                p = 0
+                if os.path.getsize(tmp):
+                    kept = np.memmap(tmp, dtype=ROLLUP_DTYPE, mode='r')
+                    p = int(np.searchsorted(kept['t'], lo, 'left'))
+                    # unmapped before the file shrinks
+                    del kept
+                os.truncate(tmp, p * ROLLUP_DTYPE.itemsize)
+                rows = self.column(store._tier_path(data_id, tier), ROLLUP_DTYPE)
+                _append(tmp, rows[int(np.searchsorted(rows['t'], max(lo, cut), 'left')):])
+            os.replace(tmp, store._tier_path(data_id, tier))
+        if raw is None:
+            # the version of a series is the mtime of its values
+            os.utime(os.path.join(d, V_FILE))
+        return late
+
+    def close(self, user_id):
+        prefix = self.path(user_id) + os.sep
+        with self._lock:
+            for path in [p for p in self._maps if p.startswith(prefix)]:
+                del self._maps[path]
+
+    def close_all(self):
+        with self._lock:
+            self._maps.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, open=len(self._maps))
+
+    def column(self, path, dtype):
+        """ the whole of a column file as a read-only array, mapped once
+        and remapped when the file has grown or been replaced """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return np.zeros(0, dtype=dtype)
+        rows = st.st_size // dtype.itemsize
+        with self._lock:
+            e = self._maps.get(path, None)
+            if e is not None and e[0] == st.st_ino and e[1] == rows:
+                self._maps.move_to_end(path)
+                self.counters['hits'] += 1
+                return e[2]
+        if rows == 0:
+            return np.zeros(0, dtype=dtype)
+        with metrics.timer('store_open_seconds', mode='map'):
+            a = np.memmap(path, dtype=dtype, mode='r', shape=(rows,))
+        with self._lock:
+            self._maps[path] = (st.st_ino, rows, a)
+            self.counters['maps'] += 1
+            while len(self._maps) > self.max_maps:
+                self._maps.popitem(last=False)
+        return a
+
+
+class MemmapSession(object):
+    def __init__(self, engine, path):
+        self.engine = engine
+        self.path = path
+
+    def _dir(self, data_id):
+        return os.path.join(self.path, _series_dir(data_id))
+
+    def has(self, data_id):
+        return os.path.exists(os.path.join(self._dir(data_id), T_FILE))
+
+    def series_ids(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(unquote(name) for name in os.listdir(self.path)
+                if os.path.exists(os.path.join(self.path, name, T_FILE)))
+
+    def _columns(self, data_id):
+        d = self._dir(data_id)
+        t = self.engine.column(os.path.join(d, T_FILE), np.dtype('<i8'))
+        v_path = os.path.join(d, V_FILE)
+        if os.path.exists(v_path + TMP) and not os.path.exists(os.path.join(d, T_FILE + TMP)):
+            # a compaction stopped between its renames
+            v_path += TMP
+        v = self.engine.column(v_path, np.dtype('<f8'))
+        n = min(len(t), len(v))
+        return t[:n], v[:n]
+
+    def _sorted(self, data_id):
+        return not os.path.exists(os.path.join(self._dir(data_id), UNSORTED_FILE))
+
+    def nrows(self, data_id):
+        return len(self._columns(data_id)[1])
+
+    def _rows(self, data_id, t, start, end, cursor):
+        """ row numbers from cursor on with start <= t < end, as a slice
+        while the timestamps are sorted, else as an array """
+        lo, hi = _ns(start), _ns(end)
+        if self._sorted(data_id):
+            a = cursor if lo is None else max(cursor, int(np.searchsorted(t, lo, 'left')))
+            b = len(t) if hi is None else int(np.searchsorted(t, hi, 'left'))
+            return slice(a, max(a, b))
+        tail = t[cursor:]
+        mask = np.ones(len(tail), dtype=bool)
+        if lo is not None:
+            mask &= tail >= lo
+        if hi is not None:
+            mask &= tail < hi
+        return cursor + np.flatnonzero(mask)
+
+    def select(self, data_id, start=None, end=None, limit=None, cursor=0):
+        t, v = self._columns(data_id)
+        n = len(t)
+        if cursor >= n:
+            return None, np.zeros(0, dtype=np.int64), n
+        rows = self._rows(data_id, t, start, end, cursor)
+        if isinstance(rows, slice):
+            stop = rows.stop if limit is None else min(rows.stop, rows.start + limit)
+            coords = np.arange(rows.start, stop)
+            rows = slice(rows.start, stop)
+        else:
+            coords = rows = rows[:limit]
+        if len(coords) == 0:
+            return None, coords, n
+        return _series(data_id, t[rows], v[rows]), coords, n
+
+    def read_chunk(self, data_id, start, end, cursor, chunksize):
+        t, v = self._columns(data_id)
+        if cursor >= len(t):
+            return None, cursor
+        if self._sorted(data_id):
+            rows = self._rows(data_id, t, start, end, cursor)
+            if rows.start >= rows.stop:
+                return None, len(t)
+            stop = min(rows.stop, rows.start + chunksize)
+            return _series(data_id, t[rows.start:stop], v[rows.start:stop]), stop
+        stop = min(cursor + chunksize, len(t))
+        rows = self._rows(data_id, t[:stop], start, end, cursor)
+        return _series(data_id, t[rows], v[rows]), stop
+
+    def tail(self, data_id, n):
+        t, v = self._columns(data_id)
+        return _series(data_id, t[-n:], v[-n:])
+
+    def append(self, data_id, s):
+        d = self._dir(data_id)
+        t_path, v_path = os.path.join(d, T_FILE), os.path.join(d, V_FILE)
+        if not os.path.isdir(d):
+            log.debug("creating new data series '{}'".format(data_id))
+            os.makedirs(d)
+        new = not os.path.exists(t_path)
+        _finish_rename(d)
+
+        t_old, v_old = self._columns(data_id)
+        n = len(v_old)
+        for path, dtype in ((t_path, np.dtype('<i8')), (v_path, np.dtype('<f8'))):
+            if os.path.exists(path) and os.path.getsize(path) != n * dtype.itemsize:
+                # left over from a crashed append
+                os.truncate(path, n * dtype.itemsize)
+
+        t = epoch_ns(s.index).astype('<i8', copy=False)
+        v = np.asarray(s.values, dtype='<f8')
+        if len(t) and (np.any(np.diff(t) < 0) or (n and t[0] < t_old[-1])):
+            open(os.path.join(d, UNSORTED_FILE), 'a').close()
+        with open(t_path, 'ab') as f:
+            f.write(t.tobytes())
+        with open(v_path, 'ab') as f:
+            f.write(v.tobytes())
+
+        for tier in config.ROLLUP_TIERS:
+            if new or os.path.exists(self._tier_path(data_id, tier)):
+                self._update_tier(data_id, tier, s)
+            else:
+                # a tier added since the series was created
+                self._rebuild_tier(data_id, tier)
+
+    def _tier_path(self, data_id, tier):
+        return os.path.join(self._dir(data_id), tier + ".rollup")
+
+    def _update_tier(self, data_id, tier, s):
+        """ fold new points into a tier, rewriting the records from the
+        first bucket they touch """
+        path = self._tier_path(data_id, tier)
+        new = rollup.partials(s, rollup.tier_seconds(tier))
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        if len(new) == 0:
+            return
+        rows = self.engine.column(path, ROLLUP_DTYPE)
+        p = int(np.searchsorted(rows['t'], epoch_ns(new.index[:1])[0], 'left'))
+        if p < len(rows):
+            new = rollup.combine(_partials(rows[p:]), new)
+        out = np.empty(len(new), dtype=ROLLUP_DTYPE)
+        out['t'] = epoch_ns(new.index)
+        for f in rollup.FIELDS:
+            out[f] = new[f].values
+        with open(path, 'r+b') as f:
+            f.seek(p * ROLLUP_DTYPE.itemsize)
+            f.write(out.tobytes())
+
+    def _rebuild_tier(self, data_id, tier, chunksize=100000):
+        open(self._tier_path(data_id, tier), 'wb').close()
+        cursor = 0
+        while True:
+            d, cursor = self.read_chunk(data_id, None, None, cursor, chunksize)
+            if d is None:
+                break
+            self._update_tier(data_id, tier, d)
+        log.info("rebuilt {} rollup of {}".format(tier, data_id))
+
+    def has_rollups(self, data_id):
+        return all(os.path.exists(self._tier_path(data_id, tier)) for tier in config.ROLLUP_TIERS)
+
+    def rollup(self, data_id, tier, start=None, end=None):
+        path = self._tier_path(data_id, tier)
+        if not os.path.exists(path):
+            return None
+        rows = self.engine.column(path, ROLLUP_DTYPE)
+        lo, hi = _ns(start), _ns(end)
+        a = 0 if lo is None else int(np.searchsorted(rows['t'], lo, 'left'))
+        b = len(rows) if hi is None else int(np.searchsorted(rows['t'], hi, 'left'))
+        return _partials(rows[a:max(a, b)])
+
+
+def _partials(rows):
+    """ rollup records as a partials frame, copied out of the map """
+    p = pd.DataFrame({f: np.array(rows[f]) for f in rollup.FIELDS}, columns=list(rollup.FIELDS),
+            index=pd.DatetimeIndex(np.array(rows['t']).view('datetime64[ns]')))
+    return p
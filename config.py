@@ -0,0 +1,93 @@
+""" server configuration
+
+Every setting can be overridden from the environment by a variable of the
+same name prefixed with SSTSP_, e.g. SSTSP_INGEST_FLUSH_INTERVAL=0.5
+"""
+import os
+
+def _bool(s):
+    return str(s).lower() in ('1', 'true', 'yes', 'on')
+
+def _get(name, default, cast=str):
+    val = os.environ.get("SSTSP_" + name, None)
+    if val is None:
+        return default
+    return cast(val)
+
+# write-behind ingest: PUTs are acknowledged once appended to the WAL and
+# committed to the user stores in groups by a background flusher
+INGEST_BUFFERED = _get("INGEST_BUFFERED", True, _bool)
+INGEST_WAL_PATH = _get("INGEST_WAL_PATH", "ingest.wal")
+INGEST_FSYNC = _get("INGEST_FSYNC", True, _bool)
+# seconds between flushes
+INGEST_FLUSH_INTERVAL = _get("INGEST_FLUSH_INTERVAL", 1.0, float)
+# flush early once this many points are buffered
+INGEST_MAX_BUFFER = _get("INGEST_MAX_BUFFER", 10000, int)
+# failed commits of a user's points before they are committed one write at
+# a time, and the writes that still fail set aside in <wal>.rejected
+INGEST_MAX_RETRIES = _get("INGEST_MAX_RETRIES", 5, int)
+
+# where series are kept, one of engine.ENGINES: "hdf5" for an HDFStore
+# per user, "memmap" for memory-mapped column files per series
+STORAGE_ENGINE = _get("STORAGE_ENGINE", "hdf5")
+
+# pooled HDFStore handles: at most STORE_MAX_OPEN files are kept open,
+# a handle unused for STORE_IDLE_TIMEOUT seconds is closed
+STORE_MAX_OPEN = _get("STORE_MAX_OPEN", 64, int)
+STORE_IDLE_TIMEOUT = _get("STORE_IDLE_TIMEOUT", 300.0, float)
+# HDF5 compression filter of new series and rollups, e.g. "blosc:zstd",
+# "blosc:lz4" or "zlib"; "" stores them uncompressed.  Existing tables
+# keep the filter they were created with
+STORE_COMPLIB = _get("STORE_COMPLIB", "")
+STORE_COMPLEVEL = _get("STORE_COMPLEVEL", 5, int)
+
+# seconds between saves of a user's series catalog, see catalog.py
+CATALOG_SAVE_INTERVAL = _get("CATALOG_SAVE_INTERVAL", 5.0, float)
+
+# how long points are kept, see retention.py: e.g. "raw=30d,1m=365d"
+# keeps raw points for 30 days, the 1m rollup for a year and the other
+# tiers forever.  "" keeps everything
+RETENTION = _get("RETENTION", "")
+# seconds between background compactions of all stores, which apply the
+# retention rules and reclaim space; 0 disables them
+COMPACT_INTERVAL = _get("COMPACT_INTERVAL", 24 * 3600.0, float)
+
+# points of each series kept in memory for /latest
+TAIL_SIZE = _get("TAIL_SIZE", 1000, int)
+
+# rows read from the store per chunk of a streamed export
+STREAM_CHUNKSIZE = _get("STREAM_CHUNKSIZE", 50000, int)
+
+# rollup tiers kept for every series, as <n><s|m|h|d|w>
+ROLLUP_TIERS = _get("ROLLUP_TIERS", ("1m", "1h", "1d"),
+        lambda s: tuple(t.strip() for t in s.split(",") if t.strip()))
+# longer series are plotted from rollups instead of decimated raw points
+PLOT_RAW_MAX_POINTS = _get("PLOT_RAW_MAX_POINTS", 100000, int)
+
+# aggregation buckets ending more than AGG_CLOSE_DELAY seconds ago are
+# treated as closed and cached, for up to AGG_CACHE_ENTRIES queries
+AGG_CLOSE_DELAY = _get("AGG_CLOSE_DELAY", 60.0, float)
+AGG_CACHE_ENTRIES = _get("AGG_CACHE_ENTRIES", 256, int)
+
+# memory budget of the cache of whole series
+SERIES_CACHE_BYTES = _get("SERIES_CACHE_BYTES", 256 * 1024 * 1024, int)
+
+# rendered plot pages kept, per series version and page arguments
+PLOT_CACHE_ENTRIES = _get("PLOT_CACHE_ENTRIES", 128, int)
+
+# messages kept per live series for subscribers that fall behind, and
+# seconds between keepalive comments on idle event streams
+LIVE_BACKLOG = _get("LIVE_BACKLOG", 100, int)
+LIVE_KEEPALIVE = _get("LIVE_KEEPALIVE", 15.0, float)
+
+# async server (aserver.py): threads running the blocking request work,
+# and requests allowed to wait for one before new ones are refused
+ASYNC_WORKERS = _get("ASYNC_WORKERS", 16, int)
+ASYNC_QUEUE = _get("ASYNC_QUEUE", 256, int)
+
+# unix socket of the single writer process (writer.py).  When set, web
+# workers forward their writes to it instead of writing the stores
+WRITER_ADDRESS = _get("WRITER_ADDRESS", "")
+WRITER_AUTHKEY = _get("WRITER_AUTHKEY", "sstsp")
+# reads retried when the writer commits to the store they are reading
+SNAPSHOT_RETRIES = _get("SNAPSHOT_RETRIES", 5, int)
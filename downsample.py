@@ -0,0 +1,83 @@
+""" shape preserving decimation of series for plotting
+
+Both methods return the positions of the points to keep, in order, so
+the caller can take them from the original series.
+
+  lttb    Largest-Triangle-Three-Buckets: one point per bucket, the one
+          making the largest triangle with the point kept in the previous
+          bucket and the average of the next bucket
+  minmax  the smallest and largest value of each bucket, which keeps
+          every spike visible
+"""
+import numpy as np
+
+from util import epoch_ns
+
+METHODS = ('lttb', 'minmax')
+
+
+def _bucket_edges(n, n_buckets):
+    return (np.arange(n_buckets + 1) * n) // n_buckets
+
+def lttb(x, y, n_out):
+    """ positions of n_out points of x, y chosen by LTTB.  The first and
+    last points are always kept """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n) if n_out >= n else np.array([0, n - 1][:max(n_out, 0)])
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # the interior points are split in n_out - 2 buckets
+    edges = 1 + _bucket_edges(n - 2, n_out - 2)
+    # average point of each bucket, plus the last point as a final bucket
+    counts = np.diff(edges)
+    avg_x = np.append(np.add.reduceat(x[1:-1], edges[:-1] - 1) / counts, x[-1])
+    avg_y = np.append(np.add.reduceat(y[1:-1], edges[:-1] - 1) / counts, y[-1])
+
+    out = np.empty(n_out, dtype=np.int64)
+    out[0] = 0
+    out[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        bx = x[lo:hi]
+        by = y[lo:hi]
+        # twice the triangle area, the constant factor doesn't matter
+        area = np.abs((x[a] - avg_x[i + 1]) * (by - y[a]) -
+                      (x[a] - bx) * (avg_y[i + 1] - y[a]))
+        a = lo + int(np.argmax(area))
+        out[i + 1] = a
+    return out
+
+def minmax(x, y, n_out):
+    """ positions of the min and max of n_out // 2 buckets """
+    n = len(y)
+    n_buckets = n_out // 2
+    if n_out >= n or n_buckets < 1:
+        return np.arange(n)
+
+    y = np.asarray(y, dtype=np.float64)
+    edges = _bucket_edges(n, n_buckets)
+    bucket = np.repeat(np.arange(n_buckets), np.diff(edges))
+    keep = []
+    for reduce in (np.minimum, np.maximum):
+        extreme = reduce.reduceat(y, edges[:-1])
+        hits = np.flatnonzero(y == extreme[bucket])
+        # first hit in each bucket
+        _, first = np.unique(bucket[hits], return_index=True)
+        keep.append(hits[first])
+    return np.unique(np.concatenate(keep))
+
+def decimate(d, max_points, method='lttb'):
+    """ at most max_points points of series d for plotting, NaNs dropped """
+    d = d[d.notnull()]
+    if max_points is None or len(d) <= max_points:
+        return d
+    x = epoch_ns(d.index).astype(np.float64)
+    if method == 'minmax':
+        idx = minmax(x, d.values, max_points)
+    else:
+        idx = lttb(x, d.values, max_points)
+    return d.iloc[idx]
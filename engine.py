@@ -0,0 +1,385 @@
+""" storage engines behind the user store functions of user.py
+
+An engine keeps each user's series and their rollup tiers.  user.py only
+talks to it through sessions:
+
+    with engine.session(user_id, mode) as store:
+        ...
+
+Sessions of one user are serialized within a process.  Mode 'r' sessions
+only read; any other mode may append, and creates the user's store.  A
+session offers
+
+  has(data_id), series_ids(), nrows(data_id)
+  select(data_id, start, end, limit, cursor)  -> (series, coords, nrows)
+  read_chunk(data_id, start, end, cursor, n)  -> (series, next cursor)
+  tail(data_id, n)                            -> series
+  append(data_id, s)                          new points, updating rollups
+  has_rollups(data_id)
+  rollup(data_id, tier, start, end)           -> partials, see rollup.py
+
+start and end are epoch seconds or None and select start <= t < end.
+Rows are numbered in write order, cursors count rows.  select returns
+the matching series (None if no row matched), their row numbers and the
+number of rows; read_chunk returns None once cursor is past the last row.
+
+The engine itself offers path(user_id), exists(user_id), users(),
+session(), version(user_id, data_id), a stamp that is cheap to get and
+changes with every commit, migrate(user_id), close(user_id), close_all()
+and stats(), and
+
+  compact(user_id, cutoffs, swap)
+
+which removes expired points and reclaims the space they and earlier
+rewrites took.  cutoffs(data_id) gives {level: epoch seconds} as
+retention.cutoffs, points of a level before its cutoff are removed.  The
+store is copied without holding it; swap() is a context manager around
+the short final step that catches up with later commits and replaces
+the store.  Returns a report
+
+  {'bytes_before': n, 'bytes_after': n,
+   'series': {data_id: {'removed': raw points removed, 'first': epoch
+              seconds of the first point left}}}
+
+listing the series raw points were removed from.
+
+config.STORAGE_ENGINE picks one:
+
+  hdf5    one pandas HDFStore per user, see HDF5Engine
+  memmap  memory-mapped column files per series, see columnar.py
+"""
+import os
+import logging as log
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+import pandas as pd
+
+import config
+import rollup
+import storepool
+import retention
+from util import time_index, in_range, epoch_ns
+
+ENGINES = ('hdf5', 'memmap')
+
+
+def open_engine(name, generation=None):
+    """ the engine called name.  generation is given with a writer
+    process, see storepool.Generations """
+    if name == 'hdf5':
+        return HDF5Engine(max_open=config.STORE_MAX_OPEN,
+                idle_timeout=config.STORE_IDLE_TIMEOUT, generation=generation,
+                complib=config.STORE_COMPLIB, complevel=config.STORE_COMPLEVEL)
+    if name == 'memmap':
+        import columnar
+        return columnar.MemmapEngine(max_maps=16 * config.STORE_MAX_OPEN)
+    raise ValueError("unknown storage engine {} - expecting one of {}".format(
+        name, ", ".join(ENGINES)))
+
+
+def _time_where(start=None, end=None):
+    """ where clause selecting start <= t < end, both epoch seconds """
+    where = []
+    if start is not None:
+        where.append("index >= {!r}".format(time_index(start)[0].isoformat()))
+    if end is not None:
+        where.append("index < {!r}".format(time_index(end)[0].isoformat()))
+    return where
+
+
+def _table_cutoffs(session, data_id, cuts):
+    """ {table key: epoch seconds} of a series' tables from retention
+    cutoffs.  Raw points are only removed while the rollups hold them, and
+    the latest point is kept; rollup buckets are kept whole """
+    out = {}
+    raw = cuts.get(retention.RAW, None)
+    if raw is not None and session.has_rollups(data_id) and session.nrows(data_id):
+        last = epoch_ns(session.tail(data_id, 1).index)[0] // 1000000000
+        out[data_id] = min(raw, last)
+    for tier in config.ROLLUP_TIERS:
+        if cuts.get(tier, None) is not None:
+            seconds = rollup.tier_seconds(tier)
+            out[rollup.tier_key(tier, data_id)] = cuts[tier] // seconds * seconds
+    return out
+
+def _append(out, key, d, cut=None):
+    """ append the rows of d from cut on to a table of out.  Returns the
+    earliest time appended, None if none were """
+    if d is None:
+        return None
+    if cut is not None:
+        d = d[in_range(d, cut, None)]
+    if len(d) == 0:
+        return None
+    out.append(key, d, format='table', index=True)
+    return float(epoch_ns(d.index).min() / 1e9)
+
+def _recopy(store, out, key, lo, cut):
+    """ replace the rows of a table of out from time lo on (all if lo is
+    None) by those of store, from cut on """
+    if key in out:
+        if lo is None:
+            out.remove(key)
+        else:
+            out.remove(key, where=_time_where(lo))
+    start = lo if cut is None else cut if lo is None else max(lo, cut)
+    _append(out, key, store.select(key, where=_time_where(start) or None))
+
+def _min_time(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+def _keep_first(firsts, data_id, t):
+    firsts[data_id] = _min_time(firsts.get(data_id, None), t)
+
+
+class HDF5Engine(object):
+    """ each user's series in one HDFStore, <user_id>.hf5, with the raw
+    series at '<data_id>' and rollups under '_rollup_<tier>/<data_id>'.
+    Handles are pooled, see storepool.py.  Tables are chunked, complib
+    adds a compression filter to new ones """
+    name = 'hdf5'
+
+    def __init__(self, root='', max_open=64, idle_timeout=300.0, generation=None,
+            complib=None, complevel=0):
+        self.root = root
+        self._pool = storepool.StorePool(self.path, max_open=max_open,
+                idle_timeout=idle_timeout, generation=generation,
+                complib=complib, complevel=complevel)
+
+    def path(self, user_id):
+        return os.path.join(self.root, str(user_id) + ".hf5")
+
+    def exists(self, user_id):
+        return os.path.exists(self.path(user_id))
+
+    def users(self):
+        return sorted(name[:-len(".hf5")] for name in os.listdir(self.root or os.curdir)
+                if name.endswith(".hf5"))
+
+    @contextmanager
+    def session(self, user_id, mode='r'):
+        with self._pool.session(user_id, mode) as store:
+            yield HDF5Session(store)
+
+    def version(self, user_id, data_id):
+        try:
+            return os.stat(self.path(user_id)).st_mtime_ns
+        except OSError:
+            return 0
+
+    def migrate(self, user_id):
+        """ one-time conversion of all fixed format series in a user store
+
+        Stores written before series were kept in table format hold each
+        series in fixed format, which can only be rewritten whole.  Appends
+        migrate lazily, this does the whole store at once.
+        """
+        migrated = []
+        with self.session(user_id, 'r+') as store:
+            for data_id in store.series_ids():
+                if not store.is_table(data_id):
+                    store.migrate(data_id)
+                    migrated.append(data_id)
+        return migrated
+
+    def compact(self, user_id, cutoffs, swap=nullcontext, chunksize=100000):
+        """ rewrite the store into <user_id>.hf5.compact without the
+        expired rows and replace it, as ptrepack would.  Tables are copied
+        a chunk at a time, each from its own read session; the rows
+        committed since are copied in the session replacing the file """
+        path = self.path(user_id)
+        tmp = path + ".compact"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        before = os.path.getsize(path)
+        out = pd.HDFStore(tmp, 'w', complevel=self._pool.complevel, complib=self._pool.complib)
+        # data_id -> ({table key: rows when copied}, {table key: cutoff})
+        copied = {}
+        firsts = {}
+        removed = {}
+
+        def catch_up(store):
+            session = HDF5Session(store)
+            for data_id in session.series_ids():
+                sizes, cuts = copied.get(data_id, ({}, None))
+                if cuts is None:
+                    cuts = _table_cutoffs(session, data_id, cutoffs(data_id))
+                n0 = sizes.get(data_id, 0)
+                nrows = session.nrows(data_id)
+                if nrows > n0:
+                    new = session.select(data_id, cursor=n0)[0]
+                    _keep_first(firsts, data_id, _append(out, data_id, new, cuts.get(data_id)))
+                for tier in config.ROLLUP_TIERS:
+                    key = rollup.tier_key(tier, data_id)
+                    if key not in store:
+                        continue
+                    if key not in sizes:
+                        _recopy(store, out, key, None, cuts.get(key))
+                    elif nrows > n0:
+                        # rollup updates rewrite the buckets from the one
+                        # the first new point falls in
+                        lo = epoch_ns(new.index).min() // 1000000000
+                        _recopy(store, out, key, lo // rollup.tier_seconds(tier) *
+                                rollup.tier_seconds(tier), cuts.get(key))
+                kept = out.get_storer(data_id).nrows if data_id in out else 0
+                if nrows > kept:
+                    removed[data_id] = {'removed': int(nrows - kept), 'first': firsts.get(data_id)}
+            out.close()
+
+        try:
+            with self.session(user_id) as store:
+                for data_id in store.series_ids():
+                    sizes = {data_id: store.nrows(data_id)}
+                    for tier in config.ROLLUP_TIERS:
+                        key = rollup.tier_key(tier, data_id)
+                        if key in store.store:
+                            sizes[key] = store.store.get_storer(key).nrows
+                    copied[data_id] = sizes, _table_cutoffs(store, data_id, cutoffs(data_id))
+            for data_id, (sizes, cuts) in copied.items():
+                for key, nrows in sizes.items():
+                    first = self._copy_rows(user_id, out, key, nrows, cuts.get(key), chunksize)
+                    if key == data_id:
+                        _keep_first(firsts, data_id, first)
+            with swap():
+                self._pool.replace(user_id, tmp, catch_up)
+        finally:
+            if out.is_open:
+                out.close()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        after = os.path.getsize(path)
+        return {'bytes_before': before, 'bytes_after': after, 'series': removed}
+
+    def _copy_rows(self, user_id, out, key, nrows, cut, chunksize):
+        """ rows [0, nrows) of a table with times from cut on into out,
+        each chunk read in its own session.  Returns the earliest time
+        copied """
+        first = None
+        start = 0
+        while start < nrows:
+            with self.session(user_id) as session:
+                store = session.store
+                if store.get_storer(key).is_table:
+                    d = store.select(key, start=start, stop=min(start + chunksize, nrows))
+                    start += chunksize
+                else:
+                    # fixed format, copied whole as a table
+                    d = store[key]
+                    d.index = pd.DatetimeIndex(d.index).astype('datetime64[ns]')
+                    start = nrows
+            first = _min_time(first, _append(out, key, d, cut))
+        return first
+
+    def close(self, user_id):
+        self._pool.close(user_id)
+
+    def close_all(self):
+        self._pool.close_all()
+
+    def stats(self):
+        return dict(self._pool.counters, open=len(self._pool))
+
+
+class HDF5Session(object):
+    def __init__(self, store):
+        self.store = store
+
+    def has(self, data_id):
+        return data_id in self.store
+
+    def series_ids(self):
+        """ data_ids of the raw series in the store """
+        return [k.lstrip('/') for k in self.store.keys() if not rollup.is_rollup_key(k)]
+
+    def nrows(self, data_id):
+        storer = self.store.get_storer(data_id)
+        if storer.is_table:
+            return storer.nrows
+        # fixed format, the length is kept with the array, it isn't read
+        return int(storer.shape[0])
+
+    def is_table(self, data_id):
+        return self.store.get_storer(data_id).is_table
+
+    def migrate(self, data_id):
+        """ rewrite a fixed format series in appendable table format """
+        store = self.store
+        s = store[data_id]
+        s.name = data_id
+        s.index = pd.DatetimeIndex(s.index).astype('datetime64[ns]')
+        store.remove(data_id)
+        store.append(data_id, s, format='table', index=True)
+        log.info("migrated {} to table format ({} rows)".format(data_id, len(s)))
+        rollup.rebuild(store, data_id, config.ROLLUP_TIERS)
+
+    def select(self, data_id, start=None, end=None, limit=None, cursor=0):
+        """ matching rows from row `cursor` on, read with a where clause on
+        the time index """
+        store = self.store
+        storer = store.get_storer(data_id)
+        if not storer.is_table:
+            d = store[data_id]
+            coords = np.flatnonzero(in_range(d, start, end))
+            coords = coords[coords >= cursor][:limit]
+            return d.iloc[coords], coords, len(d)
+
+        nrows = storer.nrows
+        where = _time_where(start, end)
+        if cursor >= nrows:
+            return None, np.zeros(0, dtype=np.int64), nrows
+        if not where and limit is None:
+            d = store.select(data_id, start=cursor)
+            return d, np.arange(cursor, nrows), nrows
+
+        coords = np.asarray(store.select_as_coordinates(data_id, where=where or None, start=cursor))
+        coords = coords[:limit]
+        if len(coords) == 0:
+            return None, coords, nrows
+        return store.select(data_id, where=coords), coords, nrows
+
+    def read_chunk(self, data_id, start, end, cursor, chunksize):
+        store = self.store
+        if not self.is_table(data_id):
+            # a fixed format series can only be read whole, as one chunk
+            if cursor > 0:
+                return None, cursor
+            d = store[data_id]
+            return d[in_range(d, start, end)], 1
+        if cursor >= self.nrows(data_id):
+            return None, cursor
+        d = store.select(data_id, where=_time_where(start, end) or None,
+                start=cursor, stop=cursor + chunksize)
+        return d, cursor + chunksize
+
+    def tail(self, data_id, n):
+        storer = self.store.get_storer(data_id)
+        if storer.is_table:
+            return self.store.select(data_id, start=max(storer.nrows - n, 0))
+        return self.store[data_id].tail(n)
+
+    def append(self, data_id, s):
+        store = self.store
+        if data_id not in store:
+            log.debug("creating new data series '{}'".format(data_id))
+            # table format so later appends only write the new rows;
+            # the index is the queryable time column
+            store.append(data_id, s, format='table', index=True)
+            rollup.update(store, data_id, s, config.ROLLUP_TIERS)
+            return
+        if not self.is_table(data_id):
+            self.migrate(data_id)
+        store.append(data_id, s)
+        if self.has_rollups(data_id):
+            rollup.update(store, data_id, s, config.ROLLUP_TIERS)
+        else:
+            # series from before rollups were kept
+            rollup.rebuild(store, data_id, config.ROLLUP_TIERS)
+
+    def has_rollups(self, data_id):
+        return all(rollup.tier_key(tier, data_id) in self.store for tier in config.ROLLUP_TIERS)
+
+    def rollup(self, data_id, tier, start=None, end=None):
+        t0 = time_index(start)[0] if start is not None else None
+        t1 = time_index(end)[0] if end is not None else None
+        return rollup.read(self.store, data_id, tier, t0, t1)
@@ -0,0 +1,153 @@
+""" encodings of series for the data endpoints
+
+'json' is pandas' split orientation, built in one piece.  The other
+formats are encoded chunk by chunk so large exports can be streamed.
+Timestamps are epoch milliseconds in the text formats, as in 'json', and
+int64 epoch nanoseconds in the binary ones:
+
+  raw      a sequence of frames, each a little-endian uint64 point count
+           n followed by n int64 timestamps and n float64 values
+  msgpack  a sequence of maps {"name": str, "t": bin, "v": bin} where t
+           and v hold the same little-endian int64/float64 arrays
+  arrow    an Arrow IPC stream of record batches with columns
+           t: timestamp[ns] and v: float64
+  block    a sequence of compressed blocks, see codec.py
+
+The binary encodings are built from the series' arrays without
+converting each point in python.  msgpack and arrow need the optional
+msgpack and pyarrow packages.
+"""
+import io
+import struct
+
+import numpy as np
+import pandas as pd
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+import codec
+from util import epoch_ns
+# the client's table, so both ends agree
+from sstsp import MIMETYPES
+
+STREAMED = ('ndjson', 'csv', 'raw', 'msgpack', 'arrow', 'block')
+BINARY = ('raw', 'msgpack', 'arrow', 'block')
+
+def available(fmt):
+    """ False if fmt needs a package that isn't installed """
+    if fmt == 'msgpack':
+        return msgpack is not None
+    if fmt == 'arrow':
+        return pa is not None
+    return fmt in MIMETYPES
+
+
+def negotiate(fmt, accept_mimetypes, default='json'):
+    """ pick a format from an explicit format argument or else the Accept
+    header.  None if the requested format is unknown """
+    if fmt:
+        return fmt if fmt in MIMETYPES else None
+    best = accept_mimetypes.best_match([MIMETYPES[default]] +
+            [m for k, m in MIMETYPES.items() if k != default], MIMETYPES[default])
+    for k, m in MIMETYPES.items():
+        if m == best:
+            return k
+    return default
+
+def _frame(d):
+    return pd.DataFrame({'t': epoch_ns(d.index) // 1000000, 'v': d.values.astype(float)})
+
+def ndjson_chunk(d):
+    """ one {"t": ms, "v": value} object per line """
+    if len(d) == 0:
+        return ""
+    return _frame(d).to_json(orient='records', lines=True).rstrip("\n") + "\n"
+
+def csv_chunk(d):
+    return _frame(d).to_csv(header=False, index=False)
+
+def _arrays(d):
+    """ little-endian int64 ns times and float64 values of a series """
+    t = epoch_ns(d.index).astype('<i8', copy=False)
+    v = np.asarray(d.values, dtype='<f8')
+    return t, v
+
+def raw_chunk(d):
+    t, v = _arrays(d)
+    return struct.pack('<Q', len(t)) + t.tobytes() + v.tobytes()
+
+def block_chunk(d):
+    return codec.encode(*_arrays(d))
+
+def msgpack_chunk(d):
+    t, v = _arrays(d)
+    return msgpack.packb({'name': d.name, 't': t.tobytes(), 'v': v.tobytes()},
+            use_bin_type=True)
+
+ARROW_SCHEMA = None if pa is None else pa.schema([
+    ('t', pa.timestamp('ns')),
+    ('v', pa.float64()),
+])
+
+def _arrow_stream(chunks):
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, ARROW_SCHEMA)
+
+    def drain():
+        out = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return out
+
+    for d in chunks:
+        t, v = _arrays(d)
+        writer.write_batch(pa.record_batch([pa.array(t.view('datetime64[ns]')),
+            pa.array(v)], schema=ARROW_SCHEMA))
+        yield drain()
+    writer.close()
+    yield drain()
+
+def encode_chunks(fmt, chunks):
+    """ generator encoding an iterable of series chunks as fmt """
+    if fmt == 'raw':
+        for d in chunks:
+            yield raw_chunk(d)
+    elif fmt == 'msgpack':
+        for d in chunks:
+            yield msgpack_chunk(d)
+    elif fmt == 'block':
+        for d in chunks:
+            yield block_chunk(d)
+    elif fmt == 'arrow':
+        for out in _arrow_stream(chunks):
+            yield out
+    elif fmt == 'csv':
+        yield "t,v\n"
+        for d in chunks:
+            yield csv_chunk(d)
+    elif fmt == 'ndjson':
+        for d in chunks:
+            yield ndjson_chunk(d)
+    else:
+        raise ValueError("{} can't be streamed".format(fmt))
+
+def sse_event(d):
+    """ d as one server-sent event whose data is d in the 'json' format,
+    encoded once for all subscribers """
+    return "data: {}\n\n".format(d.to_json(orient='split')).encode('utf-8')
+
+def encode(fmt, d):
+    """ the whole of series d encoded as fmt """
+    if fmt == 'json':
+        return d.to_json(orient='split')
+    if fmt in BINARY:
+        return b"".join(encode_chunks(fmt, [d]))
+    return "".join(encode_chunks(fmt, [d]))
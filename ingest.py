@@ -0,0 +1,363 @@
+""" write-behind ingest buffer
+
+Points are appended to a write-ahead log and held in memory until a
+background thread group-commits them, one store session per user.  A
+write is acknowledged as soon as its WAL record is on disk.  Writers
+that arrive while an fsync is running share the next one.
+
+The WAL is a file of json lines, one per put().  At flush time it is
+rotated to <wal>.flushing so new writes can continue while the previous
+group is committed; the rotated file is removed once the commit succeeds.
+On start up both files are replayed.
+
+Users are committed one by one.  The points of a user whose commit fails
+stay in <wal>.flushing and are retried with the next group, the other
+users' are not held up.  Series the failed commit did append are dropped
+from the group, so they aren't written twice.  After max_retries failures the user's points are
+committed one put() at a time, and those that still fail are set aside
+in <wal>.rejected, in the WAL's format, and logged.
+"""
+import json
+import os
+import threading
+import time
+import logging as log
+
+import numpy as np
+
+
+class IngestBuffer(object):
+    def __init__(self, wal_path, commit, flush_interval=1.0, max_buffer=10000, fsync=True,
+            max_retries=5):
+        """ commit(user_id, points, done) writes {data_id: (t, v)} to the
+        user's store and must raise if it fails.  It calls done(data_id)
+        once a series' points are readable from the store, while readers
+        of the store are still excluded, so that no reader sees the points
+        in both places or in neither"""
+        self.wal_path = wal_path
+        self.flushing_path = wal_path + ".flushing"
+        self.rejected_path = wal_path + ".rejected"
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.fsync = fsync
+        self.max_retries = max_retries
+        self._commit = commit
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        # taken before _lock.  WAL records are numbered as written, _synced
+        # is the last one known to be on disk
+        self._sync_lock = threading.Lock()
+        self._written = 0
+        self._synced = 0
+        self._pending = {}
+        self._flushing = {}
+        # user_id -> failed commits of the points in _flushing
+        self._failures = {}
+        self._size = 0
+        self._thread = None
+        self._stopped = False
+
+        self.counters = {
+            'points_buffered': 0,
+            'points_flushed': 0,
+            'flushes': 0,
+            'flush_errors': 0,
+            'points_rejected': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+        }
+
+        self.recover()
+        self._wal = open(self.wal_path, 'ab')
+        if self._flushing:
+            # left over from a failed recovery, retried in the background
+            self._ensure_flusher()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self.counters)
+            s['queue_depth'] = self._size
+            s['flushing'] = _count(self._flushing)
+        return s
+
+    def put(self, user_id, points, sync=True):
+        """ durably buffer {data_id: (t, v)} for user_id.  With sync=False
+        the points are buffered but may not be on disk yet; the caller
+        must sync() the returned record number before acknowledging them """
+        points = {d: (np.asarray(t, dtype=float), np.asarray(v, dtype=float))
+                for d, (t, v) in points.items()}
+        rec = json.dumps({'u': user_id,
+            'p': {d: [t.tolist(), v.tolist()] for d, (t, v) in points.items()}})
+
+        n = sum(len(v) for t, v in points.values())
+        with self._lock:
+            self._wal.write(rec.encode('utf-8') + b'\n')
+            self._wal.flush()
+            self._written += 1
+            seq = self._written
+            _merge(self._pending, user_id, points)
+            self._size += n
+            self.counters['points_buffered'] += n
+            if self._size >= self.max_buffer:
+                self._wakeup.notify()
+
+        self._ensure_flusher()
+        if sync:
+            self.sync(seq)
+        return seq
+
+    def sync(self, seq):
+        """ wait until WAL record seq is on disk """
+        if not self.fsync:
+            return
+        with self._sync_lock:
+            if self._synced >= seq:
+                # covered by an fsync that started after it was written
+                return
+            with self._lock:
+                target = self._written
+                fileno = self._wal.fileno()
+            os.fsync(fileno)
+            self._synced = target
+
+    def pending(self, user_id, data_id):
+        """ unflushed (t, v) for a series, or None """
+        with self._lock:
+            parts = [g[user_id][data_id] for g in (self._flushing, self._pending)
+                    if data_id in g.get(user_id, {})]
+        if not parts:
+            return None
+        return (np.concatenate([t for p in parts for t in p[0]]),
+                np.concatenate([v for p in parts for v in p[1]]))
+
+    def pending_ids(self, user_id):
+        """ data_ids with unflushed points """
+        with self._lock:
+            return set(self._flushing.get(user_id, {})) | set(self._pending.get(user_id, {}))
+
+    def flush(self):
+        """ commit everything buffered so far """
+        with self._flush_lock:
+            with self._sync_lock, self._lock:
+                if self._pending:
+                    if self.fsync:
+                        os.fsync(self._wal.fileno())
+                    self._synced = self._written
+                    self._wal.close()
+                    if self._flushing:
+                        # points of failed commits are retried with the new ones
+                        _append_file(self.wal_path, self.flushing_path, self.fsync)
+                        os.remove(self.wal_path)
+                        for user_id, series in self._pending.items():
+                            _extend(self._flushing, user_id, series)
+                    else:
+                        if os.path.exists(self.wal_path):
+                            os.rename(self.wal_path, self.flushing_path)
+                        self._flushing = self._pending
+                    self._pending = {}
+                    self._size = 0
+                    self._wal = open(self.wal_path, 'ab')
+                group = self._flushing
+
+            if not group:
+                return
+
+            start = time.time()
+            n = _count(group)
+            rejected = self.counters['points_rejected']
+            for user_id in list(group):
+                self._commit_user(group, user_id)
+            n -= self.counters['points_rejected'] - rejected
+
+            with self._lock:
+                left = _count(group)
+                if group:
+                    # only the failed users' points stay in the rotated WAL
+                    _write_group(self.flushing_path, group, self.fsync)
+                else:
+                    self._flushing = {}
+                    if os.path.exists(self.flushing_path):
+                        os.remove(self.flushing_path)
+
+            ms = 1000 * (time.time() - start)
+            self.counters['flushes'] += 1
+            self.counters['points_flushed'] += n - left
+            self.counters['last_flush_ms'] = ms
+            self.counters['total_flush_ms'] += ms
+            self.counters['max_flush_ms'] = max(ms, self.counters['max_flush_ms'])
+            log.debug("ingest flushed {} points in {} ms".format(n - left, ms))
+
+    def _commit_user(self, group, user_id):
+        """ commit and remove a user's points from group, series by series.
+        Those not committed are kept if the commit fails, until it failed
+        max_retries times """
+        def done(data_id):
+            with self._lock:
+                series = group.get(user_id, {})
+                series.pop(data_id, None)
+                if not series:
+                    group.pop(user_id, None)
+        try:
+            self._commit(user_id, _concat(group[user_id]), done)
+            self._failures.pop(user_id, None)
+            return
+        except Exception:
+            self.counters['flush_errors'] += 1
+            failures = self._failures[user_id] = self._failures.get(user_id, 0) + 1
+            if failures < self.max_retries:
+                log.exception("ingest flush failed for {}, will retry".format(user_id))
+                return
+            log.exception("ingest flush failed for {} {} times, committing its points "
+                    "one write at a time".format(user_id, failures))
+        self._failures.pop(user_id, None)
+        series = group.get(user_id, {})
+        for data_id in list(series):
+            while data_id in series:
+                t, v = series[data_id][0][0], series[data_id][1][0]
+                shifted = []
+                def shift(committed=None):
+                    if not shifted:
+                        shifted.append(True)
+                        with self._lock:
+                            _shift(series, data_id)
+                try:
+                    self._commit(user_id, {data_id: (t, v)}, shift)
+                except Exception:
+                    log.exception("setting aside {} points of {}/{} that can't be committed, "
+                            "see {}".format(len(v), user_id, data_id, self.rejected_path))
+                    _write_group(self.rejected_path, {user_id: {data_id: ([t], [v])}},
+                            self.fsync, append=True)
+                    self.counters['points_rejected'] += len(v)
+                    shift()
+        with self._lock:
+            group.pop(user_id, None)
+
+    def recover(self):
+        """ commit points left in WAL files by a previous process.  Points
+        that can't be committed are kept for the flusher to retry """
+        group = {}
+        for path in (self.flushing_path, self.wal_path):
+            if os.path.exists(path):
+                _replay(path, group)
+        if not group:
+            for path in (self.flushing_path, self.wal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+        log.info("recovering {} points from ingest WAL".format(_count(group)))
+        if os.path.exists(self.wal_path):
+            _append_file(self.wal_path, self.flushing_path, self.fsync)
+            os.remove(self.wal_path)
+        self._flushing = group
+        self.flush()
+
+    def close(self):
+        """ stop the flusher and commit whatever is buffered.  Closing
+        again does nothing """
+        if self._wal.closed:
+            return
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        with self._sync_lock, self._lock:
+            if self.fsync:
+                os.fsync(self._wal.fileno())
+            self._synced = self._written
+            self._wal.close()
+
+    def _ensure_flusher(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(target=self._run, name="ingest-flusher")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._size < self.max_buffer and not self._stopped:
+                    self._wakeup.wait(self.flush_interval)
+                if self._stopped:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                log.exception("ingest flusher error")
+
+
+def _merge(group, user_id, points):
+    """ group is {user_id: {data_id: ([t arrays], [v arrays])}} """
+    series = group.setdefault(user_id, {})
+    for data_id, (t, v) in points.items():
+        ts, vs = series.setdefault(data_id, ([], []))
+        ts.append(t)
+        vs.append(v)
+
+def _extend(group, user_id, series):
+    """ add the {data_id: ([t arrays], [v arrays])} of a user to group """
+    into = group.setdefault(user_id, {})
+    for data_id, (ts, vs) in series.items():
+        its, ivs = into.setdefault(data_id, ([], []))
+        its.extend(ts)
+        ivs.extend(vs)
+
+def _shift(series, data_id):
+    """ drop the first put() of a series, and the series once it's empty """
+    ts, vs = series[data_id]
+    del ts[0]
+    del vs[0]
+    if not ts:
+        del series[data_id]
+
+def _concat(series):
+    return {d: (np.concatenate(ts), np.concatenate(vs)) for d, (ts, vs) in series.items()}
+
+def _count(group):
+    n = 0
+    for series in group.values():
+        for ts, vs in series.values():
+            n += sum(len(v) for v in vs)
+    return n
+
+def _replay(path, group):
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                rec = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # torn final record from a crash mid write
+                log.warning("skipping unreadable WAL record in {}".format(path))
+                continue
+            _merge(group, rec['u'], {d: (np.asarray(t, dtype=float), np.asarray(v, dtype=float))
+                for d, (t, v) in rec['p'].items()})
+
+def _write_group(path, group, fsync=True, append=False):
+    """ write group as WAL records, one per user and put(), replacing path
+    unless append """
+    tmp = path if append else path + ".tmp"
+    with open(tmp, 'ab' if append else 'wb') as f:
+        for user_id, series in group.items():
+            for data_id, (ts, vs) in series.items():
+                for t, v in zip(ts, vs):
+                    f.write(json.dumps({'u': user_id,
+                        'p': {data_id: [t.tolist(), v.tolist()]}}).encode('utf-8') + b'\n')
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    if not append:
+        os.replace(tmp, path)
+
+def _append_file(src, dst, fsync=True):
+    with open(src, 'rb') as f, open(dst, 'ab') as out:
+        out.write(f.read())
+        out.flush()
+        if fsync:
+            os.fsync(out.fileno())
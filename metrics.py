@@ -0,0 +1,154 @@
+""" latency histograms and counters of the running server, see /metrics
+
+Timings are observed into histograms by name and labels, e.g.
+
+    metrics.observe('store_seconds', took, op='read')
+
+    with metrics.timer('compaction_seconds'):
+        ...
+
+Each histogram keeps the count and sum of its observations and how many
+fell in each of the BUCKETS, in seconds.  Modules also register the
+stats() of their caches, pools and buffers with add_stats(); their
+numeric values are reported as they are when the metrics are read.
+
+render() gives everything in the Prometheus text format, with names
+prefixed 'sstsp_'; snapshot() gives a dict, with quantiles estimated
+from the buckets.
+"""
+import bisect
+import numbers
+import threading
+import time
+import logging as log
+from contextlib import contextmanager
+
+PREFIX = "sstsp_"
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0, 30.0)
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # the last count is of observations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """ estimate, interpolating linearly within the bucket the
+        quantile falls in.  None without observations """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lo = self.buckets[i - 1] if i else 0.0
+                if i == len(self.buckets):
+                    return lo
+                return lo + (self.buckets[i] - lo) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Registry(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # (name, sorted label items) -> Histogram
+        self._histograms = {}
+        self._stats = {}
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._histograms.get(key, None)
+            if h is None:
+                h = self._histograms[key] = Histogram(self.buckets)
+            h.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def add_stats(self, name, stats):
+        """ report the numeric values of stats() as <name>_<key> """
+        self._stats[name] = stats
+
+    def _collect_stats(self):
+        out = {}
+        for name, stats in list(self._stats.items()):
+            try:
+                values = stats() or {}
+            except Exception:
+                log.exception("stats of {} failed".format(name))
+                continue
+            out[name] = {k: int(v) if isinstance(v, numbers.Integral) else float(v)
+                    for k, v in values.items()
+                    if isinstance(v, numbers.Real) and not isinstance(v, bool)}
+        return out
+
+    def snapshot(self):
+        """ {'histograms': {name: [{'labels', 'count', 'sum', 'p50', ...}]},
+        'stats': {name: {key: value}}} """
+        histograms = {}
+        with self._lock:
+            for (name, labels), h in sorted(self._histograms.items()):
+                e = {'labels': dict(labels), 'count': h.count, 'sum': h.sum}
+                for q in QUANTILES:
+                    e['p{:g}'.format(100 * q)] = h.quantile(q)
+                histograms.setdefault(name, []).append(e)
+        return {'histograms': histograms, 'stats': self._collect_stats()}
+
+    def render(self):
+        """ the Prometheus text exposition format """
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), h in sorted(self._histograms.items()):
+                full = PREFIX + name
+                if full not in typed:
+                    lines.append("# TYPE {} histogram".format(full))
+                    typed.add(full)
+                cumulative = 0
+                for bound, n in zip(self.buckets + (float('inf'),), h.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float('inf') else "{:g}".format(bound)
+                    lines.append("{}_bucket{} {}".format(full,
+                        _labels(labels + (('le', le),)), cumulative))
+                lines.append("{}_sum{} {!r}".format(full, _labels(labels), h.sum))
+                lines.append("{}_count{} {}".format(full, _labels(labels), h.count))
+        for name, values in sorted(self._collect_stats().items()):
+            for k, v in sorted(values.items()):
+                full = "{}{}_{}".format(PREFIX, name, k)
+                lines.append("# TYPE {} gauge".format(full))
+                lines.append("{} {!r}".format(full, v))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(items):
+    if not items:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+        .replace('"', '\\"').replace('\n', '\\n')) for k, v in items) + "}"
+
+
+# the process wide registry
+REGISTRY = Registry()
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+add_stats = REGISTRY.add_stats
+snapshot = REGISTRY.snapshot
+render = REGISTRY.render
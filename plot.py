@@ -1,5 +1,6 @@
 from collections import OrderedDict
 import os.path
+import json
 from bokeh.plotting import figure 
 from bokeh.models.sources import ColumnDataSource, AjaxDataSource
 from bokeh.models import BoxSelectTool, HoverTool
@@ -10,6 +11,18 @@ import logging as log
 import requests
 import sstsp
 
+# plot width assumed when the page doesn't say, and how many points to
+# draw per pixel of it
+DEFAULT_WIDTH = 1000
+POINTS_PER_PIXEL = 2
+# points in the overview above the main plot, see create_selection_plot
+OVERVIEW_POINTS = 300
+# ms to wait for zooming/panning to settle before fetching
+REFETCH_DELAY = 250
+# line colors of overlaid series, in turn
+OVERLAY_COLORS = ['#A6CEE3', '#1F78B4', '#B2DF8A', '#33A02C', '#FB9A99', '#E31A1C',
+        '#FDBF6F', '#FF7F00', '#CAB2D6', '#6A3D9A']
+
 
 def style_axis(plot, theme):
     plot.axis.minor_tick_in=None
@@ -89,28 +102,127 @@ def create_main_plot(theme, source):
 #    ])
     return p
 
-def create_selection_plot(main_plot, theme):
+def create_overlay_plot(theme, source, data_ids):
+    """ one line per series, source holding a column per data_id on a
+    shared index, see user.get_data_frame """
+    p = figure(x_axis_type = "datetime", tools="pan,xwheel_zoom,ywheel_zoom,box_zoom,reset,previewsave",
+               height=500, toolbar_location='right', active_scroll='xwheel_zoom',
+               responsive=True)
+    for i, data_id in enumerate(data_ids):
+        color = OVERLAY_COLORS[i % len(OVERLAY_COLORS)]
+        p.line('index', data_id, color=color, source=source, legend=data_id)
+        p.circle('index', data_id, color=color, source=source, size=2)
+    style_main_plot(p, theme)
+    return p
+
+def add_zoom_refetch(p, source, data_url, max_points, method='lttb', tz_offset_ms=0):
+    """ refetch the visible window of the series at up to max_points
+    points whenever the x range of p changes, so zooming in shows more
+    detail than the decimated initial data """
+    code = """
+        if (window.refetch_timer != undefined){
+            clearTimeout(window.refetch_timer);
+        }
+        window.refetch_timer = setTimeout(function(){
+            var start = (x_range.start - %(tz_offset_ms)d) / 1000;
+            var end = (x_range.end - %(tz_offset_ms)d) / 1000;
+            var url = %(data_url)s + "?start=" + start + "&end=" + end +
+                "&max_points=%(max_points)d&method=%(method)s";
+            var xhr = new XMLHttpRequest();
+            xhr.open("GET", url, true);
+            xhr.onload = function(){
+                if (xhr.status != 200){
+                    return;
+                }
+                var d = JSON.parse(xhr.responseText);
+                var index = [];
+                for (var i = 0; i < d.index.length; i++){
+                    index.push(d.index[i] + %(tz_offset_ms)d);
+                }
+                source.data = {'index': index, 'data': d.data};
+                source.trigger('change');
+            };
+            xhr.send();
+        }, %(delay)d);
+    """ % {
+        'data_url': json.dumps(data_url),
+        'max_points': max_points,
+        'method': method,
+        'tz_offset_ms': tz_offset_ms,
+        'delay': REFETCH_DELAY,
+    }
+    p.x_range.callback = CustomJS(args={'source': source, 'x_range': p.x_range}, code=code)
+    return p
 
-    static_source = ColumnDataSource(data)
+def live_stream_script(source, events_url, tz_offset_ms=0):
+    """ javascript appending the points pushed by the events endpoint at
+    events_url to source, once the plot is on the page """
+    return """
+        (function(){
+            function find_source(){
+                var docs = window.Bokeh ? (Bokeh.documents || []) : [];
+                for (var i = 0; i < docs.length; i++){
+                    var m = docs[i].get_model_by_id(%(source_id)s);
+                    if (m) return m;
+                }
+                var views = window.Bokeh ? (Bokeh.index || {}) : {};
+                for (var k in views){
+                    var m = views[k].model.document.get_model_by_id(%(source_id)s);
+                    if (m) return m;
+                }
+                return null;
+            }
+            function connect(){
+                if (!window.EventSource) return;
+                var source = find_source();
+                if (source == null){
+                    setTimeout(connect, 250);
+                    return;
+                }
+                var events = new EventSource(%(events_url)s);
+                events.onmessage = function(e){
+                    var d = JSON.parse(e.data);
+                    var index = [];
+                    for (var i = 0; i < d.index.length; i++){
+                        index.push(d.index[i] + %(tz_offset_ms)d);
+                    }
+                    source.stream({'index': index, 'data': d.data});
+                };
+            }
+            connect();
+        })();
+    """ % {
+        'source_id': json.dumps(source.ref['id']),
+        'events_url': json.dumps(events_url),
+        'tz_offset_ms': tz_offset_ms,
+    }
+
+def create_selection_plot(main_plot, theme, source, details_url, tz_offset_ms=0):
+    """ an overview of the whole series above main_plot, drawn once from
+    a heavily decimated source.  Brushing a region of it zooms main_plot
+    to the region, which fetches it at full resolution (see
+    add_zoom_refetch), and shows how far the region was decimated from
+    details_url.  Clearing the selection zooms back out """
     selection_plot = figure(
         height=100, tools="box_select", x_axis_location="above",
         x_axis_type="datetime", toolbar_location=None,
-        outline_line_color=None, name="small_plot"
+        outline_line_color=None, name="small_plot", responsive=True
     )
-    selection_source = ColumnDataSource()
-    for k in ['end', 'values', 'start', 'bottom']:
-        selection_source.add([], k)
+    selection_source = ColumnDataSource(dict(start=[], end=[], top=[], bottom=[]))
 
     if theme == 'default':
         selection_color = '#c6dbef'
     elif theme == 'dark':
         selection_color = "#FFAD5C"
 
-    selection_plot.quad(top='values', bottom='bottom', left='start', right='end',
+    values = source.data['data']
+    top = float(max(values)) if len(values) else 1.0
+    bottom = float(min(values)) if len(values) else 0.0
+    selection_plot.quad(top='top', bottom='bottom', left='start', right='end',
           source=selection_source, color=selection_color, fill_alpha=0.5)
 
-    selection_plot.line('index', 'data', color='#A6CEE3', source=static_source)
-    selection_plot.circle('index', 'data', color='#A6CEE3', source=static_source, size=1)
+    selection_plot.line('index', 'data', color='#A6CEE3', source=source)
+    selection_plot.circle('index', 'data', color='#A6CEE3', source=source, size=1)
 
     style_selection_plot(selection_plot, theme)
 
@@ -118,89 +230,79 @@ def create_selection_plot(main_plot, theme):
     select_tool.dimensions = ['width']
 
     code = """
+        var main_range = main_plot.get('x_range');
         if (window.xrange_base_start == undefined){
-            window.xrange_base_start = main_plot.get('x_range').get('start');
-        }
-        if (window.xrange_base_end == undefined){
-            window.xrange_base_end = main_plot.get('x_range').get('end');
+            window.xrange_base_start = main_range.get('start');
+            window.xrange_base_end = main_range.get('end');
         }
 
-        data = source.get('data');
-        sel = source.get('selected')['1d']['indices'];
-        var mi = 1000000000;
-        var ma = -100000;
+        var index = source.get('data')['index'];
+        var sel = source.get('selected')['1d']['indices'];
+        var selected = selection_source.get('data');
+        var panel = document.getElementById("details_panel");
         if (sel.length == 0){
-           var url = "http://127.0.0.1:5000/alldata";
-           source_data = selection_source.get('data');
-           source_data.bottom = []
-           source_data.values = [];
-           source_data.start = [];
-           source_data.end = [];
-
-            // reset main plot ranges
-            main_range.set('start', window.xrange_base_start);
-            main_range.set('end', window.xrange_base_end);
-        }else{
-           for (i=0; i<sel.length; i++){
-            if (mi>sel[i]){
-                mi = sel[i];
+            selected.start = [];
+            selected.end = [];
+            selected.top = [];
+            selected.bottom = [];
+            selection_source.trigger('change');
+            main_range.set({'start': window.xrange_base_start, 'end': window.xrange_base_end});
+            if (panel){
+                panel.className = "hidden";
+                panel.innerHTML = "";
             }
-            if (ma<sel[i]){
-                ma = sel[i];
-            }
-           }
-           var url = "http://127.0.0.1:5000/subsample/"+data.Date[mi]+"/"+data.Date[ma];
-           source_data = selection_source.get('data');
-           source_data.bottom = [0]
-           source_data.values = [700];
-           source_data.start = [data.Date[mi]];
-           source_data.end = [data.Date[ma]];
-
-           main_range = main_plot.get('x_range');
-           main_range.set('start', data.Date[mi]);
-           main_range.set('end', data.Date[ma]);
+            return;
         }
 
-        xmlhttp = new XMLHttpRequest();
-        xmlhttp.open("GET", url, true);
-        xmlhttp.send();
-
+        var mi = sel[0], ma = sel[0];
+        for (var i = 1; i < sel.length; i++){
+            mi = Math.min(mi, sel[i]);
+            ma = Math.max(ma, sel[i]);
+        }
+        var start = index[mi], end = index[ma];
+        selected.start = [start];
+        selected.end = [end];
+        selected.top = [%(top)r];
+        selected.bottom = [%(bottom)r];
         selection_source.trigger('change');
+        // the zoom refetch of main_plot fetches the region
+        main_range.set({'start': start, 'end': end});
 
-        if (sel.length==0){
-            $("#details_panel").addClass("hidden");
-            $("#details_panel").html("");
-        }else{
-
-            var url = "http://127.0.0.1:5000/details";
-            xhr = $.ajax({
-                type: 'GET',
-                url: url,
-                contentType: "application/json",
-                // data: jsondata,
-                header: {
-                  client: "javascript"
-                }
-            });
-
-            xhr.done(function(details) {
-                $("#details_panel").removeClass("hidden");
-                $("#details_panel").html("<h3>Selected Region Report</h3>");
-                $("#details_panel").append("<div>From " + details.start + " to " + details.end + "</div>");
-                $("#details_panel").append("<div>Number of original samples " + details.original_samples_no + "</div>");
-                $("#details_panel").append("<div>Number of samples " + details.samples_no + "</div>");
-                $("#details_panel").append("<div>Factor " + details.factor + "</div>");
-            });
+        if (!panel){
+            return;
         }
-
-    """
+        var url = %(details_url)s + (%(details_url)s.indexOf("?") < 0 ? "?" : "&") +
+            "start=" + (start - %(tz_offset_ms)d) / 1000 +
+            "&end=" + (end - %(tz_offset_ms)d) / 1000;
+        var xhr = new XMLHttpRequest();
+        xhr.open("GET", url, true);
+        xhr.onload = function(){
+            if (xhr.status != 200){
+                return;
+            }
+            var details = JSON.parse(xhr.responseText);
+            panel.className = "";
+            panel.innerHTML = "<h3>Selected Region Report</h3>" +
+                "<div>From " + new Date(details.start * 1000).toISOString() +
+                " to " + new Date(details.end * 1000).toISOString() + "</div>" +
+                "<div>Number of original samples " + details.original_samples_no + "</div>" +
+                "<div>Number of samples " + details.samples_no + "</div>" +
+                "<div>Factor " + details.factor.toFixed(1) + "</div>";
+        };
+        xhr.send();
+    """ % {
+        'top': top,
+        'bottom': bottom,
+        'details_url': json.dumps(details_url),
+        'tz_offset_ms': tz_offset_ms,
+    }
 
     callback = CustomJS(
-           args={'source': static_source,
+           args={'source': source,
                  'selection_source': selection_source,
                  'main_plot': main_plot},
            code=code)
-    static_source.callback = callback
+    source.callback = callback
 
     return selection_plot
 
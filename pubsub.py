@@ -0,0 +1,99 @@
+""" in-process fan-out of new points to live subscribers
+
+Each (user_id, data_id) with subscribers has a channel holding the last
+few published messages, numbered in order.  publish appends a message
+once and wakes every waiting subscriber, which then takes all messages
+newer than the last one it saw; no per subscriber queue is written.  A
+subscriber that falls more than the backlog behind skips the oldest.
+"""
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+class _Channel(object):
+    def __init__(self, backlog):
+        self.messages = deque(maxlen=backlog)
+        self.seq = 0
+        self.refs = 0
+        self.listeners = []
+        self.cond = threading.Condition()
+
+
+class Subscription(object):
+    """ a subscriber's position in a channel """
+    def __init__(self, channel):
+        self._channel = channel
+        self._seen = channel.seq
+
+    def get(self, timeout=None):
+        """ messages published since the last get, waiting up to timeout
+        seconds for one.  Empty on timeout """
+        ch = self._channel
+        with ch.cond:
+            if ch.seq == self._seen:
+                ch.cond.wait(timeout)
+            new = [m for seq, m in ch.messages if seq > self._seen]
+            self._seen = ch.seq
+        return new
+
+
+class Hub(object):
+    def __init__(self, backlog=100):
+        self.backlog = backlog
+        self._channels = {}
+        self._lock = threading.Lock()
+        self.counters = dict(published=0, delivered=0)
+
+    def subscribed(self, key):
+        """ True if key has subscribers, so callers only build messages
+        that will be read """
+        return key in self._channels
+
+    def publish(self, key, message):
+        """ deliver message to the current subscribers of key """
+        with self._lock:
+            ch = self._channels.get(key)
+            if ch is None:
+                return 0
+            subscribers = ch.refs
+            listeners = list(ch.listeners)
+        with ch.cond:
+            ch.seq += 1
+            ch.messages.append((ch.seq, message))
+            ch.cond.notify_all()
+        for fn in listeners:
+            fn()
+        self.counters['published'] += 1
+        self.counters['delivered'] += subscribers
+        return subscribers
+
+    @contextmanager
+    def subscribe(self, key, on_publish=None):
+        """ context manager yielding a Subscription to messages published
+        to key from now on.  on_publish() is called by the publishing
+        thread after each message, for subscribers that don't wait in
+        Subscription.get, see aserver.py """
+        with self._lock:
+            ch = self._channels.get(key)
+            if ch is None:
+                ch = self._channels[key] = _Channel(self.backlog)
+            ch.refs += 1
+            if on_publish is not None:
+                ch.listeners.append(on_publish)
+        try:
+            yield Subscription(ch)
+        finally:
+            with self._lock:
+                ch.refs -= 1
+                if on_publish is not None:
+                    ch.listeners.remove(on_publish)
+                if ch.refs == 0:
+                    del self._channels[key]
+
+    def stats(self):
+        with self._lock:
+            subscribers = sum(ch.refs for ch in self._channels.values())
+            out = dict(self.counters, channels=len(self._channels),
+                    subscribers=subscribers)
+        return out
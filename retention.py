@@ -0,0 +1,136 @@
+""" retention rules and the background compaction job
+
+config.RETENTION limits how long each level of a series is kept: 'raw'
+for the points themselves, or a rollup tier of config.ROLLUP_TIERS.
+Levels without a limit are kept forever.  Rules are separated by ';',
+each an optional data_id pattern (fnmatch style) and ':' followed by
+comma separated <level>=<interval>, e.g.
+
+    raw=30d,1m=365d
+    test*:raw=1d,1m=1d,1h=1d,1d=1d; raw=30d,1m=365d
+
+The first rule whose pattern matches a data_id applies, a rule without
+a pattern matches every series.  Old points thus live on as rollups
+only: raw points are removed only from series that have rollups, and the
+latest point of a series is always kept.
+
+Removal happens when a store is compacted, see the engines' compact().
+The Compactor runs it for every user every config.COMPACT_INTERVAL
+seconds.  Compaction copies the store in short read sessions and only
+takes the store for the final swap, so ingest and reads go on meanwhile.
+"""
+import fnmatch
+import threading
+import time
+import logging as log
+
+from util import parse_interval
+
+RAW = 'raw'
+
+
+def parse_rules(text, tiers=()):
+    """ [(pattern, {level: seconds})] from a rules string as above.
+    Raises ValueError on an unknown level or a bad interval """
+    rules = []
+    for part in text.split(';'):
+        part = part.strip()
+        if not part:
+            continue
+        pattern, _, limits = part.rpartition(':')
+        policy = {}
+        for item in limits.split(','):
+            level, _, age = item.strip().partition('=')
+            level = level.strip()
+            if level != RAW and level not in tiers:
+                raise ValueError("unknown retention level {} - expecting {} or one of {}".format(
+                    level, RAW, ", ".join(tiers)))
+            policy[level] = parse_interval(age)
+        rules.append((pattern.strip() or '*', policy))
+    return rules
+
+def policy(rules, data_id):
+    """ {level: seconds} kept of a series, empty if nothing is removed """
+    for pattern, limits in rules:
+        if fnmatch.fnmatchcase(data_id, pattern):
+            return limits
+    return {}
+
+def cutoffs(limits, now):
+    """ {level: epoch seconds} before which a level's points expire """
+    return {level: now - seconds for level, seconds in limits.items()}
+
+
+class Compactor(object):
+    def __init__(self, compact, users, interval):
+        """ compact(user_id) compacts a user's store and returns its
+        report, see user.compact_user; users() lists the user_ids """
+        self.compact = compact
+        self.users = users
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._run_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+        self.counters = {
+            'runs': 0,
+            'users': 0,
+            'errors': 0,
+            'points_removed': 0,
+            'bytes_reclaimed': 0,
+            'last_run_ms': 0.0,
+        }
+
+    def start(self):
+        with self._lock:
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(target=self._run, name="compactor")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def run(self):
+        """ compact every store once.  Returns {user_id: report} """
+        with self._run_lock:
+            start = time.time()
+            reports = {}
+            for user_id in self.users():
+                if self._stopped:
+                    break
+                try:
+                    reports[user_id] = r = self.compact(user_id)
+                except Exception:
+                    self.counters['errors'] += 1
+                    log.exception("compaction of {} failed".format(user_id))
+                    continue
+                self.counters['users'] += 1
+                self.counters['points_removed'] += sum(s['removed'] for s in r['series'].values())
+                self.counters['bytes_reclaimed'] += r['bytes_before'] - r['bytes_after']
+            self.counters['runs'] += 1
+            self.counters['last_run_ms'] = 1000 * (time.time() - start)
+            log.info("compacted {} stores in {:.0f} ms, {} bytes reclaimed".format(
+                len(reports), self.counters['last_run_ms'],
+                sum(r['bytes_before'] - r['bytes_after'] for r in reports.values())))
+            return reports
+
+    def close(self):
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        return dict(self.counters)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._stopped:
+                    self._wakeup.wait(self.interval)
+                if self._stopped:
+                    return
+            try:
+                self.run()
+            except Exception:
+                log.exception("compactor error")
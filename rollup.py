@@ -0,0 +1,141 @@
+""" multi-resolution rollups of series
+
+Each tier holds one row per bucket of its width, with the count, sum,
+min, max, first and last of the raw points falling in the bucket.  Tiers
+are kept in the user store next to the raw series under
+'_rollup_<tier>/<data_id>' and updated as points are committed, so long
+ranges can be read and plotted without touching the raw points.
+
+first and last assume points arrive in time order.
+"""
+import logging as log
+
+import numpy as np
+import pandas as pd
+
+from util import epoch_ns, parse_interval
+
+PREFIX = "_rollup_"
+FIELDS = ('count', 'sum', 'min', 'max', 'first', 'last')
+FUNCTIONS = ('count', 'sum', 'mean', 'min', 'max', 'first', 'last')
+
+_COMBINE = {
+    'count': 'sum',
+    'sum': 'sum',
+    'min': 'min',
+    'max': 'max',
+    'first': 'first',
+    'last': 'last',
+}
+
+
+def tier_key(tier, data_id):
+    return "{}{}/{}".format(PREFIX, tier, data_id)
+
+def is_rollup_key(key):
+    return key.lstrip('/').startswith(PREFIX)
+
+def tier_seconds(tier):
+    return parse_interval(tier)
+
+def bucket_index(index, seconds):
+    """ start of the bucket of each timestamp, as int64 ns """
+    step = int(seconds) * 1000000000
+    return (epoch_ns(index) // step) * step
+
+def partials(d, seconds):
+    """ per bucket count, sum, min, max, first and last of series d """
+    if len(d) == 0:
+        return pd.DataFrame(columns=list(FIELDS), dtype=float,
+                index=pd.DatetimeIndex([], dtype='datetime64[ns]'))
+    g = pd.Series(d.values.astype(float)).groupby(bucket_index(d.index, seconds), sort=True)
+    p = pd.DataFrame({
+        'count': g.count().astype(float),
+        'sum': g.sum(),
+        'min': g.min(),
+        'max': g.max(),
+        'first': g.first(),
+        'last': g.last(),
+    }, columns=list(FIELDS))
+    p.index = pd.to_datetime(p.index.values.astype(np.int64)).astype('datetime64[ns]')
+    return p
+
+def combine(*parts):
+    """ merge partials of the same buckets, given oldest first """
+    parts = [p for p in parts if p is not None and len(p)]
+    if not parts:
+        return None
+    if len(parts) == 1:
+        return parts[0]
+    c = pd.concat(parts).groupby(level=0, sort=True).agg(_COMBINE)
+    return c[list(FIELDS)]
+
+def rebucket(p, seconds):
+    """ partials of coarser buckets from partials of finer ones.  seconds
+    must be a multiple of the finer bucket width """
+    if p is None or len(p) == 0:
+        return p
+    c = p.groupby(bucket_index(p.index, seconds), sort=True).agg(_COMBINE)[list(FIELDS)]
+    c.index = pd.to_datetime(c.index.values.astype(np.int64)).astype('datetime64[ns]')
+    return c
+
+def finish(p, fns=('mean',)):
+    """ the requested aggregates from partials """
+    out = pd.DataFrame(index=p.index)
+    for fn in fns:
+        if fn == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out['mean'] = p['sum'] / p['count']
+        else:
+            out[fn] = p[fn]
+    return out
+
+def _time_clause(op, ts):
+    return "index {} {!r}".format(op, pd.Timestamp(ts).isoformat())
+
+def update(store, data_id, s, tiers):
+    """ fold newly committed points s of data_id into each tier """
+    for tier in tiers:
+        key = tier_key(tier, data_id)
+        new = partials(s, tier_seconds(tier))
+        if len(new) == 0:
+            continue
+        if key in store:
+            where = _time_clause('>=', new.index[0])
+            old = store.select(key, where=where)
+            if len(old):
+                store.remove(key, where=where)
+                new = combine(old, new)
+        store.append(key, new, format='table', index=True)
+
+def rebuild(store, data_id, tiers, chunksize=100000):
+    """ recompute the tiers of data_id from its raw points """
+    for tier in tiers:
+        key = tier_key(tier, data_id)
+        if key in store:
+            store.remove(key)
+    nrows = store.get_storer(data_id).nrows
+    for start in range(0, nrows, chunksize):
+        update(store, data_id, store.select(data_id, start=start, stop=start + chunksize), tiers)
+    log.info("rebuilt rollups of {} from {} points".format(data_id, nrows))
+
+def read(store, data_id, tier, start=None, end=None):
+    """ stored partials of a tier for buckets starting in [start, end) """
+    key = tier_key(tier, data_id)
+    if key not in store:
+        return None
+    where = []
+    if start is not None:
+        where.append(_time_clause('>=', start))
+    if end is not None:
+        where.append(_time_clause('<', end))
+    return store.select(key, where=where or None)
+
+def choose_tier(span_seconds, max_points, tiers):
+    """ the finest tier needing at most max_points buckets to cover the
+    span, else the coarsest tier """
+    ordered = sorted(tiers, key=tier_seconds)
+    for tier in ordered:
+        if span_seconds / float(tier_seconds(tier)) <= max_points:
+            return tier
+    return ordered[-1] if ordered else None
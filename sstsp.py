@@ -1,4 +1,29 @@
+""" client for sstsp servers
+
+Points are sent through a Client, which buffers them and posts them in
+batches from a background thread, so sampling loops never wait on the
+network:
+
+    with sstsp.Client(url, user_id, key) as c:
+        while True:
+            c.send("temperature", read_sensor())
+            time.sleep(1)
+
+AsyncClient does the same on an asyncio event loop (needs aiohttp).
+Both keep their connections open between batches and retry failed
+batches with exponential backoff.  Given a spool file, points not yet
+acknowledged survive a restart of the client.
+"""
+import os
+import json
+import time
+import random
+import threading
+import atexit
+import logging as log
+
 import requests
+from requests.adapters import HTTPAdapter
 
 USER_ID_LEN = 16
 DEFAULT_FREQ = '1s'
@@ -7,10 +32,575 @@ URL_BASE = "http://localhost:5000"
 KEY="b5f3039a4fe94f1cb7344c10e0fffc22"
 USER_ID="73cee64511fbc598"
 
+# statuses worth trying the same batch again for
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+_default = None
+_default_lock = threading.Lock()
+
 def send_data(datum, timestamp, value):
-    params = {'v':str(value), 'key':KEY, 't':str(timestamp)}
-    url = URL_BASE + "/d/" + USER_ID + "/" + str(datum) + "/latest"
-    r = requests.put(url, data=params)
+    """ queue a point with the default client, see Client.send """
+    default_client().send(datum, value, timestamp)
+
+def default_client():
+    """ the Client for URL_BASE, USER_ID and KEY, flushed at exit """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Client(URL_BASE, USER_ID, KEY)
+            atexit.register(_default.close)
+    return _default
+
+
+class SendError(Exception):
+    """ a batch failed; retryable unless the server rejected it """
+    def __init__(self, msg, retryable=True, retry_after=None):
+        Exception.__init__(self, msg)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class _Buffer(object):
+    """ points waiting to be sent, {data_id: ([t], [v])}, and optionally
+    their spool file of one json line per point.  The spool is cut down
+    to the unacknowledged points once at least as many were acknowledged
+    since, so after a crash some acknowledged points may be sent again """
+    def __init__(self, max_points, spool=None):
+        self.max_points = max_points
+        self.spool = spool
+        self.lock = threading.Lock()
+        self.points = {}
+        self.count = 0
+        self.dropped = 0
+        self._acked = 0
+        self._spool_file = None
+        if spool is not None:
+            self._replay()
+            self._spool_file = open(spool, 'a')
+
+    def _replay(self):
+        if not os.path.exists(self.spool):
+            return
+        n = 0
+        with open(self.spool) as f:
+            for line in f:
+                try:
+                    data_id, t, v = json.loads(line)
+                except ValueError:
+                    # torn last line
+                    continue
+                self._add(data_id, t, v)
+                n += 1
+        log.info("replayed {} spooled points from {}".format(n, self.spool))
+
+    def _add(self, data_id, t, v):
+        ts, vs = self.points.setdefault(data_id, ([], []))
+        ts.append(t)
+        vs.append(v)
+        self.count += 1
+
+    def add(self, data_id, t, v):
+        """ the number of points buffered, 0 if the buffer is full and the
+        point was dropped """
+        with self.lock:
+            if self.count >= self.max_points:
+                self.dropped += 1
+                return 0
+            self._add(data_id, t, v)
+            if self._spool_file is not None:
+                self._spool_file.write(json.dumps([data_id, t, v]) + "\n")
+            return self.count
+
+    def take(self, n):
+        """ up to n of the oldest points, as {data_id: ([t], [v])} """
+        with self.lock:
+            batch = {}
+            taken = 0
+            for data_id in list(self.points):
+                if taken >= n:
+                    break
+                ts, vs = self.points[data_id]
+                k = n - taken
+                batch[data_id] = (ts[:k], vs[:k])
+                if k >= len(ts):
+                    del self.points[data_id]
+                else:
+                    self.points[data_id] = (ts[k:], vs[k:])
+                taken += min(k, len(ts))
+            self.count -= taken
+            return batch
+
+    def put_back(self, batch):
+        """ return an unsent batch ahead of the points added since """
+        with self.lock:
+            for data_id, (ts, vs) in batch.items():
+                old_ts, old_vs = self.points.pop(data_id, ([], []))
+                self.points[data_id] = (ts + old_ts, vs + old_vs)
+                self.count += len(ts)
+
+    def acked(self, batch):
+        with self.lock:
+            if self._spool_file is None:
+                return
+            self._acked += sum(len(ts) for ts, vs in batch.values())
+            if self._acked < self.count:
+                return
+            tmp = self.spool + ".tmp"
+            with open(tmp, 'w') as f:
+                for data_id, (ts, vs) in self.points.items():
+                    for t, v in zip(ts, vs):
+                        f.write(json.dumps([data_id, t, v]) + "\n")
+            self._spool_file.close()
+            os.replace(tmp, self.spool)
+            self._spool_file = open(self.spool, 'a')
+            self._acked = 0
+
+    def sync(self):
+        with self.lock:
+            if self._spool_file is not None:
+                self._spool_file.flush()
+
+    def close(self):
+        with self.lock:
+            if self._spool_file is not None:
+                self._spool_file.close()
+                self._spool_file = None
+
+
+class _Sender(object):
+    """ what Client and AsyncClient share: the buffer, batch bodies and
+    the reading of responses """
+    def __init__(self, url, user_id, key, max_batch, flush_interval, max_buffer,
+            spool, retries, backoff, max_backoff, timeout):
+        self.url = url.rstrip('/') + "/d/" + user_id
+        self.key = key
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.buffer = _Buffer(max_buffer, spool)
+        self.counters = {'points': 0, 'batches': 0, 'retries': 0, 'rejected': 0, 'failed': 0}
+        # flushes asked for and send rounds done, see flush
+        self._requested = 0
+        self._completed = 0
+
+    def _point(self, data_id, value, t):
+        return str(data_id), time.time() if t is None else float(t), float(value)
+
+    def _body(self, batch):
+        return json.dumps({'key': self.key, 'data':
+            {data_id: {'t': ts, 'v': vs} for data_id, (ts, vs) in batch.items()}})
+
+    def _check(self, status, body, retry_after=None):
+        """ the number of points accepted of a batch, SendError if it
+        failed as a whole """
+        if status in RETRY_STATUSES:
+            raise SendError("server answered {}".format(status), True, _seconds(retry_after))
+        if status != 200:
+            raise SendError("server rejected batch ({}) - {}".format(status, body[:200]), False)
+        try:
+            doc = json.loads(body)
+        except ValueError:
+            raise SendError("unreadable response - {}".format(body[:200]))
+        if doc.get('rejected'):
+            self.counters['rejected'] += doc['rejected']
+            log.warning("server rejected {} points".format(doc['rejected']))
+        return doc.get('accepted', 0)
+
+    def _delay(self, attempt, e):
+        """ seconds to wait before retry number attempt, with jitter so
+        clients cut off together don't come back together """
+        if e.retry_after is not None:
+            return e.retry_after
+        d = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return d * random.uniform(0.5, 1.0)
+
+    def _done(self, batch, accepted=None, e=None):
+        """ account for a batch; False if it failed and was kept to be
+        retried by the next send round """
+        if e is None:
+            self.counters['points'] += accepted
+            self.counters['batches'] += 1
+            self.buffer.acked(batch)
+            return True
+        log.error("batch for {} series not sent - {}".format(len(batch), e))
+        if e.retryable:
+            self.counters['failed'] += 1
+            self.buffer.put_back(batch)
+            return False
+        self.counters['rejected'] += sum(len(ts) for ts, vs in batch.values())
+        self.buffer.acked(batch)
+        return True
+
+    def _due(self):
+        """ whether a send round should start without waiting """
+        return self.buffer.count >= self.max_batch or self._completed < self._requested
+
+    def stats(self):
+        return dict(self.counters, buffered=self.buffer.count, dropped=self.buffer.dropped)
+
+
+class Client(_Sender):
+    """ buffers points and posts them as batches to /d/<user_id> from a
+    background thread, when max_batch points are buffered or every
+    flush_interval seconds.
+
+    Connections are pooled in a requests session.  A batch that fails with
+    a connection error or a retryable status is retried up to `retries`
+    times with exponential backoff starting at `backoff` seconds (or the
+    server's Retry-After), then kept for the next round.  At most
+    max_buffer points are held, send drops points beyond that.  With a
+    spool path, unacknowledged points are also kept on disk and resent by
+    the next Client with the same spool.
+    """
+    def __init__(self, url=URL_BASE, user_id=USER_ID, key=KEY, max_batch=1000,
+            flush_interval=1.0, max_buffer=100000, spool=None, retries=5,
+            backoff=0.5, max_backoff=30.0, timeout=10.0, pool_size=4):
+        _Sender.__init__(self, url, user_id, key, max_batch, flush_interval, max_buffer,
+                spool, retries, backoff, max_backoff, timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name="sstsp-client")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, data_id, value, t=None):
+        """ queue a point, t in epoch seconds defaulting to now.  Never
+        waits for the network; False if the buffer was full """
+        n = self.buffer.add(*self._point(data_id, value, t))
+        if n >= self.max_batch:
+            with self._cond:
+                self._cond.notify_all()
+        return n > 0
+
+    def flush(self, timeout=None):
+        """ send everything queued so far now and wait for it.  False if
+        points are left, after failed retries or on timeout """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._requested += 1
+            target = self._requested
+            self._cond.notify_all()
+            while self._completed < target:
+                left = None if deadline is None else deadline - time.time()
+                if left is not None and left <= 0:
+                    return False
+                self._cond.wait(left)
+        return self.buffer.count == 0
+
+    def close(self, timeout=30.0):
+        """ send what is buffered and stop; unsent points stay in the
+        spool if there is one """
+        if self._closing:
+            return
+        self.flush(timeout)
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        self.buffer.close()
+        self.session.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._due() and not self._closing:
+                    self._cond.wait(self.flush_interval)
+                if self._closing:
+                    return
+                round_ = self._requested
+            self.buffer.sync()
+            while self.buffer.count and self._send(self.buffer.take(self.max_batch)):
+                pass
+            with self._cond:
+                self._completed = round_
+                self._cond.notify_all()
+
+    def _send(self, batch):
+        body = self._body(batch)
+        for attempt in range(self.retries + 1):
+            try:
+                try:
+                    r = self.session.post(self.url, data=body, timeout=self.timeout,
+                            headers={'Content-Type': 'application/json'})
+                except requests.RequestException as e:
+                    raise SendError(str(e))
+                return self._done(batch, self._check(r.status_code, r.text,
+                    r.headers.get('Retry-After')))
+            except SendError as e:
+                if not e.retryable or attempt == self.retries or self._closing:
+                    return self._done(batch, e=e)
+                self.counters['retries'] += 1
+                time.sleep(self._delay(attempt, e))
+
+
+class AsyncClient(_Sender):
+    """ Client for asyncio programs, sending from a task on the running
+    loop through a pooled aiohttp session:
+
+        async with sstsp.AsyncClient(url, user_id, key) as c:
+            c.send("temperature", value)
+
+    send doesn't block; flush and close are coroutines.  Points sent
+    before start() are queued and go out once it is called.
+    """
+    def __init__(self, url=URL_BASE, user_id=USER_ID, key=KEY, max_batch=1000,
+            flush_interval=1.0, max_buffer=100000, spool=None, retries=5,
+            backoff=0.5, max_backoff=30.0, timeout=10.0, pool_size=4):
+        _Sender.__init__(self, url, user_id, key, max_batch, flush_interval, max_buffer,
+                spool, retries, backoff, max_backoff, timeout)
+        self.pool_size = pool_size
+        self.session = None
+        self._task = None
+        self._cond = None
+
+    async def start(self):
+        """ open the session and start sending, on the running loop """
+        import asyncio
+        import aiohttp
+        self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self._cond = asyncio.Condition()
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def send(self, data_id, value, t=None):
+        """ queue a point, see Client.send """
+        import asyncio
+        n = self.buffer.add(*self._point(data_id, value, t))
+        if n >= self.max_batch and self._cond is not None:
+            asyncio.ensure_future(self._notify())
+        return n > 0
+
+    async def _notify(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    async def flush(self):
+        """ send everything queued so far now and wait for it, see
+        Client.flush """
+        if self._cond is None:
+            raise RuntimeError("AsyncClient isn't sending - call start() first, "
+                    "or use it with async with")
+        async with self._cond:
+            self._requested += 1
+            target = self._requested
+            self._cond.notify_all()
+            await self._cond.wait_for(lambda: self._completed >= target)
+        return self.buffer.count == 0
+
+    async def close(self):
+        import asyncio
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self.buffer.close()
+        await self.session.close()
+
+    async def _run(self):
+        import asyncio
+        while True:
+            async with self._cond:
+                if not self._due():
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), self.flush_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                round_ = self._requested
+            self.buffer.sync()
+            while self.buffer.count and await self._send(self.buffer.take(self.max_batch)):
+                pass
+            async with self._cond:
+                self._completed = round_
+                self._cond.notify_all()
+
+    async def _send(self, batch):
+        import asyncio
+        import aiohttp
+        body = self._body(batch)
+        for attempt in range(self.retries + 1):
+            try:
+                try:
+                    async with self.session.post(self.url, data=body,
+                            headers={'Content-Type': 'application/json'}) as r:
+                        text = await r.text()
+                        status, retry_after = r.status, r.headers.get('Retry-After')
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    raise SendError(str(e) or type(e).__name__)
+                return self._done(batch, self._check(status, text, retry_after))
+            except SendError as e:
+                if not e.retryable or attempt == self.retries:
+                    return self._done(batch, e=e)
+                self.counters['retries'] += 1
+                await asyncio.sleep(self._delay(attempt, e))
+
+
+def _seconds(retry_after):
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+# content types of the data endpoints' formats, also served by formats.py
+MIMETYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'raw': 'application/x-sstsp-raw',
+    'msgpack': 'application/x-msgpack',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'block': 'application/x-sstsp-block',
+}
+
+def _series(t_ns, v, name=None):
+    # numpy/pandas are only needed for reading data back, not to send it
+    import pandas as pd
+    s = pd.Series(v, index=pd.to_datetime(t_ns, unit='ns'))
+    s.name = name
+    return s
+
+def _decode_raw(body):
+    import struct
+    import numpy as np
+    ts, vs = [], []
+    pos = 0
+    while pos < len(body):
+        n, = struct.unpack_from('<Q', body, pos)
+        pos += 8
+        ts.append(np.frombuffer(body, dtype='<i8', count=n, offset=pos))
+        pos += 8 * n
+        vs.append(np.frombuffer(body, dtype='<f8', count=n, offset=pos))
+        pos += 8 * n
+    if not ts:
+        return _series(np.zeros(0, dtype='<i8'), np.zeros(0))
+    return _series(np.concatenate(ts), np.concatenate(vs))
+
+def _decode_msgpack(body):
+    import msgpack
+    import numpy as np
+    ts, vs, name = [], [], None
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(body)
+    for m in unpacker:
+        name = m['name']
+        ts.append(np.frombuffer(m['t'], dtype='<i8'))
+        vs.append(np.frombuffer(m['v'], dtype='<f8'))
+    if not ts:
+        return _series(np.zeros(0, dtype='<i8'), np.zeros(0))
+    return _series(np.concatenate(ts), np.concatenate(vs), name)
+
+def _decode_arrow(body):
+    import pyarrow as pa
+    table = pa.ipc.open_stream(body).read_all()
+    t = table.column('t').to_numpy().astype('datetime64[ns]').view('<i8')
+    return _series(t, table.column('v').to_numpy())
+
+def _unplanes(np, b, n, width):
+    out = np.zeros((n, 8), dtype=np.uint8)
+    if width:
+        out[:, :width] = np.frombuffer(b, dtype=np.uint8).reshape(width, n).T
+    return out.view('<u8').reshape(n)
+
+def _decode_block(body):
+    """ the blocks of the server's codec.py, decoded here so the client
+    stays a single module """
+    import struct
+    import zlib
+    import numpy as np
+    ts, vs = [], []
+    pos = 0
+    while pos < len(body):
+        magic, version, width, n, t0, d0 = struct.unpack_from('<4sBBxxQqq', body, pos)
+        if magic != b'SSTB' or version != 1:
+            raise ValueError("not a version 1 block at offset {}".format(pos))
+        tlen, vlen = struct.unpack_from('<II', body, pos + 32)
+        pos += 40
+        tb = zlib.decompress(body[pos:pos + tlen])
+        vb = zlib.decompress(body[pos + tlen:pos + tlen + vlen])
+        pos += tlen + vlen
+
+        u = _unplanes(np, tb, max(n - 2, 0), width)
+        dod = ((u >> np.uint64(1)) ^ (np.uint64(0) - (u & np.uint64(1)))).view('<i8')
+        d = np.full(max(n - 1, 0), d0, dtype='<i8')
+        if n > 2:
+            d[1:] += np.cumsum(dod)
+        t = np.full(n, t0, dtype='<i8')
+        if n > 1:
+            t[1:] += np.cumsum(d)
+        ts.append(t)
+        vs.append(np.bitwise_xor.accumulate(_unplanes(np, vb, n, 8)).view('<f8'))
+    if not ts:
+        return _series(np.zeros(0, dtype='<i8'), np.zeros(0))
+    return _series(np.concatenate(ts), np.concatenate(vs))
+
+def _decode_text(fmt, body):
+    import pandas as pd
+    from io import StringIO
+    if fmt == 'json':
+        d = pd.read_json(StringIO(body), orient='split', typ='series', convert_dates=False)
+        return _series(pd.to_datetime(d.index, unit='ms'), d.values.astype(float), d.name)
+    if fmt == 'ndjson':
+        d = pd.read_json(StringIO(body), lines=True, convert_dates=False) if body else \
+            pd.DataFrame({'t': [], 'v': []})
+    else:
+        d = pd.read_csv(StringIO(body))
+    return _series(pd.to_datetime(d['t'].values, unit='ms'), d['v'].values.astype(float))
+
+def decode(content_type, body):
+    """ a pandas Series from the body of a data endpoint response """
+    content_type = (content_type or MIMETYPES['json']).split(';')[0].strip()
+    fmt = None
+    for k, m in MIMETYPES.items():
+        if m == content_type:
+            fmt = k
+    if fmt == 'raw':
+        return _decode_raw(body)
+    if fmt == 'msgpack':
+        return _decode_msgpack(body)
+    if fmt == 'arrow':
+        return _decode_arrow(body)
+    if fmt == 'block':
+        return _decode_block(body)
+    if fmt is None:
+        raise ValueError("unknown content type {}".format(content_type))
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    return _decode_text(fmt, body)
 
-    if r.status_code != requests.codes.ok:
-        pass #FIXME
+def get_data(datum, fmt='raw', start=None, end=None, latest=False):
+    """ fetch a series, or the part of it with start <= t < end (epoch
+    seconds), in the given wire format """
+    url = URL_BASE + "/d/" + USER_ID + "/" + str(datum)
+    if latest:
+        url += "/latest"
+    params = {'format': fmt}
+    if start is not None: params['start'] = str(start)
+    if end is not None: params['end'] = str(end)
+    r = requests.get(url, params=params)
+    r.raise_for_status()
+    return decode(r.headers.get('Content-Type'), r.content)
@@ -0,0 +1,263 @@
+""" pool of long lived HDFStore handles
+
+Opening an HDF5 file is far more expensive than the reads and appends
+done through it, so handles are kept open per user in a bounded LRU and
+closed after sitting idle.
+
+PyTables refuses to open a file a second time in a different mode, so
+rather than separate read and write handles each user has one handle.
+It is opened read-only and upgraded to append mode by the first write
+session; an append mode handle serves reads as well.  Sessions on the
+same handle are serialized, pandas stores are not thread safe.
+
+When another process writes the stores (see writer.py) a pool is given
+the users' commit generations and reopens read handles opened at an
+older one, HDF5 handles don't notice changes made through other handles.
+"""
+import os
+import mmap
+import struct
+import threading
+import time
+import logging as log
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import pandas as pd
+
+import config
+import metrics
+if config.WRITER_ADDRESS:
+    # readers open the files the writer process holds open for append;
+    # the generations keep them apart, HDF5's own file locks would refuse
+    os.environ.setdefault("HDF5_USE_FILE_LOCKING", "FALSE")
+# PyTables closes every open file from an atexit hook registered when it
+# is first imported.  Import it before any of our hooks are registered so
+# ours, which still need open stores, run first.
+import tables
+
+READ_MODES = ('r',)
+
+
+class Generations(object):
+    """ per user commit counters in small memory mapped files shared by the
+    writer process and the readers.  A counter is odd while a commit to
+    the user's store is in progress, and is bumped back to even once the
+    commit is flushed """
+    def __init__(self, path_for, wait=5.0):
+        self.path_for = path_for
+        self.wait = wait
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def _map(self, user_id, create=False):
+        m = self._maps.get(user_id, None)
+        if m is not None:
+            return m
+        path = self.path_for(user_id)
+        if not create and not os.path.exists(path):
+            return None
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < 8:
+                os.ftruncate(fd, 8)
+            m = mmap.mmap(fd, 8)
+        finally:
+            os.close(fd)
+        with self._lock:
+            return self._maps.setdefault(user_id, m)
+
+    def read(self, user_id):
+        m = self._map(user_id)
+        return 0 if m is None else struct.unpack_from('<Q', m)[0]
+
+    def stable(self, user_id):
+        """ the generation once no commit is in progress.  Gives up
+        waiting after self.wait seconds, e.g. after a writer crash """
+        deadline = time.time() + self.wait
+        g = self.read(user_id)
+        while g % 2 and time.time() < deadline:
+            time.sleep(0.001)
+            g = self.read(user_id)
+        return g
+
+    def begin(self, user_id):
+        m = self._map(user_id, create=True)
+        g = struct.unpack_from('<Q', m)[0]
+        # stays odd if a crashed commit left it odd
+        struct.pack_into('<Q', m, 0, g + 1 if g % 2 == 0 else g + 2)
+
+    def end(self, user_id):
+        m = self._map(user_id, create=True)
+        g = struct.unpack_from('<Q', m)[0]
+        struct.pack_into('<Q', m, 0, g + 1 if g % 2 else g)
+
+
+class _Handle(object):
+    def __init__(self, store, mode, generation=None):
+        self.store = store
+        self.mode = mode
+        self.generation = generation
+        self.lock = threading.RLock()
+        self.last_used = time.time()
+
+
+class StorePool(object):
+    def __init__(self, path_for, max_open=64, idle_timeout=300.0, generation=None,
+            complib=None, complevel=0):
+        """ path_for(user_id) gives the file for a user's store.  If given,
+        generation(user_id) is the user's commit generation, see
+        Generations.stable.  complib and complevel are the compression
+        filter of tables created through the pool """
+        self.path_for = path_for
+        self.complib = complib or None
+        self.complevel = complevel if complib else None
+        self.generation = generation
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self.counters = {'opens': 0, 'hits': 0, 'closes': 0, 'refreshes': 0}
+
+    @contextmanager
+    def session(self, user_id, mode='r'):
+        """ yield the open store for user_id, opening it if needed.  Any
+        mode other than 'r' opens the file for append, creating it """
+        write = mode not in READ_MODES
+        h = self._acquire(user_id, write)
+        try:
+            yield h.store
+            if write:
+                h.store.flush()
+        finally:
+            h.last_used = time.time()
+            h.lock.release()
+        self.reap()
+
+    def _acquire(self, user_id, write):
+        while True:
+            with self._lock:
+                h = self._handles.get(user_id, None)
+                if h is not None:
+                    self._handles.move_to_end(user_id)
+            if h is None:
+                h = self._open(user_id, 'a' if write else 'r')
+                if h is None:
+                    continue
+                return h
+
+            h.lock.acquire()
+            if h.store is None:
+                # closed by eviction while we waited
+                h.lock.release()
+                continue
+            if write and h.mode in READ_MODES:
+                self._close(user_id, h)
+                h.lock.release()
+                continue
+            if h.mode in READ_MODES and self.generation is not None \
+                    and h.generation != self.generation(user_id):
+                # another process committed since the handle was opened
+                self._close(user_id, h)
+                h.lock.release()
+                self.counters['refreshes'] += 1
+                continue
+            self.counters['hits'] += 1
+            return h
+
+    def _open(self, user_id, mode):
+        """ open and register a locked handle, None if another thread
+        registered one first """
+        with self._open_lock:
+            with self._lock:
+                if user_id in self._handles:
+                    return None
+            # taken before opening, a commit while opening makes it stale
+            generation = None
+            if self.generation is not None and mode in READ_MODES:
+                generation = self.generation(user_id)
+            with metrics.timer('store_open_seconds', mode=mode):
+                store = pd.HDFStore(self.path_for(user_id), mode,
+                        complevel=self.complevel, complib=self.complib)
+            h = _Handle(store, mode, generation)
+            h.lock.acquire()
+            with self._lock:
+                self._handles[user_id] = h
+        self.counters['opens'] += 1
+        log.debug("opened store for {} mode={}".format(user_id, mode))
+        self._evict()
+        return h
+
+    def _close(self, user_id, h):
+        """ close a handle whose lock is held by the caller """
+        with self._lock:
+            if self._handles.get(user_id, None) is h:
+                del self._handles[user_id]
+        if h.store is not None:
+            h.store.close()
+            h.store = None
+            self.counters['closes'] += 1
+
+    def replace(self, user_id, new_path, prepare=None):
+        """ replace user_id's file by new_path.  prepare(store) is called
+        first with the store open for append, and no session runs between
+        it and the replace.  Sessions waiting meanwhile open the new file """
+        h = self._acquire(user_id, True)
+        try:
+            if prepare is not None:
+                prepare(h.store)
+            h.store.flush()
+            self._close(user_id, h)
+            os.replace(new_path, self.path_for(user_id))
+        finally:
+            h.last_used = time.time()
+            h.lock.release()
+
+    def close(self, user_id):
+        """ close user_id's handle, e.g. before replacing the file """
+        with self._lock:
+            h = self._handles.get(user_id, None)
+        if h is not None:
+            with h.lock:
+                self._close(user_id, h)
+
+    def _evict(self):
+        """ close least recently used idle handles beyond max_open """
+        with self._lock:
+            excess = len(self._handles) - self.max_open
+            victims = list(self._handles.items())[:max(excess, 0)]
+        for user_id, h in victims:
+            if h.lock.acquire(False):
+                try:
+                    self._close(user_id, h)
+                finally:
+                    h.lock.release()
+
+    def reap(self):
+        """ close handles idle for longer than idle_timeout """
+        cutoff = time.time() - self.idle_timeout
+        idle = []
+        with self._lock:
+            # handles are kept in order of use, oldest first
+            for u, h in self._handles.items():
+                if h.last_used >= cutoff:
+                    break
+                idle.append((u, h))
+        for user_id, h in idle:
+            if h.lock.acquire(False):
+                try:
+                    if h.last_used < cutoff:
+                        self._close(user_id, h)
+                finally:
+                    h.lock.release()
+
+    def close_all(self):
+        with self._lock:
+            handles = list(self._handles.items())
+        for user_id, h in handles:
+            with h.lock:
+                self._close(user_id, h)
+
+    def __len__(self):
+        return len(self._handles)
@@ -0,0 +1,88 @@
+""" size and throughput of the compressed encodings on weather-like data
+
+    python testing/bench_codec.py [n_points ...]
+
+Reports bytes per point and encode/decode speed of codec.py blocks, and
+the size of an HDF5 store of the same points for each compression
+filter, as written with SSTSP_STORE_COMPLIB.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import logging as log
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import codec
+import engine
+from util import epoch_ns
+
+REPEAT = 5
+BATCH = 10000
+COMPLIBS = ('', 'zlib', 'blosc:lz4', 'blosc:zstd')
+
+def make_series(n):
+    """ 15 second samples with a little jitter and readings to a tenth of
+    a degree, like testing/weather.py """
+    t = 1.5e9 + np.arange(n) * 15.0 + np.random.uniform(0, 0.5, n)
+    v = np.round(60 + 10 * np.sin(np.arange(n) / 500.0) + np.random.normal(0, 0.2, n), 1)
+    s = pd.Series(v, index=pd.to_datetime(t, unit='s'))
+    s.name = 'bench'
+    return s
+
+def best_of(fn):
+    best = None
+    for i in range(REPEAT):
+        start = time.time()
+        fn()
+        took = time.time() - start
+        best = took if best is None else min(best, took)
+    return best
+
+def hdf5_bytes(s, complib):
+    """ size of an HDF5 store holding s, appended in batches """
+    cwd = os.getcwd()
+    d = tempfile.mkdtemp()
+    try:
+        os.chdir(d)
+        e = engine.HDF5Engine(complib=complib, complevel=5)
+        for i in range(0, len(s), BATCH):
+            with e.session('bench', 'a') as store:
+                store.append('bench', s.iloc[i:i + BATCH])
+        e.close_all()
+        return os.path.getsize(e.path('bench'))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(d)
+
+def run(n):
+    s = make_series(n)
+    t = epoch_ns(s.index)
+    v = s.values
+    raw = 16 * n
+    print("{} points, {} bytes as raw int64/float64".format(n, raw))
+    print("{:>16} {:>12} {:>10} {:>14} {:>14}".format(
+        "encoding", "bytes", "bytes/pt", "encode Mpt/s", "decode Mpt/s"))
+
+    for level in (1, 6):
+        body = codec.encode(t, v, level)
+        enc = best_of(lambda: codec.encode(t, v, level))
+        dec = best_of(lambda: codec.decode_all(body))
+        print("{:>16} {:>12} {:>10.2f} {:>14.1f} {:>14.1f}".format(
+            "block zlib-{}".format(level), len(body), len(body) / float(n),
+            n / enc / 1e6, n / dec / 1e6))
+
+    for complib in COMPLIBS:
+        size = hdf5_bytes(s, complib)
+        print("{:>16} {:>12} {:>10.2f}".format("hdf5 " + (complib or "none"), size, size / float(n)))
+    print("")
+
+if __name__ == '__main__':
+    log.basicConfig(level=log.WARNING)
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 1000000]
+    for n in sizes:
+        run(n)
@@ -0,0 +1,79 @@
+""" compare ingest rate and range query latency of the storage engines
+
+    python testing/bench_engines.py [n_points ...]
+
+Points are appended in batches, as the ingest buffer commits them, to a
+fresh store per engine in a temporary directory.  Queries select a
+random 1% of the series by time.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import logging as log
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import engine
+
+BATCH = 1000
+QUERIES = 50
+
+def make_series(n):
+    """ 15 second samples with a little jitter, like testing/weather.py """
+    t = 1.5e9 + np.arange(n) * 15.0 + np.random.uniform(0, 0.5, n)
+    v = 60 + 10 * np.sin(np.arange(n) / 500.0) + np.random.normal(0, 0.2, n)
+    s = pd.Series(v, index=pd.to_datetime(t, unit='s'))
+    s.name = 'bench'
+    return s
+
+def run_engine(name, s, ranges):
+    e = engine.open_engine(name)
+    start = time.time()
+    for i in range(0, len(s), BATCH):
+        with e.session('bench', 'a') as store:
+            store.append('bench', s.iloc[i:i + BATCH])
+    ingest = len(s) / (time.time() - start)
+
+    took = []
+    rows = 0
+    for lo, hi in ranges:
+        start = time.time()
+        with e.session('bench') as store:
+            d, coords, nrows = store.select('bench', lo, hi)
+        took.append(time.time() - start)
+        rows += len(coords)
+    e.close_all()
+    took = 1000 * np.array(took)
+    return ingest, np.median(took), np.percentile(took, 99), rows
+
+def run(n):
+    s = make_series(n)
+    t = s.index.values.astype(np.int64) / 1e9
+    width = (t[-1] - t[0]) / 100
+    lo = np.random.uniform(t[0], t[-1] - width, QUERIES)
+    ranges = [(a, a + width) for a in lo]
+
+    print("{} points".format(n))
+    print("{:>8} {:>14} {:>12} {:>12} {:>10}".format(
+        "engine", "ingest pts/s", "query p50 ms", "query p99 ms", "rows"))
+    cwd = os.getcwd()
+    for name in engine.ENGINES:
+        d = tempfile.mkdtemp()
+        try:
+            os.chdir(d)
+            ingest, p50, p99, rows = run_engine(name, s, ranges)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(d)
+        print("{:>8} {:>14.0f} {:>12.2f} {:>12.2f} {:>10}".format(name, ingest, p50, p99, rows))
+    print("")
+
+if __name__ == '__main__':
+    log.basicConfig(level=log.WARNING)
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000]
+    for n in sizes:
+        run(n)
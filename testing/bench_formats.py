@@ -0,0 +1,55 @@
+""" compare encode time, decode time and payload size of the data
+endpoint wire formats
+
+    python testing/bench_formats.py [n_points ...]
+"""
+import os
+import sys
+import time
+import logging as log
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import formats
+import sstsp
+
+REPEAT = 5
+
+def make_series(n):
+    """ 15 second samples with a little jitter, like testing/weather.py """
+    t = 1.5e9 + np.arange(n) * 15.0 + np.random.uniform(0, 0.5, n)
+    v = 60 + 10 * np.sin(np.arange(n) / 500.0) + np.random.normal(0, 0.2, n)
+    s = pd.Series(v, index=pd.to_datetime(t, unit='s'))
+    s.name = 'bench'
+    return s
+
+def best_of(fn):
+    best = None
+    for i in range(REPEAT):
+        start = time.time()
+        fn()
+        took = time.time() - start
+        best = took if best is None else min(best, took)
+    return 1000 * best
+
+def run(n):
+    s = make_series(n)
+    print("{} points".format(n))
+    print("{:>8} {:>12} {:>12} {:>12}".format("format", "encode ms", "decode ms", "bytes"))
+    for fmt in formats.MIMETYPES:
+        if not formats.available(fmt):
+            print("{:>8} unavailable".format(fmt))
+            continue
+        body = formats.encode(fmt, s)
+        enc = best_of(lambda: formats.encode(fmt, s))
+        dec = best_of(lambda: sstsp.decode(formats.MIMETYPES[fmt], body))
+        print("{:>8} {:>12.2f} {:>12.2f} {:>12}".format(fmt, enc, dec, len(body)))
+    print("")
+
+if __name__ == '__main__':
+    log.basicConfig(level=log.INFO)
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 100000, 1000000]
+    for n in sizes:
+        run(n)
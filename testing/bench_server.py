@@ -0,0 +1,272 @@
+""" benchmark of a running server with generated data
+
+    python testing/bench_server.py [--url URL] [--sizes 1e3,1e4,...] [--out results.json]
+    python testing/bench_server.py --compare before.json after.json
+
+Without --url a server is started on a free port in a temporary
+directory, as by load_async.py, and the store sizes are read from there;
+with --url give --data-dir to have them.  Measured are
+
+  put       points/s of single point PUTs, --clients at a time
+  batch     points/s of JSON batch POSTs of --batch points
+  sizes     as one series is grown to each of --sizes points: latency of
+            /latest and of the whole series as json and raw, the first
+            (uncached) request and the quantiles of --repeat more, and
+            the store size in bytes per point
+  plot      the plot page of the largest series, cold and then cached
+
+The results are written as JSON with the commit, engine and versions
+they were taken with, and the server's /metrics snapshot.  --compare
+prints two results files side by side.
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import asyncio
+import argparse
+import platform
+import subprocess
+import logging as log
+from importlib import metadata
+
+import numpy as np
+import aiohttp
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..'))
+import config
+from load_async import new_key, free_port, start_server, wait_up
+
+SIZES = (1000, 10000, 100000, 1000000, 10000000)
+LOAD_BATCH = 100000
+START = 1.5e9
+
+def quantiles(x):
+    """ {'p50', 'p99'} of latencies in ms """
+    if len(x) == 0:
+        return {'p50': None, 'p99': None}
+    p = np.percentile(x, [50, 99]) * 1000
+    return {'p50': float(p[0]), 'p99': float(p[1])}
+
+def store_bytes(data_dir, user_id):
+    """ bytes of a user's store, an HDF5 file or a directory of columns """
+    if data_dir is None:
+        return None
+    total = 0
+    for name in os.listdir(data_dir):
+        if not name.startswith(user_id):
+            continue
+        path = os.path.join(data_dir, name)
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        else:
+            total += os.path.getsize(path)
+    return total
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def versions():
+    out = {'python': platform.python_version()}
+    for name in ('numpy', 'pandas', 'tables', 'flask', 'aiohttp', 'bokeh'):
+        try:
+            out[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            out[name] = None
+    return out
+
+async def timed(session, method, url, **kw):
+    t0 = time.time()
+    async with session.request(method, url, **kw) as r:
+        body = await r.read()
+        if r.status != 200:
+            raise RuntimeError("{} {} gave {}: {}".format(method, url, r.status, body[:200]))
+    return time.time() - t0, body
+
+async def bench_put(session, url, key, user_id, n, clients):
+    """ points/s of n single point PUTs from clients at a time """
+    latency = []
+    async def client(c):
+        for i in range(c, n, clients):
+            took, _ = await timed(session, 'PUT', '{}/d/{}/put{}'.format(url, user_id, c),
+                    data={'key': key, 'v': str(i), 't': str(START + i)})
+            latency.append(took)
+    start = time.time()
+    await asyncio.gather(*[client(c) for c in range(clients)])
+    return dict(points=n, clients=clients, points_per_s=n / (time.time() - start),
+            **quantiles(latency))
+
+async def post_points(session, url, key, user_id, data_id, t, v):
+    body = {'key': key, 'data': {data_id: {'t': t.tolist(), 'v': v.tolist()}}}
+    took, _ = await timed(session, 'POST', '{}/d/{}'.format(url, user_id), json=body)
+    return took
+
+async def bench_batch(session, url, key, user_id, n, batch):
+    """ points/s of n points POSTed batch at a time """
+    latency = []
+    start = time.time()
+    for i in range(0, n, batch):
+        t = START + np.arange(i, min(i + batch, n), dtype='f8')
+        latency.append(await post_points(session, url, key, user_id, 'batch', t, np.sin(t)))
+    return dict(points=n, batch=batch, points_per_s=n / (time.time() - start),
+            **quantiles(latency))
+
+async def wait_committed(session, url, user_id, data_id, n, timeout=60.0):
+    """ wait for the catalog to count n points and for the ingest buffer,
+    which commits them in the background, to be empty """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        _, body = await timed(session, 'GET', '{}/d/{}'.format(url, user_id))
+        if json.loads(body).get(data_id, {}).get('count', 0) >= n:
+            _, body = await timed(session, 'GET', url + '/metrics?format=json')
+            ingest = json.loads(body)['stats'].get('ingest', {})
+            if not ingest.get('queue_depth', 0) and not ingest.get('flushing', 0):
+                return
+        await asyncio.sleep(0.1)
+    raise RuntimeError("{} didn't reach {} points".format(data_id, n))
+
+async def latencies(session, url, repeat):
+    """ the first and the quantiles of repeat more GETs of url """
+    first, body = await timed(session, 'GET', url)
+    rest = [(await timed(session, 'GET', url))[0] for i in range(repeat)]
+    return dict(first_ms=1000 * first, bytes=len(body), **quantiles(rest))
+
+async def bench_sizes(session, url, key, user_id, sizes, repeat, data_dir):
+    out = []
+    n = 0
+    series = '{}/d/{}/grow'.format(url, user_id)
+    for size in sizes:
+        start = time.time()
+        while n < size:
+            t = START + np.arange(n, min(n + LOAD_BATCH, size), dtype='f8') * 15.0
+            await post_points(session, url, key, user_id, 'grow', t, np.sin(t / 900.0))
+            n += len(t)
+        await wait_committed(session, url, user_id, 'grow', size)
+        load = time.time() - start
+        r = dict(size=size, load_s=load)
+        r['latest'] = await latencies(session, series + '/latest', repeat)
+        r['json'] = await latencies(session, series + '?format=json', repeat)
+        r['raw'] = await latencies(session, series + '?format=raw', repeat)
+        r['store_bytes'] = store_bytes(data_dir, user_id)
+        if r['store_bytes'] is not None:
+            r['bytes_per_point'] = r['store_bytes'] / float(size)
+        out.append(r)
+        log.warning("{:>9d} points  latest {:.1f} ms  json {:.1f} ms  raw {:.1f} ms".format(
+            size, r['latest']['p50'], r['json']['p50'], r['raw']['p50']))
+    return out
+
+async def bench_plot(session, url, user_id, repeat):
+    """ the plot page of the grown series, rendered and then cached """
+    page = '{}/p/{}/grow'.format(url, user_id)
+    r = await latencies(session, page, repeat)
+    return dict(cold_ms=r['first_ms'], warm_p50=r['p50'], warm_p99=r['p99'], bytes=r['bytes'])
+
+async def run(args, url, data_dir):
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0),
+            timeout=timeout) as session:
+        await wait_up(session, url)
+        key, user_id = new_key()
+        results = {}
+        results['put'] = await bench_put(session, url, key, user_id, args.puts, args.clients)
+        log.warning("put    {points_per_s:8.0f} points/s  p50 {p50:.1f} ms  p99 {p99:.1f} ms".format(
+            **results['put']))
+        results['batch'] = await bench_batch(session, url, key, user_id, args.batch_points, args.batch)
+        log.warning("batch  {points_per_s:8.0f} points/s  p50 {p50:.1f} ms  p99 {p99:.1f} ms".format(
+            **results['batch']))
+        # a store of its own, so its size is that of the one series
+        key, user_id = new_key()
+        results['sizes'] = await bench_sizes(session, url, key, user_id, args.sizes,
+                args.repeat, data_dir)
+        results['plot'] = await bench_plot(session, url, user_id, args.repeat)
+        log.warning("plot   cold {cold_ms:.1f} ms  warm p50 {warm_p50:.1f} ms".format(
+            **results['plot']))
+        try:
+            _, body = await timed(session, 'GET', url + '/metrics?format=json')
+            results['metrics'] = json.loads(body)
+        except (RuntimeError, ValueError):
+            results['metrics'] = None
+    return results
+
+def _flatten(d, prefix=''):
+    """ {'a.b': number} of the numbers in nested results """
+    out = {}
+    if isinstance(d, list):
+        d = {str(e.get('size', i)): e for i, e in enumerate(d)}
+    for k, v in d.items():
+        name = prefix + str(k)
+        if isinstance(v, (dict, list)):
+            out.update(_flatten(v, name + '.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[name] = v
+    return out
+
+def compare(a_path, b_path):
+    with open(a_path) as f:
+        a = json.load(f)
+    with open(b_path) as f:
+        b = json.load(f)
+    print("{:40s} {:>14s} {:>14s} {:>8s}".format('', (a['meta']['commit'] or a_path)[:12],
+        (b['meta']['commit'] or b_path)[:12], 'change'))
+    fa = _flatten({k: v for k, v in a.items() if k not in ('meta', 'metrics')})
+    fb = _flatten({k: v for k, v in b.items() if k not in ('meta', 'metrics')})
+    for k in sorted(set(fa) | set(fb)):
+        va, vb = fa.get(k, None), fb.get(k, None)
+        change = "{:+.0f}%".format(100.0 * (vb - va) / va) if va and vb is not None else ""
+        print("{:40s} {:>14s} {:>14s} {:>8s}".format(k,
+            "-" if va is None else "{:.4g}".format(va),
+            "-" if vb is None else "{:.4g}".format(vb), change))
+
+if __name__ == '__main__':
+    log.basicConfig(level=log.WARNING, format="%(message)s")
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--url', default=None)
+    parser.add_argument('--data-dir', default=None)
+    parser.add_argument('--sizes', default=",".join(str(s) for s in SIZES),
+            type=lambda s: [int(float(x)) for x in s.split(",")])
+    parser.add_argument('--puts', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--batch-points', type=int, default=200000)
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--out', default=None)
+    parser.add_argument('--compare', nargs=2, metavar=('A', 'B'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    proc = tmp = None
+    url = args.url
+    data_dir = args.data_dir
+    if url is None:
+        port = free_port()
+        proc, tmp = start_server(port)
+        url = 'http://127.0.0.1:{}'.format(port)
+        data_dir = tmp
+    try:
+        results = asyncio.run(run(args, url.rstrip('/'), data_dir))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    results['meta'] = dict(commit=git_commit(), time=time.time(), url=url if args.url else None,
+            engine=None if args.url else config.STORAGE_ENGINE,
+            ingest_buffered=None if args.url else config.INGEST_BUFFERED,
+            sizes=args.sizes, versions=versions())
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+    else:
+        json.dump(results, sys.stdout, indent=1)
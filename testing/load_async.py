@@ -0,0 +1,186 @@
+""" load test of the async server: concurrent ingest clients and live
+viewers against one aserver.py process
+
+    python testing/load_async.py [--url URL] [--writers N] [--viewers N] [--duration S]
+
+Without --url a server is started on a free port in a temporary
+directory.  Each writer PUTs one point at a time to its own series as
+fast as the server answers; the viewers all hold an event stream of one
+series that a single writer updates ten times a second, and record how
+long each point took to reach them.
+"""
+import os
+import sys
+import time
+import uuid
+import json
+import socket
+import shutil
+import asyncio
+import hashlib
+import argparse
+import resource
+import tempfile
+import subprocess
+import logging as log
+
+import numpy as np
+import aiohttp
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+import sstsp
+
+LIVE_RATE = 10.0
+
+def new_key():
+    key = uuid.uuid4()
+    return key.hex, hashlib.sha256(key.bytes).hexdigest()[:sstsp.USER_ID_LEN]
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_server(port):
+    tmp = tempfile.mkdtemp(prefix='sstsp-load-')
+    root = os.path.join(HERE, '..')
+    shutil.copytree(os.path.join(root, 'templates'), os.path.join(tmp, 'templates'))
+    proc = subprocess.Popen([sys.executable, os.path.join(root, 'aserver.py'),
+        '--port', str(port), '--log-level', 'warning'], cwd=tmp, env=dict(os.environ,
+        PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')])))
+    return proc, tmp
+
+async def wait_up(session, url):
+    for i in range(100):
+        try:
+            async with session.get(url + '/d/' + 'x' * sstsp.USER_ID_LEN + '/x/latest'):
+                return
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("server at {} didn't come up".format(url))
+
+def percentiles(x):
+    if len(x) == 0:
+        return "-"
+    p = np.percentile(x, [50, 90, 99]) * 1000
+    return "p50 {:.1f} ms  p90 {:.1f} ms  p99 {:.1f} ms".format(*p)
+
+async def writer(session, url, key, user_id, data_id, stop, stats):
+    i = 0
+    while time.time() < stop:
+        t0 = time.time()
+        try:
+            async with session.put('{}/d/{}/{}'.format(url, user_id, data_id),
+                    data={'key': key, 'v': str(i), 't': str(t0)}) as r:
+                await r.read()
+                status = r.status
+        except aiohttp.ClientError:
+            status = None
+        if status == 200:
+            stats['latency'].append(time.time() - t0)
+        elif status == 503:
+            stats['busy'] += 1
+            await asyncio.sleep(0.1)
+        else:
+            stats['errors'] += 1
+        i += 1
+
+async def live_writer(session, url, key, user_id, data_id, stop):
+    while time.time() < stop:
+        async with session.put('{}/d/{}/{}'.format(url, user_id, data_id),
+                data={'key': key, 'v': '1', 't': str(time.time())}) as r:
+            await r.read()
+        await asyncio.sleep(1.0 / LIVE_RATE)
+
+async def viewer(session, url, user_id, data_id, stop, stats):
+    while time.time() < stop:
+        try:
+            async with session.get('{}/d/{}/{}/events'.format(url, user_id, data_id),
+                    timeout=aiohttp.ClientTimeout(total=None, sock_read=None)) as r:
+                if r.status == 503:
+                    # what EventSource does: reconnect after a while
+                    stats['busy'] += 1
+                    await asyncio.sleep(float(r.headers.get('Retry-After', 1)))
+                    continue
+                if r.status != 200:
+                    stats['errors'] += 1
+                    return
+                stats['connected'] += 1
+                while time.time() < stop:
+                    try:
+                        line = await asyncio.wait_for(r.content.readline(), stop - time.time() + 0.1)
+                    except asyncio.TimeoutError:
+                        break
+                    if not line:
+                        break
+                    if line.startswith(b'data: '):
+                        d = json.loads(line[6:])
+                        now = time.time()
+                        for t in d['index']:
+                            stats['delay'].append(now - t / 1000.0)
+                return
+        except aiohttp.ClientError:
+            stats['errors'] += 1
+            return
+
+async def run(url, n_writers, n_viewers, duration):
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await wait_up(session, url)
+        key, user_id = new_key()
+        # create the series up front so viewers can subscribe
+        for data_id in ['live'] + ['w{}'.format(i) for i in range(n_writers)]:
+            async with session.put('{}/d/{}/{}'.format(url, user_id, data_id),
+                    data={'key': key, 'v': '0'}) as r:
+                assert r.status == 200, await r.text()
+
+        w_stats = dict(latency=[], busy=0, errors=0)
+        v_stats = dict(delay=[], connected=0, busy=0, errors=0)
+        start = time.time()
+        stop = start + duration
+        tasks = [viewer(session, url, user_id, 'live', stop, v_stats) for i in range(n_viewers)]
+        tasks += [writer(session, url, key, user_id, 'w{}'.format(i), stop, w_stats)
+                for i in range(n_writers)]
+        clients = asyncio.gather(*tasks)
+        # let the viewers connect before the live series starts moving
+        await asyncio.sleep(min(2.0, duration / 4.0))
+        await live_writer(session, url, key, user_id, 'live', stop)
+        await clients
+        elapsed = time.time() - start
+
+    n = len(w_stats['latency'])
+    print("writers  {:5d}  {:8.0f} points/s  busy {}  errors {}  {}".format(
+        n_writers, n / elapsed, w_stats['busy'], w_stats['errors'],
+        percentiles(w_stats['latency'])))
+    print("viewers  {:5d}  connected {}  busy {}  errors {}  {:.0f} deliveries  delay {}".format(
+        n_viewers, v_stats['connected'], v_stats['busy'], v_stats['errors'], len(v_stats['delay']),
+        percentiles(v_stats['delay'])))
+
+if __name__ == '__main__':
+    log.basicConfig(level=log.WARNING)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--url', default=None)
+    parser.add_argument('--writers', type=int, default=100)
+    parser.add_argument('--viewers', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=10.0)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    proc = tmp = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        proc, tmp = start_server(port)
+        url = 'http://127.0.0.1:{}'.format(port)
+    try:
+        asyncio.run(run(url.rstrip('/'), args.writers, args.viewers, args.duration))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+            shutil.rmtree(tmp, ignore_errors=True)
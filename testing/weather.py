@@ -5,6 +5,10 @@ import sstsp
 
 owm = pyowm.OWM('95af8f5a066c0337adf73aabf722b5fc')
 TEMP_UNITS = 'fahrenheit'
+# readings are queued and posted in batches in the background, so a slow
+# or unreachable server doesn't hold up the sampling loop
+client = sstsp.Client(flush_interval=60, spool="weather.spool")
+
 def kelvin_to_f(temp_k):
     return temp_k*9.0/5.0 - 459.67
 
@@ -22,17 +26,20 @@ def update():
     
     temp_f = w.get_temperature(TEMP_UNITS)['temp']
     log.info("temperature is {} F".format(temp_f))
-    sstsp.send_data("atlanta_temperature", time.time(), temp_f)
+    client.send("atlanta_temperature", temp_f)
     
     wind_speed = w.get_wind()['speed']
 
     log.info("wind speed is {}".format(wind_speed))
-    sstsp.send_data("atlanta_wind_speed", time.time(), wind_speed)
+    client.send("atlanta_wind_speed", wind_speed)
 
 if __name__ == '__main__':
     log.basicConfig(level=log.DEBUG)
     UPDATE_INT = 15
-    while True:
-        update()
-        time.sleep(UPDATE_INT)
+    try:
+        while True:
+            update()
+            time.sleep(UPDATE_INT)
+    finally:
+        client.close()
 
@@ -0,0 +1,29 @@
+""" the server modules are imported from the repository root; user.py and
+the engines keep their files relative to the working directory, which
+is a fresh temporary directory for the whole session """
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+WORKDIR = tempfile.mkdtemp(prefix='sstsp-tests-')
+os.chdir(WORKDIR)
+
+
+def pytest_unconfigure(config):
+    # pytest changes back to where it was started before the atexit hooks
+    # of user.py save the catalogs and close the stores
+    os.chdir(WORKDIR)
+
+import hashlib
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def user_key():
+    """ (user_id, key) of a new user """
+    import sstsp
+    key = uuid.uuid4()
+    return hashlib.sha256(key.bytes).hexdigest()[:sstsp.USER_ID_LEN], key.hex
@@ -0,0 +1,277 @@
+""" the HTTP API through Flask's test client """
+import os
+import json
+
+import pytest
+
+pytest.importorskip('bokeh')
+import app
+import config
+import ingest
+import user
+from werkzeug.http import http_date
+
+T0 = 1700000000
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+def put(client, user_id, key, data_id, v, t):
+    return client.put('/d/{}/{}'.format(user_id, data_id), data={'key': key, 'v': v, 't': t})
+
+def values(client, user_id, data_id):
+    r = client.get('/d/{}/{}'.format(user_id, data_id))
+    assert r.status_code == 200, r.data
+    return json.loads(r.data)['data']
+
+def flush():
+    if user.ingest_buffer() is not None:
+        user.ingest_buffer().flush()
+
+
+def test_bad_times_are_refused_and_ingest_goes_on(client, user_key):
+    user_id, key = user_key
+    assert put(client, user_id, key, 'temp', '1', str(T0)).status_code == 200
+    r = put(client, user_id, key, 'temp', '2', '1e12')
+    assert r.status_code == 400
+    r = client.post('/d/{}'.format(user_id), content_type='application/json',
+            data=json.dumps({'key': key, 'data': {'temp': {'t': [1e15], 'v': [3]}}}))
+    assert r.status_code == 400
+    assert 'out of range' in json.loads(r.data)['results']['temp'][0]
+
+    flush()
+    assert put(client, user_id, key, 'temp', '4', str(T0 + 1)).status_code == 200
+    flush()
+    assert values(client, user_id, 'temp') == [1.0, 4.0]
+    if user.ingest_buffer() is not None:
+        assert user.ingest_buffer().stats()['points_flushed'] >= 2
+
+def test_an_uncommittable_wal_record_does_not_stop_a_restart(client, user_key):
+    buf = user.ingest_buffer()
+    if buf is None:
+        pytest.skip("ingest is not buffered")
+    user_id, key = user_key
+    assert put(client, user_id, key, 'temp', '1', str(T0)).status_code == 200
+    flush()
+
+    # a record from before the times were checked, left in the WAL
+    buf.close()
+    with open(buf.wal_path, 'a') as f:
+        f.write(json.dumps({'u': user_id, 'p': {'bad': [[1e15], [2.0]]}}) + "\n")
+        f.write(json.dumps({'u': user_id, 'p': {'temp': [[T0 + 1], [3.0]]}}) + "\n")
+    user._ingest = ingest.IngestBuffer(buf.wal_path, user._commit_points,
+            flush_interval=3600, max_retries=2)
+    try:
+        flush()
+        assert user._ingest.stats()['points_rejected'] == 1
+        assert user._ingest.pending_ids(user_id) == set()
+        assert values(client, user_id, 'temp') == [1.0, 3.0]
+        assert put(client, user_id, key, 'temp', '4', str(T0 + 2)).status_code == 200
+        flush()
+        assert values(client, user_id, 'temp') == [1.0, 3.0, 4.0]
+    finally:
+        user._ingest.close()
+        user._ingest = None
+
+def test_a_partly_committed_group_is_stored_once(client, user_key):
+    buf = user.ingest_buffer()
+    if buf is None or config.STORAGE_ENGINE != 'hdf5':
+        pytest.skip("needs buffered ingest into HDF5, which refuses the data_id")
+    user_id, key = user_key
+
+    # a group from before data_ids were checked, left in the WAL
+    buf.close()
+    with open(buf.wal_path, 'a') as f:
+        f.write(json.dumps({'u': user_id,
+            'p': {'temp': [[T0, T0 + 1], [1.0, 2.0]], 'a/b': [[T0], [3.0]]}}) + "\n")
+    user._ingest = ingest.IngestBuffer(buf.wal_path, user._commit_points,
+            flush_interval=3600, max_retries=2)
+    try:
+        for i in range(4):
+            flush()
+        stats = user._ingest.stats()
+        assert stats['points_flushed'] == 2 and stats['points_rejected'] == 1
+        assert values(client, user_id, 'temp') == [1.0, 2.0]
+    finally:
+        user._ingest.close()
+        user._ingest = None
+
+def test_malformed_batches_are_bad_requests(client, user_key):
+    user_id, key = user_key
+    for doc in ({'key': 123, 'data': {'temp': {'t': [T0], 'v': [1]}}},
+            {'key': key, 'data': {'temp': {'t': [T0], 'v': [[1]]}}},
+            {'key': key, 'data': {'a/b': {'t': [T0], 'v': [1]}, 'latest': {'t': [T0], 'v': [1]}}}):
+        r = client.post('/d/{}'.format(user_id), content_type='application/json',
+                data=json.dumps(doc))
+        assert r.status_code == 400, r.data
+    r = client.post('/d/{}?key={}'.format(user_id, key), content_type='text/csv',
+            data="temp,{},\n".format(T0))
+    assert r.status_code == 400
+    assert client.get('/d/{}'.format(user_id)).status_code == 404
+
+@pytest.mark.parametrize('query', ['start=1e12', 'end=-1e12', 'start=inf', 'start=nan'])
+def test_times_outside_datetime64_are_bad_requests(client, user_key, query):
+    user_id, key = user_key
+    assert put(client, user_id, key, 'temp', '1', str(T0)).status_code == 200
+    for url in ['/d/{u}/temp', '/d/{u}/temp/agg?every=1h', '/d/{u}/temp/details',
+            '/d/{u}?data_id=temp']:
+        url = url.format(u=user_id)
+        r = client.get(url + ('&' if '?' in url else '?') + query)
+        assert r.status_code == 400, url
+
+def test_unknown_users_leave_no_catalog(client, user_key):
+    user_id, key = user_key
+    for url in ['/d/{}', '/d/{}/x', '/d/{}/x/latest']:
+        assert client.get(url.format(user_id)).status_code == 404
+    user._catalog.close()
+    assert not os.path.exists(user._catalog.path(user_id))
+
+def test_etags_follow_writes(client, user_key):
+    user_id, key = user_key
+    url = '/d/{}/temp'.format(user_id)
+    assert put(client, user_id, key, 'temp', '1', str(T0)).status_code == 200
+    r = client.get(url)
+    assert r.status_code == 200
+    etag = r.headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    assert put(client, user_id, key, 'temp', '2', str(T0 + 1)).status_code == 200
+    r = client.get(url, headers={'If-None-Match': etag})
+    assert r.status_code == 200 and r.headers['ETag'] != etag
+    assert client.get(url, headers={'If-None-Match': r.headers['ETag']}).status_code == 304
+
+def test_if_none_match_star_needs_the_series(client, user_key):
+    user_id, key = user_key
+    assert put(client, user_id, key, 'temp', '1', str(T0)).status_code == 200
+    star = {'If-None-Match': '*'}
+    assert client.get('/d/{}/temp'.format(user_id), headers=star).status_code == 304
+    assert client.get('/d/{}/wind'.format(user_id), headers=star).status_code == 404
+
+class Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+def test_last_modified_waits_for_the_second_to_end(client, user_key, monkeypatch):
+    user_id, key = user_key
+    url = '/d/{}/temp'.format(user_id)
+    assert put(client, user_id, key, 'temp', '1', str(T0)).status_code == 200
+    # a write at T0 + 0.1 and another in the same second, after a GET
+    clock = Clock(T0 + 0.3)
+    monkeypatch.setattr(app, 'time', clock)
+    monkeypatch.setattr(app, 'series_version', lambda u, d: ('v1', T0 + 0.1))
+    since = {'If-Modified-Since': http_date(T0)}
+    r = client.get(url)
+    assert r.status_code == 200 and 'Last-Modified' not in r.headers
+    assert client.get(url, headers=since).status_code == 200
+
+    clock.now = T0 + 1.5
+    r = client.get(url)
+    assert r.headers['Last-Modified'] == http_date(T0)
+    assert client.get(url, headers=since).status_code == 304
+
+    monkeypatch.setattr(app, 'series_version', lambda u, d: ('v2', T0 + 2.2))
+    clock.now = T0 + 3.5
+    assert client.get(url, headers=since).status_code == 200
+
+def test_plot_pages_are_cached_until_a_write(client, user_key):
+    user_id, key = user_key
+    url = '/p/{}/temp'.format(user_id)
+    assert put(client, user_id, key, 'temp', '1', str(T0)).status_code == 200
+    before = app._plot_pages.stats()
+    first = client.get(url)
+    assert first.status_code == 200
+    assert client.get(url).data == first.data
+    stats = app._plot_pages.stats()
+    assert (stats['misses'], stats['hits']) == (before['misses'] + 1, before['hits'] + 1)
+
+    assert put(client, user_id, key, 'temp', '2', str(T0 + 1)).status_code == 200
+    assert client.get(url).status_code == 200
+    assert app._plot_pages.stats()['misses'] == before['misses'] + 2
+
+def test_events_carry_new_points(client, user_key):
+    user_id, key = user_key
+    assert put(client, user_id, key, 'temp', '1', str(T0)).status_code == 200
+    assert client.get('/d/{}/wind/events'.format(user_id)).status_code == 404
+
+    r = client.get('/d/{}/temp/events'.format(user_id), buffered=False)
+    assert r.status_code == 200 and r.mimetype == 'text/event-stream'
+    events = iter(r.response)
+    assert next(events) == b": subscribed\n\n"
+    assert put(client, user_id, key, 'temp', '2', str(T0 + 1)).status_code == 200
+    event = next(events)
+    r.close()
+    assert event.startswith(b"data: ") and event.endswith(b"\n\n")
+    d = json.loads(event[len(b"data: "):])
+    assert d['data'] == [2.0] and d['index'] == [(T0 + 1) * 1000]
+
+def test_metrics_count_requests(client, user_key):
+    user_id, key = user_key
+    assert put(client, user_id, key, 'temp', '1', str(T0)).status_code == 200
+    assert client.get('/d/{}/temp'.format(user_id)).status_code == 200
+    r = client.get('/metrics')
+    assert r.status_code == 200 and r.mimetype == 'text/plain'
+    text = r.data.decode('utf-8')
+    assert '# TYPE sstsp_request_seconds histogram' in text
+    assert 'sstsp_request_seconds_count{method="GET",route="/d/<user_id>/<data_id>",status="200"}' in text
+    assert '# TYPE sstsp_series_cache_hits gauge' in text
+
+    snapshot = json.loads(client.get('/metrics?format=json').data)
+    gets = [h for h in snapshot['histograms']['request_seconds']
+            if h['labels'] == {'method': 'GET', 'route': '/d/<user_id>/<data_id>', 'status': '200'}]
+    assert gets[0]['count'] >= 1 and gets[0]['p50'] is not None
+    assert 'hits' in snapshot['stats']['plot_cache']
+
+def test_every_view_of_a_series(client, user_key):
+    user_id, key = user_key
+    for i in range(5):
+        assert put(client, user_id, key, 'temp', str(i), str(T0 + 60 * i)).status_code == 200
+    flush()
+    for url in ['/p/{u}/temp', '/p/{u}/temp?overview=1', '/p/{u}?data_id=temp',
+            '/d/{u}/temp/details', '/d/{u}/temp/latest', '/d/{u}/temp/agg?every=1m',
+            '/d/{u}/temp?max_points=3', '/d/{u}?data_id=temp', '/d/{u}']:
+        r = client.get(url.format(u=user_id))
+        assert r.status_code == 200, (url, r.data[:200])
+    for fmt in ('json', 'csv', 'ndjson', 'raw'):
+        r = client.get('/d/{}/temp?format={}'.format(user_id, fmt))
+        assert r.status_code == 200 and r.data, (fmt, r.data[:200])
+
+def test_nan_points_are_kept_but_not_plotted(client, user_key):
+    user_id, key = user_key
+    for i, v in enumerate(['1', 'nan', '3']):
+        assert put(client, user_id, key, 'temp', v, str(T0 + i)).status_code == 200
+    flush()
+    assert values(client, user_id, 'temp') == [1.0, None, 3.0]
+
+    r = client.get('/d/{}/temp?limit=2'.format(user_id))
+    assert json.loads(r.data)['data'] == [1.0, None]
+    r = client.get('/d/{}/temp?limit=2&cursor={}'.format(user_id, r.headers['X-Next-Cursor']))
+    assert json.loads(r.data)['data'] == [3.0]
+
+    r = client.get('/d/{}/temp?max_points=10'.format(user_id))
+    assert json.loads(r.data)['data'] == [1.0, 3.0]
+
+def test_details_of_the_whole_series(client, user_key):
+    user_id, key = user_key
+    for i in range(3):
+        assert put(client, user_id, key, 'temp', str(i), str(T0 + 60 * i)).status_code == 200
+    flush()
+    r = client.get('/d/{}/temp/details'.format(user_id))
+    d = json.loads(r.data)
+    assert (d['start'], d['end']) == (T0, T0 + 120)
+    assert d['original_samples_no'] == 3
+    r = client.get('/d/{}/temp/details?start={}'.format(user_id, T0 + 60))
+    d = json.loads(r.data)
+    assert (d['start'], d['end']) == (T0 + 60, T0 + 120)
+    assert d['original_samples_no'] == 2
+
+@pytest.mark.parametrize('freq, kept', [('15s', '15s'), ('1min', '1min'), ('1h', '1h'),
+        ('every now and then', None)])
+def test_sampling_interval(client, user_key, freq, kept):
+    user_id, key = user_key
+    r = client.put('/d/{}/temp'.format(user_id), data={'key': key, 'v': '1', 'f': freq})
+    assert r.status_code == 200
+    assert json.loads(client.get('/d/{}'.format(user_id)).data)['temp']['freq'] == kept
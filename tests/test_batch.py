@@ -0,0 +1,55 @@
+""" parsing and validation of batch writes """
+import json
+import time
+
+import numpy as np
+
+import batch
+
+
+def test_points_and_results():
+    b = batch.parse_json(json.dumps({'key': 'k', 'data': {
+        'a': {'t': [1.7e9, 1.7e9 + 1, 'x'], 'v': [1, 'nan', 2]},
+        'b': {'v': ['y']},
+    }}))
+    assert b.key == 'k'
+    assert b.accepted == 2 and b.rejected == 2
+    t, v = b.points['a']
+    assert t.tolist() == [1.7e9, 1.7e9 + 1]
+    assert v[0] == 1 and np.isnan(v[1])
+    assert b.results['a'][:2] == [None, None]
+    assert 'time' in b.results['a'][2]
+    assert 'value' in b.results['b'][0]
+
+def test_missing_time_is_the_receive_time():
+    b = batch.parse_lines("a 1\n")
+    assert abs(b.points['a'][0][0] - time.time()) < 60
+
+def test_times_outside_datetime64_are_rejected():
+    b = batch.Batch()
+    b.add('a', [1e12, -1e10, 1e15, 'inf', batch.MAX_TIME - 1, 1.7e9], [1, 2, 3, 4, 5, 6])
+    assert b.accepted == 2
+    assert b.points['a'][0].tolist() == [batch.MAX_TIME - 1, 1.7e9]
+    assert all('out of range' in r for r in b.results['a'][:4])
+
+def test_bad_data_ids_are_rejected():
+    b = batch.parse_json(json.dumps({'data': {d: {'t': [1.7e9], 'v': [1]}
+        for d in ('a/b', '', 'x y', 'latest', '..', '_rollup_1h', 'ok')}}))
+    assert list(b.points) == ['ok']
+    assert b.rejected == 6
+    b = batch.parse_csv(",1.7e9,1\nok,1.7e9,2\n")
+    assert list(b.points) == ['ok'] and b.results[''] == ["data_id may not be empty"]
+
+def test_missing_values_are_not_nan():
+    b = batch.parse_csv("a,1.7e9,\na,1.7e9,nan\na,1.7e9,NA\n")
+    assert b.accepted == 1 and np.isnan(b.points['a'][1][0])
+    assert b.results['a'][0] is not None and b.results['a'][2] is not None
+    b = batch.parse_lines("a\na NaN\n")
+    assert b.accepted == 1 and b.results['a'][0] is not None
+    b = batch.parse_json('{"data": {"a": {"v": [null, NaN, "nan"]}}}')
+    assert b.results['a'] == [b.results['a'][0], None, None] and b.accepted == 2
+
+def test_malformed_values_are_rejected():
+    b = batch.parse_json(json.dumps({'data': {
+        'a': {'t': [[1.7e9], 1.7e9, 1.7e9, 1.7e9], 'v': [1, [1], {'x': 1}, 10**400]}}}))
+    assert b.accepted == 0 and all(r is not None for r in b.results['a'])
@@ -0,0 +1,156 @@
+""" the in-memory caches of cache.py, on their own and behind user.py """
+import time
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cache
+import user
+from util import epoch_ns, time_index
+
+T0 = 1700000000
+
+
+def series(t, v=None, name='temp'):
+    t = np.asarray(t, dtype=float)
+    s = pd.Series(t if v is None else np.asarray(v, dtype=float), index=time_index(t))
+    s.name = name
+    return s
+
+
+@pytest.fixture
+def tails():
+    return cache.TailCache(3, threading.RLock())
+
+def test_tail_ring_wraps_around(tails):
+    loads = []
+    def load(size):
+        loads.append(size)
+        return series([T0, T0 + 1])
+    t, v = tails.latest('k', 2, load)
+    assert v.tolist() == [T0, T0 + 1]
+    tails.extend('k', epoch_ns(time_index([T0 + 2, T0 + 3])), [T0 + 2, T0 + 3])
+    t, v = tails.latest('k', 3, load)
+    assert v.tolist() == [T0 + 1, T0 + 2, T0 + 3]
+    assert t.tolist() == epoch_ns(time_index([T0 + 1, T0 + 2, T0 + 3])).tolist()
+    assert loads == [3]
+    # beyond the ring, the caller reads the store
+    assert tails.latest('k', 4, load) is None
+
+def test_tail_only_extends_warm_series(tails):
+    tails.extend('k', epoch_ns(time_index([T0])), [1.0])
+    t, v = tails.latest('k', 3, lambda size: series([T0 + 5], [5.0]))
+    assert v.tolist() == [5.0]
+
+def test_tail_discard_user(tails):
+    tails.latest(('u1', 'a'), 1, lambda size: series([T0], [1.0]))
+    tails.latest(('u2', 'a'), 1, lambda size: series([T0], [1.0]))
+    tails.discard_user('u1')
+    assert tails.latest(('u1', 'a'), 1, lambda size: series([T0], [2.0]))[1].tolist() == [2.0]
+    assert tails.latest(('u2', 'a'), 1, lambda size: series([T0], [2.0]))[1].tolist() == [1.0]
+
+def test_latest_follows_writes(user_key):
+    user_id, key = user_key
+    user.write_points(user_id, {'temp': ([T0, T0 + 1], [1.0, 2.0])})
+    assert user.get_data_page_latest(user_id, 'temp', 2).tolist() == [1.0, 2.0]
+    user.write_points(user_id, {'temp': ([T0 + 2], [3.0])})
+    d = user.get_data_page_latest(user_id, 'temp', 2)
+    assert d.tolist() == [2.0, 3.0]
+    assert epoch_ns(d.index).tolist() == epoch_ns(time_index([T0 + 1, T0 + 2])).tolist()
+
+
+def test_series_lru_is_bounded_by_bytes():
+    one = cache._nbytes(series([T0, T0 + 1]))
+    c = cache.SeriesCache(2 * one, threading.RLock())
+    for k in ('a', 'b'):
+        c.put(k, series([T0, T0 + 1]), c.generation(k))
+    assert c.get('a') is not None
+    c.put('c', series([T0, T0 + 1]), c.generation('c'))
+    # b was the least recently used
+    assert c.get('b') is None and c.get('a') is not None and c.get('c') is not None
+    assert c.stats()['evictions'] == 1 and c.stats()['bytes'] == 2 * one
+    c.put('big', series(np.arange(T0, T0 + 10)), c.generation('big'))
+    assert c.get('big') is None
+
+def test_series_extended_by_writes():
+    c = cache.SeriesCache(1 << 20, threading.RLock())
+    c.put('a', series([T0]), c.generation('a'))
+    c.extend('a', series([T0 + 1]))
+    assert c.get('a').tolist() == [T0, T0 + 1]
+
+def test_series_loaded_across_a_write_is_not_kept():
+    c = cache.SeriesCache(1 << 20, threading.RLock())
+    generation = c.generation(('u1', 'a'))
+    c.extend(('u1', 'a'), series([T0 + 1]))
+    c.put(('u1', 'a'), series([T0]), generation)
+    assert c.get(('u1', 'a')) is None
+    generation = c.generation(('u1', 'a'))
+    c.discard_user('u1')
+    c.put(('u1', 'a'), series([T0]), generation)
+    assert c.get(('u1', 'a')) is None
+
+def test_cached_series_follow_writes(user_key):
+    user_id, key = user_key
+    user.write_points(user_id, {'temp': ([T0, T0 + 1], [1.0, 2.0])})
+    assert user.get_data_page(user_id, 'temp').tolist() == [1.0, 2.0]
+    hits = user.series_cache_stats()['hits']
+    user.write_points(user_id, {'temp': ([T0 + 2], [3.0])})
+    assert user.get_data_page(user_id, 'temp').tolist() == [1.0, 2.0, 3.0]
+    assert user.get_data_page(user_id, 'temp', T0 + 1, T0 + 2).tolist() == [2.0]
+    assert user.series_cache_stats()['hits'] == hits + 2
+
+
+def test_agg_lru_and_invalidation():
+    c = cache.AggCache(2)
+    for k in ('a', 'b', 'c'):
+        key = ('u1', k, 60)
+        c.put(key, None, T0 + 600, 'partials of ' + k, c.generation('u1', k))
+    assert c.get(('u1', 'a', 60)) is None and c.counters['evictions'] == 1
+    # points after the closed buckets, or too recent to be in any, change nothing
+    c.invalidate('u1', 'b', T0 + 600, T0 + 3600)
+    c.invalidate('u1', 'b', T0, T0)
+    assert c.get(('u1', 'b', 60)) == (None, T0 + 600, 'partials of b')
+    c.invalidate('u1', 'b', T0 + 599, T0 + 3600)
+    assert c.get(('u1', 'b', 60)) is None
+
+def test_agg_computed_across_a_write_is_not_kept():
+    c = cache.AggCache(2)
+    generation = c.generation('u1', 'a')
+    c.invalidate('u1', 'a', T0, T0 + 3600)
+    c.put(('u1', 'a', 60), None, T0 + 600, 'stale', generation)
+    assert c.get(('u1', 'a', 60)) is None
+
+def test_closed_buckets_are_cached(user_key):
+    user_id, key = user_key
+    user.write_points(user_id, {'temp': (T0 + np.arange(0, 7200, 600.0), np.ones(12))})
+    first = user.aggregate(user_id, 'temp', 3600, ('count', 'sum'))
+    # every bucket closed by now, from the first point on
+    lo, hi, p = user._aggs.get((user_id, 'temp', 3600))
+    assert lo is None and hi > T0 + 7200 and p['count'].sum() == 12
+    assert user.aggregate(user_id, 'temp', 3600, ('count', 'sum')).equals(first)
+
+    # a write into a closed bucket makes it stale
+    user.write_points(user_id, {'temp': ([T0 + 60], [5.0])})
+    a = user.aggregate(user_id, 'temp', 3600, ('count', 'sum'))
+    assert a['count'].sum() == 13 and a['sum'].sum() == 17.0
+
+def test_open_buckets_are_not_cached(user_key):
+    user_id, key = user_key
+    now = time.time()
+    user.write_points(user_id, {'temp': ([now - 30, now], [1.0, 2.0])})
+    assert user.aggregate(user_id, 'temp', 3600, ('count',))['count'].sum() == 2
+    lo, hi, p = user._aggs.get((user_id, 'temp', 3600))
+    assert hi <= now - 30 and len(p) == 0
+
+
+def test_page_lru():
+    c = cache.PageCache(2)
+    for k in ('a', 'b', 'c'):
+        c.put(k, 'page ' + k)
+    assert c.get('a') is None and c.get('c') == 'page c'
+    assert c.stats() == {'hits': 1, 'misses': 1, 'evictions': 1, 'entries': 2}
+    off = cache.PageCache(0)
+    off.put('a', 'page a')
+    assert off.get('a') is None
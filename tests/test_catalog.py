@@ -0,0 +1,43 @@
+""" catalog.Catalog of each user's series """
+import os
+
+import catalog
+
+
+class Stores(object):
+    """ scan function of a catalog over {user_id: {data_id: entry}} """
+    def __init__(self):
+        self.series = {}
+        self.scans = 0
+
+    def scan(self, user_id):
+        self.scans += 1
+        return {d: dict(e) for d, e in self.series.get(user_id, {}).items()}
+
+
+def test_lookups_of_unknown_users_are_not_kept(tmp_path):
+    stores = Stores()
+    cat = catalog.Catalog(stores.scan, root=str(tmp_path))
+    for i in range(3):
+        assert cat.listing('nobody') == {}
+        assert cat.get('nobody', 'x') is None
+    assert cat.stats() == {'users': 0, 'dirty': 0, 'series': 0}
+    cat.close()
+    assert os.listdir(str(tmp_path)) == []
+
+def test_recorded_users_are_saved_and_rebuilt(tmp_path):
+    stores = Stores()
+    cat = catalog.Catalog(stores.scan, root=str(tmp_path))
+    cat.record('u1', {'temp': ([1.0, 2.0], [0.0, 0.0])}, {'temp': '1m'}, now=5.0)
+    assert os.path.exists(cat.path('u1'))
+    assert cat.get('u1', 'temp')['count'] == 2
+
+    # a crash: the saved copy isn't clean, so the store is scanned again
+    stores.series['u1'] = {'temp': catalog.entry(first=1.0, last=3.0, count=3)}
+    cat = catalog.Catalog(stores.scan, root=str(tmp_path))
+    e = cat.get('u1', 'temp')
+    assert (e['count'], e['last'], e['freq'], e['created']) == (3, 3.0, '1m', 5.0)
+    cat.close()
+    scans = stores.scans
+    assert catalog.Catalog(stores.scan, root=str(tmp_path)).get('u1', 'temp')['count'] == 3
+    assert stores.scans == scans
@@ -0,0 +1,53 @@
+""" the batching clients of sstsp.py against a stub server """
+import asyncio
+import json
+
+import pytest
+
+import sstsp
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+
+
+async def stub_server(received):
+    """ a server accepting every batch POSTed to it """
+    async def post(request):
+        doc = json.loads(await request.text())
+        received.append(doc['data'])
+        n = sum(len(p['v']) for p in doc['data'].values())
+        return web.json_response({'success': True, 'accepted': n, 'rejected': 0, 'results': {}})
+    app = web.Application()
+    app.router.add_post('/d/{user_id}', post)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, 'http://127.0.0.1:{}'.format(port)
+
+
+def test_async_points_sent_before_start_go_out_once_started():
+    async def run():
+        received = []
+        runner, url = await stub_server(received)
+        c = sstsp.AsyncClient(url, sstsp.USER_ID, sstsp.KEY, max_batch=2)
+        # more than a batch, before any loop task exists to notify
+        for i in range(3):
+            assert c.send('temp', i, t=1.7e9 + i)
+        with pytest.raises(RuntimeError, match="start"):
+            await c.flush()
+        async with c:
+            c.send('temp', 3, t=1.7e9 + 3)
+            assert await c.flush()
+        await runner.cleanup()
+        return received
+    received = asyncio.run(run())
+    assert sorted(v for batch in received for v in batch['temp']['v']) == [0, 1, 2, 3]
+
+def test_async_close_before_start():
+    async def run():
+        c = sstsp.AsyncClient('http://127.0.0.1:1', sstsp.USER_ID, sstsp.KEY)
+        c.send('temp', 1)
+        await c.close()
+    asyncio.run(run())
@@ -0,0 +1,72 @@
+""" round trips of the compressed blocks and the wire formats """
+import numpy as np
+import pandas as pd
+import pytest
+
+import codec
+import formats
+import sstsp
+from util import time_index
+
+I64 = np.iinfo(np.int64)
+T0 = 1700000000 * 10**9
+
+CASES = {
+    'empty': ([], []),
+    'single': ([T0], [1.5]),
+    'two': ([T0, T0 + 10**9], [1.0, 2.0]),
+    'regular': (T0 + 15 * 10**9 * np.arange(1000), np.sin(np.arange(1000))),
+    'jitter': (T0 + np.cumsum(np.random.RandomState(1).randint(1, 10**10, 500)),
+               np.random.RandomState(2).normal(size=500)),
+    'special values': (T0 + np.arange(6), [np.nan, np.inf, -np.inf, -0.0, 0.0, 5e-324]),
+    'constant': (T0 + np.arange(100), np.full(100, 20.0)),
+    'int64 extremes': ([I64.min, -1, 0, 1, I64.max], [1.0, 2.0, 3.0, 4.0, 5.0]),
+    'unsorted': ([T0 + 5, T0, T0 + 3, T0 - 10**12], [1.0, 2.0, 3.0, 4.0]),
+}
+
+def same(a, b):
+    """ equal bit patterns, so NaNs and -0.0 count """
+    return np.array_equal(np.asarray(a, dtype='<f8').view('<u8'), np.asarray(b, dtype='<f8').view('<u8'))
+
+
+@pytest.mark.parametrize('case', sorted(CASES))
+def test_block_round_trip(case):
+    t, v = CASES[case]
+    t, v, end = codec.decode(codec.encode(t, v))
+    assert t.tolist() == np.asarray(CASES[case][0], dtype='<i8').tolist()
+    assert same(v, CASES[case][1])
+
+@pytest.mark.parametrize('case', sorted(CASES))
+def test_client_decodes_blocks(case):
+    t, v = CASES[case]
+    body = codec.encode(t, v) + codec.encode(t[:1], v[:1])
+    s = sstsp.decode(formats.MIMETYPES['block'], body)
+    t2, v2 = codec.decode_all(body)
+    assert np.asarray(s.index).view('<i8').tolist() == t2.tolist()
+    assert same(s.values, v2)
+
+def test_concatenated_blocks():
+    t, v = CASES['regular']
+    body = b"".join(codec.encode(t[i:i + 100], v[i:i + 100]) for i in range(0, 1000, 100))
+    t2, v2 = codec.decode_all(body)
+    assert t2.tolist() == t.tolist() and same(v2, v)
+    assert [len(x) for x in codec.decode_all(b"")] == [0, 0]
+
+def test_mismatched_lengths():
+    with pytest.raises(ValueError):
+        codec.encode([1, 2], [1.0])
+
+
+@pytest.mark.parametrize('fmt', [f for f in formats.MIMETYPES if formats.available(f)])
+@pytest.mark.parametrize('n', [0, 1, 1000])
+def test_wire_formats(fmt, n):
+    v = np.arange(n, dtype=float)
+    v[::7] = np.nan
+    s = pd.Series(v, index=time_index(1.7e9 + np.arange(n) * 0.5))
+    s.name = 'temp'
+    body = formats.encode(fmt, s)
+    d = sstsp.decode(formats.MIMETYPES[fmt], body)
+    assert len(d) == n
+    # the text formats carry milliseconds
+    assert np.array_equal(d.index.values.astype('datetime64[ms]'), s.index.values.astype('datetime64[ms]'))
+    assert np.array_equal(d.values, v, equal_nan=True)
@@ -0,0 +1,34 @@
+""" decimation for plotting, downsample.py """
+import numpy as np
+import pandas as pd
+
+import downsample
+from util import time_index
+
+
+def test_lttb_keeps_the_peaks():
+    x = np.arange(10.0)
+    y = np.array([0, 0, 0, 5, 0, 0, 0, 0, -5, 0], dtype=float)
+    assert downsample.lttb(x, y, 4).tolist() == [0, 3, 8, 9]
+
+def test_lttb_short_outputs():
+    x = np.arange(5.0)
+    assert downsample.lttb(x, x, 5).tolist() == [0, 1, 2, 3, 4]
+    assert downsample.lttb(x, x, 2).tolist() == [0, 4]
+    assert downsample.lttb(x, x, 0).tolist() == []
+
+def test_minmax_keeps_each_buckets_extremes():
+    y = np.array([3, 1, 4, 1, 5, 9, 2, 6], dtype=float)
+    assert downsample.minmax(np.arange(8.0), y, 4).tolist() == [1, 2, 5, 6]
+    assert downsample.minmax(np.arange(8.0), y, 8).tolist() == list(range(8))
+
+def test_decimate_takes_points_of_the_series():
+    t = 1700000000 + np.arange(10)
+    d = pd.Series([0, 0, 0, 5, 0, np.nan, 0, 0, -5, 0], index=time_index(t))
+    kept = downsample.decimate(d, 4, 'lttb')
+    assert len(kept) == 4 and kept.notnull().all()
+    assert (d.loc[kept.index] == kept).all()
+    assert kept.max() == 5 and kept.min() == -5
+    # buckets of the 9 points left: min and max of each, the first if tied
+    assert downsample.decimate(d, 4, 'minmax').tolist() == [0, 5, 0, -5]
+    assert len(downsample.decimate(d, 20)) == 9
@@ -0,0 +1,69 @@
+""" range queries and retention of the storage engines """
+import numpy as np
+import pandas as pd
+import pytest
+
+import engine
+import retention
+from util import time_index
+
+T0 = 1699920000
+
+
+@pytest.fixture(params=engine.ENGINES)
+def store(request, tmp_path, monkeypatch):
+    """ an engine with a store 'u' holding a series 'temp' of a point about
+    every minute, at times that don't convert exactly to ns """
+    monkeypatch.chdir(tmp_path)
+    e = engine.open_engine(request.param)
+    t = T0 + 60 * np.arange(100) + 0.1234567
+    s = pd.Series(np.arange(100, dtype=float), index=time_index(t))
+    s.name = 'temp'
+    with e.session('u', 'a') as session:
+        session.append('temp', s)
+    yield e, t
+    e.close_all()
+
+def compact(e, cuts):
+    return e.compact('u', lambda data_id: cuts)
+
+def times(e):
+    with e.session('u') as session:
+        d = session.select('temp')[0]
+    return d
+
+
+def test_range_bounds(store):
+    e, t = store
+    with e.session('u') as session:
+        d = session.select('temp', t[40], t[50])[0]
+    assert d.tolist() == list(range(40, 50))
+
+def test_a_point_on_the_cutoff_is_kept(store):
+    e, t = store
+    r = compact(e, {retention.RAW: t[40]})
+    assert r['series']['temp']['removed'] == 40
+    d = times(e)
+    assert len(d) == 60 and d.iloc[0] == 40
+    assert r['series']['temp']['first'] == pytest.approx(t[40])
+
+def test_the_latest_point_is_kept(store):
+    e, t = store
+    r = compact(e, {retention.RAW: t[-1] + 3600})
+    assert r['series']['temp']['removed'] == 99
+    assert times(e).tolist() == [99.0]
+
+def test_nothing_expired(store):
+    e, t = store
+    r = compact(e, {retention.RAW: t[0]})
+    assert r['series'] == {}
+    assert len(times(e)) == 100
+
+def test_rollup_buckets_are_kept_whole(store):
+    e, t = store
+    # the cutoff falls inside the second hour
+    compact(e, {'1h': T0 + 5400})
+    with e.session('u') as session:
+        p = session.rollup('temp', '1h')
+    assert p.index[0] == time_index(T0 + 3600)[0]
+    assert p['count'].sum() == 40
@@ -0,0 +1,152 @@
+""" write-ahead log, group commit and recovery of ingest.IngestBuffer """
+import os
+
+import numpy as np
+import pytest
+
+import ingest
+
+
+class Store(object):
+    """ commit function of an IngestBuffer, failing for the users in fail.
+    Like a store, series appended before a failing one stay appended """
+    def __init__(self):
+        self.points = {}
+        self.fail = set()
+
+    def commit(self, user_id, points, done):
+        if user_id in self.fail:
+            raise IOError("store of {} is broken".format(user_id))
+        for data_id, (t, v) in points.items():
+            if np.any(np.isinf(t)) or '/' in data_id:
+                raise ValueError("bad point")
+            ts, vs = self.points.setdefault((user_id, data_id), ([], []))
+            ts.extend(t.tolist())
+            vs.extend(v.tolist())
+            done(data_id)
+
+    def values(self, user_id, data_id):
+        return self.points.get((user_id, data_id), ([], []))[1]
+
+
+@pytest.fixture
+def wal(tmp_path):
+    return str(tmp_path / 'ingest.wal')
+
+def new_buffer(wal, store, **kw):
+    kw.setdefault('flush_interval', 3600)
+    kw.setdefault('fsync', False)
+    return ingest.IngestBuffer(wal, store.commit, **kw)
+
+
+def test_flush_commits_and_clears_the_wal(wal):
+    store = Store()
+    buf = new_buffer(wal, store)
+    buf.put('u1', {'a': ([1.0, 2.0], [10.0, 20.0])})
+    buf.put('u1', {'a': ([3.0], [30.0])})
+    assert buf.pending('u1', 'a')[1].tolist() == [10.0, 20.0, 30.0]
+    buf.flush()
+    assert store.values('u1', 'a') == [10.0, 20.0, 30.0]
+    assert buf.pending('u1', 'a') is None
+    assert buf.stats()['points_flushed'] == 3
+    assert not os.path.exists(buf.flushing_path)
+    buf.close()
+
+def test_recovery_replays_both_wal_files(wal):
+    store = Store()
+    buf = new_buffer(wal, store)
+    buf.put('u1', {'a': ([1.0], [10.0])})
+    store.fail.add('u1')
+    buf.flush()
+    buf.put('u1', {'a': ([2.0], [20.0])})
+    # a crash: neither the rotated WAL nor the new one are committed
+    buf._wal.close()
+    assert os.path.exists(buf.flushing_path) and os.path.getsize(wal)
+
+    store.fail.clear()
+    buf = new_buffer(wal, store)
+    assert store.values('u1', 'a') == [10.0, 20.0]
+    assert not os.path.exists(buf.flushing_path)
+    buf.close()
+
+def test_recovery_skips_a_torn_record(wal):
+    with open(wal, 'wb') as f:
+        f.write(b'{"u": "u1", "p": {"a": [[1.0], [10.0]]}}\n{"u": "u1", "p": {"a"')
+    store = Store()
+    new_buffer(wal, store).close()
+    assert store.values('u1', 'a') == [10.0]
+
+def test_a_failing_user_does_not_hold_up_the_others(wal):
+    store = Store()
+    store.fail.add('bad')
+    buf = new_buffer(wal, store)
+    buf.put('bad', {'a': ([1.0], [1.0])})
+    buf.put('good', {'a': ([1.0], [1.0])})
+    buf.flush()
+    assert store.values('good', 'a') == [1.0]
+    assert buf.pending_ids('bad') == {'a'}
+
+    # new points are taken in while the failed ones wait
+    buf.put('good', {'a': ([2.0], [2.0])})
+    buf.put('bad', {'a': ([2.0], [2.0])})
+    buf.flush()
+    assert store.values('good', 'a') == [1.0, 2.0]
+    assert buf.stats()['points_flushed'] == 2
+
+    store.fail.clear()
+    buf.flush()
+    assert store.values('bad', 'a') == [1.0, 2.0]
+    assert not os.path.exists(buf.flushing_path)
+    buf.close()
+
+def test_failed_points_survive_a_restart(wal):
+    store = Store()
+    store.fail.add('bad')
+    buf = new_buffer(wal, store)
+    buf.put('bad', {'a': ([1.0], [1.0])})
+    buf.put('good', {'a': ([1.0], [1.0])})
+    buf.flush()
+    buf.put('bad', {'a': ([2.0], [2.0])})
+    buf._wal.close()
+
+    # still failing: kept for the flusher rather than raising
+    buf = new_buffer(wal, store)
+    assert buf.pending('bad', 'a')[1].tolist() == [1.0, 2.0]
+    store.fail.clear()
+    buf.flush()
+    assert store.values('bad', 'a') == [1.0, 2.0]
+    assert store.values('good', 'a') == [1.0]
+    buf.close()
+
+def test_uncommittable_writes_are_set_aside(wal):
+    store = Store()
+    buf = new_buffer(wal, store, max_retries=3)
+    buf.put('u1', {'a': ([1.0], [1.0])})
+    buf.put('u1', {'a': ([np.inf], [2.0])})
+    buf.put('u1', {'a': ([3.0], [3.0]), 'b': ([3.0], [3.0])})
+    for i in range(3):
+        buf.flush()
+    # the good writes of the user are committed one by one
+    assert store.values('u1', 'a') == [1.0, 3.0]
+    assert store.values('u1', 'b') == [3.0]
+    assert buf.pending_ids('u1') == set()
+    assert buf.stats()['points_rejected'] == 1
+    with open(buf.rejected_path) as f:
+        assert len(f.readlines()) == 1
+
+    buf.put('u1', {'a': ([4.0], [4.0])})
+    buf.flush()
+    assert store.values('u1', 'a') == [1.0, 3.0, 4.0]
+    buf.close()
+
+def test_series_committed_before_a_failure_are_not_written_again(wal):
+    store = Store()
+    buf = new_buffer(wal, store, max_retries=3)
+    buf.put('u1', {'temp': ([1.0, 2.0], [1.0, 2.0]), 'a/b': ([1.0], [3.0])})
+    for i in range(5):
+        buf.flush()
+    assert store.values('u1', 'temp') == [1.0, 2.0]
+    assert 'a/b' not in buf.pending_ids('u1')
+    stats = buf.stats()
+    assert stats['points_flushed'] == 2 and stats['points_rejected'] == 1
+    buf.close()
@@ -0,0 +1,48 @@
+""" series written in HDF5 fixed format, as before table storage, are
+served as they are until their next write migrates them """
+import numpy as np
+import pandas as pd
+import pytest
+
+import config
+import user
+
+T0 = 1699920000  # midnight UTC
+
+pytestmark = pytest.mark.skipif(config.STORAGE_ENGINE != 'hdf5',
+        reason="fixed format series are only found in HDF5 stores")
+
+
+@pytest.fixture
+def legacy(user_key):
+    """ user_id of a store holding a fixed format series 'temp' of a
+    point a minute over two days, without rollups """
+    user_id, key = user_key
+    t = T0 + 60 * np.arange(2 * 24 * 60)
+    s = pd.Series(np.arange(len(t), dtype=float), index=pd.to_datetime(t, unit='s'))
+    s.name = 'temp'
+    with pd.HDFStore(user.user_store_path(user_id), 'w') as store:
+        store['temp'] = s
+    return user_id
+
+
+def test_streamed_export(legacy):
+    chunks = list(user.iter_data_page(legacy, 'temp', chunksize=100))
+    assert sum(len(c) for c in chunks) == 2 * 24 * 60
+    chunks = list(user.iter_data_page(legacy, 'temp', T0 + 60, T0 + 180, chunksize=100))
+    assert [len(c) for c in chunks] == [2]
+
+def test_count_points(legacy):
+    assert user.count_points(legacy, 'temp') == 2 * 24 * 60
+
+def test_rollups_from_raw_points(legacy):
+    p = user.get_rollup(legacy, 'temp', '1h')
+    assert len(p) == 48 and p['count'].sum() == 2 * 24 * 60
+    p = user.get_rollup(legacy, 'temp', '1h', T0 + 30, T0 + 3601)
+    assert p['count'].tolist() == [60, 60]
+    a = user.aggregate(legacy, 'temp', 3600, ('mean', 'max'))
+    assert a['max'].iloc[0] == 59 and a['mean'].iloc[0] == 29.5
+    assert user.count_range(legacy, 'temp', T0 + 60, T0 + 2 * 3600) == 119
+
+def test_span_of_the_points(legacy):
+    assert user.series_span(legacy, 'temp') == (T0, T0 + 60 * (2 * 24 * 60 - 1))
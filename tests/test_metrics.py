@@ -0,0 +1,52 @@
+""" latency histograms and the /metrics output of metrics.py """
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def registry():
+    return metrics.Registry(buckets=(0.1, 1.0))
+
+def test_histogram_buckets_and_quantiles():
+    h = metrics.Histogram((0.1, 1.0))
+    assert h.quantile(0.5) is None
+    for seconds in (0.05, 0.1, 0.5, 0.5, 5.0):
+        h.observe(seconds)
+    # a bucket counts observations up to and including its bound
+    assert h.counts == [2, 2, 1] and h.count == 5 and h.sum == pytest.approx(6.15)
+    assert h.quantile(0.2) == pytest.approx(0.05)
+    assert h.quantile(0.6) == pytest.approx(0.1 + 0.9 / 2)
+    # beyond the largest bucket only its bound is known
+    assert h.quantile(0.99) == 1.0
+
+def test_render(registry):
+    registry.observe('request_seconds', 0.05, route='/d/<user_id>', status='200')
+    registry.observe('request_seconds', 2.0, route='/d/<user_id>', status='200')
+    registry.add_stats('cache', lambda: {'hits': 3, 'ratio': 0.5, 'on': True, 'name': 'x'})
+    lines = registry.render().splitlines()
+    labels = 'route="/d/<user_id>",status="200"'
+    assert lines == [
+        '# TYPE sstsp_request_seconds histogram',
+        'sstsp_request_seconds_bucket{' + labels + ',le="0.1"} 1',
+        'sstsp_request_seconds_bucket{' + labels + ',le="1"} 1',
+        'sstsp_request_seconds_bucket{' + labels + ',le="+Inf"} 2',
+        'sstsp_request_seconds_sum{' + labels + '} 2.05',
+        'sstsp_request_seconds_count{' + labels + '} 2',
+        '# TYPE sstsp_cache_hits gauge',
+        'sstsp_cache_hits 3',
+        '# TYPE sstsp_cache_ratio gauge',
+        'sstsp_cache_ratio 0.5',
+    ]
+
+def test_snapshot_survives_failing_stats(registry):
+    registry.observe('store_seconds', 0.5, op='read')
+    registry.add_stats('broken', lambda: 1 / 0)
+    registry.add_stats('pool', lambda: {'open': 2})
+    s = registry.snapshot()
+    h, = s['histograms']['store_seconds']
+    assert h['labels'] == {'op': 'read'} and h['count'] == 1 and h['p50'] == pytest.approx(0.55)
+    assert s['stats'] == {'pool': {'open': 2}}
+
+def test_label_values_are_escaped():
+    assert metrics._labels((('a', 'x"y\\z\n'),)) == '{a="x\\"y\\\\z\\n"}'
@@ -0,0 +1,32 @@
+""" fan-out of new points to live subscribers, pubsub.Hub """
+import pubsub
+
+
+def test_subscribers_get_what_is_published_after_they_subscribe():
+    hub = pubsub.Hub(backlog=10)
+    assert hub.publish('k', b'before') == 0
+    with hub.subscribe('k') as a, hub.subscribe('k') as b:
+        assert hub.subscribed('k')
+        assert hub.publish('k', b'one') == 2
+        hub.publish('k', b'two')
+        assert a.get(0) == [b'one', b'two']
+        assert a.get(0) == []
+        assert b.get(0) == [b'one', b'two']
+    assert not hub.subscribed('k')
+    assert hub.stats() == {'published': 2, 'delivered': 4, 'channels': 0, 'subscribers': 0}
+
+def test_a_slow_subscriber_skips_beyond_the_backlog():
+    hub = pubsub.Hub(backlog=2)
+    with hub.subscribe('k') as sub:
+        for m in (b'1', b'2', b'3'):
+            hub.publish('k', m)
+        assert sub.get(0) == [b'2', b'3']
+
+def test_listeners_are_called_on_publish():
+    hub = pubsub.Hub()
+    calls = []
+    with hub.subscribe('k', lambda: calls.append(1)):
+        hub.publish('k', b'x')
+        hub.publish('other', b'x')
+    hub.publish('k', b'x')
+    assert calls == [1]
@@ -0,0 +1,78 @@
+""" pooled HDFStore handles and the commit generations shared with a
+writer process """
+import os
+import sys
+import subprocess
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import storepool
+from util import time_index
+
+
+@pytest.fixture
+def gens(tmp_path):
+    return storepool.Generations(lambda user_id: str(tmp_path / (user_id + ".gen")), wait=0.05)
+
+def series(t):
+    s = pd.Series(np.asarray(t, dtype=float), index=time_index(t))
+    s.name = 'temp'
+    return s
+
+
+def test_generations_are_odd_during_a_commit(gens):
+    assert gens.read('u') == 0
+    gens.begin('u')
+    assert gens.read('u') % 2 == 1
+    gens.end('u')
+    assert gens.read('u') == 2
+    assert gens.stable('u') == 2
+
+def test_stable_gives_up_on_a_crashed_commit(gens):
+    gens.begin('u')
+    assert gens.stable('u') % 2 == 1
+    # a new commit after the crash still ends even
+    gens.begin('u')
+    gens.end('u')
+    assert gens.read('u') % 2 == 0
+
+def test_generations_are_shared_through_the_file(gens, tmp_path):
+    other = storepool.Generations(gens.path_for)
+    gens.begin('u')
+    gens.end('u')
+    assert other.read('u') == 2
+
+def test_read_handles_reopen_after_a_commit(gens, tmp_path):
+    path = str(tmp_path / "u.hf5")
+    with pd.HDFStore(path, 'w') as store:
+        store.append('temp', series([1.0]), format='table')
+    reader = storepool.StorePool(lambda user_id: path, generation=gens.stable)
+    with reader.session('u') as store:
+        assert len(store.select('temp')) == 1
+
+    # a commit by a writer process, as writer.py makes them
+    gens.begin('u')
+    subprocess.check_call([sys.executable, '-c', "import pandas as pd, numpy as np; "
+        "s = pd.Series([2.0], index=pd.to_datetime([2.0], unit='s').astype('datetime64[ns]'), "
+        "name='temp'); "
+        "st = pd.HDFStore({!r}, 'a'); st.append('temp', s); st.close()".format(path)],
+        env=dict(os.environ, HDF5_USE_FILE_LOCKING='FALSE'))
+    gens.end('u')
+    with reader.session('u') as store:
+        assert len(store.select('temp')) == 2
+    assert reader.counters['refreshes'] == 1
+    reader.close_all()
+
+def test_idle_handles_are_closed(tmp_path):
+    pool = storepool.StorePool(lambda user_id: str(tmp_path / (user_id + ".hf5")),
+            max_open=2, idle_timeout=3600)
+    for user_id in ('a', 'b', 'c'):
+        with pool.session(user_id, 'a') as store:
+            store.append('temp', series([1.0]), format='table')
+    assert len(pool) == 2
+    pool.idle_timeout = 0
+    pool.reap()
+    assert len(pool) == 0
+    assert all(os.path.exists(str(tmp_path / (u + ".hf5"))) for u in 'abc')
@@ -1,9 +1,30 @@
 import sstsp
 import pandas as pd
+import numpy as np
 import time
 import logging as log
-import os.path
+import threading
+import atexit
+import functools
+from contextlib import contextmanager
 
+from util import error, internal_error, epoch_ns, time_index, in_range
+import config
+import ingest
+import storepool
+import engine
+import cache
+import rollup
+import pubsub
+import formats
+import writer
+import catalog
+import retention
+import metrics
+
+_ingest = None
+_ingest_lock = threading.Lock()
+_compactor = None
 
 
 
@@ -12,86 +33,786 @@ class User(object):
         self.user_id = user_id
 
 def get_user_page(user_id):
+    """ {data_id: catalog entry} of the user's series, see catalog.py """
     log.debug("getting user page {}".format(user_id))
-    return user_id
+    series = _catalog.listing(user_id)
+    if not series and not user_store_exists(user_id):
+        error(404, "unknown user_id")
+    return series
 
 def _valid_user_id(user_id):
     #FIXME - ensure user_id is correctly formed before file operations
     return True
 
 def user_store_path(user_id):
-    return str(user_id) + ".hf5"
+    return _engine.path(user_id)
 
 def user_store_exists(user_id):
-    return os.path.exists(user_store_path(user_id))
+    return _engine.exists(user_id)
+
+def _generation_path(user_id):
+    return str(user_id) + ".gen"
+
+# with a writer process the stores change under our read handles, see
+# writer.py
+_gens = storepool.Generations(_generation_path) if config.WRITER_ADDRESS else None
+_seen_gens = {}
+_writer = None
+
+_engine = engine.open_engine(config.STORAGE_ENGINE,
+        generation=_gens.stable if _gens is not None else None)
+atexit.register(_engine.close_all)
+
+# held by writers from making points readable until the caches are
+# extended, see cache.py
+_write_lock = threading.RLock()
+_tails = cache.TailCache(config.TAIL_SIZE, _write_lock)
+_series = cache.SeriesCache(config.SERIES_CACHE_BYTES, _write_lock)
+_aggs = cache.AggCache(config.AGG_CACHE_ENTRIES)
+
+# per series (write count, last write time) of this process, bumped under
+# _write_lock.  See series_version
+_versions = {}
+_boot = "{:x}".format(int(time.time() * 1e6))
 
-def create_user_store(user_id):
-    """ get user dataframe"""
-    f = pd.HDFStore(user_store_path(user_id), 'w')
-    return f
+_hub = pubsub.Hub(config.LIVE_BACKLOG)
+
+def _scan_catalog(user_id):
+    """ catalog entries of the user's series from the store and the
+    ingest buffer.  first and last are those of the first and last rows,
+    created is unknown """
+    entries = {}
+    with _read_session(user_id) as store:
+        for data_id in store.series_ids() if store is not None else []:
+            first, _, nrows = store.select(data_id, limit=1)
+            e = entries[data_id] = catalog.entry(count=int(nrows))
+            if first is not None:
+                t = epoch_ns(pd.concat([first, store.tail(data_id, 1)]).index) / 1e9
+                e['first'], e['last'] = float(t[0]), float(t[-1])
+        buf = ingest_buffer()
+        for data_id in buf.pending_ids(user_id) if buf is not None else []:
+            p = _pending_series(user_id, data_id)
+            e = entries.setdefault(data_id, catalog.entry())
+            if p is not None and len(p):
+                t = epoch_ns(p.index) / 1e9
+                e['first'] = float(t[0]) if e['first'] is None else e['first']
+                e['last'] = float(t[-1])
+                e['count'] += len(t)
+    return entries
+
+# workers next to a writer process only read the catalog the writer
+# keeps, see writer_catalog
+_catalog = catalog.Catalog(_scan_catalog, save_interval=config.CATALOG_SAVE_INTERVAL,
+        readonly=bool(config.WRITER_ADDRESS))
+atexit.register(_catalog.close)
+_writer_catalog = None
 
 def get_user_store(user_id, mode='r'):
+    """ context manager yielding a session on the user's store, see
+    engine.py.  Write modes create the store if it doesn't exist yet """
     if not _valid_user_id(user_id):
         error(404, "invalid user_id")
     
+    if mode == 'r' and not user_store_exists(user_id):
+        error(404, "unknown user_id")
+
+    return _timed_session(user_id, mode)
+
+@contextmanager
+def _timed_session(user_id, mode):
+    """ an engine session, observing how long it waited for the user's
+    store and how long it held it """
+    op = 'read' if mode == 'r' else 'write'
+    start = time.time()
+    with _engine.session(user_id, mode) as store:
+        opened = time.time()
+        metrics.observe('store_wait_seconds', opened - start, op=op)
+        try:
+            yield store
+        finally:
+            metrics.observe('store_seconds', time.time() - opened, op=op)
+
+def migrate_user_store(user_id):
+    """ one-time conversion of a user store to the current layout of its
+    engine, see HDF5Engine.migrate.  Returns the migrated data_ids """
     if not user_store_exists(user_id):
         error(404, "unknown user_id")
+    return _engine.migrate(user_id)
 
-    """ get user dataframe"""
-    f = pd.HDFStore(user_store_path(user_id), mode)
-    return f
+def store_stats():
+    return _engine.stats()
+
+def ingest_buffer():
+    """ the process wide write-behind buffer, created (and its WAL
+    replayed) on first use.  None if buffered ingest is disabled or
+    writes go to a writer process """
+    global _ingest
+    if not config.INGEST_BUFFERED or config.WRITER_ADDRESS:
+        return None
+    if _ingest is None:
+        with _ingest_lock:
+            if _ingest is None:
+                _ingest = ingest.IngestBuffer(config.INGEST_WAL_PATH, _commit_points,
+                        flush_interval=config.INGEST_FLUSH_INTERVAL,
+                        max_buffer=config.INGEST_MAX_BUFFER,
+                        fsync=config.INGEST_FSYNC,
+                        max_retries=config.INGEST_MAX_RETRIES)
+                atexit.register(_ingest.close)
+    return _ingest
+
+def ingest_stats():
+    buf = ingest_buffer()
+    return buf.stats() if buf is not None else {}
+
+def _pending_series(user_id, data_id):
+    buf = ingest_buffer()
+    if buf is None:
+        return None
+    p = buf.pending(user_id, data_id)
+    if p is None:
+        return None
+    return _new_series(data_id, *p)
+
+def _is_pending(user_id, data_id):
+    buf = ingest_buffer()
+    return buf is not None and data_id in buf.pending_ids(user_id)
+
+def _snapshot(fn):
+    """ with a writer process, retry fn(user_id, ...) when the writer
+    committed to the user's store while it was reading.  Reads take no
+    lock the writer waits on """
+    @functools.wraps(fn)
+    def read(user_id, *args, **kwargs):
+        if _gens is None:
+            return fn(user_id, *args, **kwargs)
+        for attempt in range(config.SNAPSHOT_RETRIES):
+            g = _gens.stable(user_id)
+            try:
+                out = fn(user_id, *args, **kwargs)
+            except Exception:
+                # a torn read can fail in any way, only trust the error if
+                # nothing changed under it
+                if _gens.read(user_id) == g:
+                    raise
+                continue
+            if _gens.read(user_id) == g:
+                return out
+        error(503, "store of {} kept changing while reading".format(user_id))
+    return read
+
+def _sync_user(user_id):
+    """ drop the cached state of a user whose store the writer process
+    has committed to since we last looked """
+    if _gens is None:
+        return
+    g = _gens.read(user_id)
+    if _seen_gens.get(user_id, None) != g:
+        with _write_lock:
+            _tails.discard_user(user_id)
+            _series.discard_user(user_id)
+            _aggs.discard_user(user_id)
+            _seen_gens[user_id] = g
+
+@contextmanager
+def _read_session(user_id):
+    """ like get_user_store(user_id) but yields None if the user has no
+    store yet.  Read the ingest buffer inside the session to get a view
+    consistent with the store """
+    if not user_store_exists(user_id):
+        yield None
+        return
+    with get_user_store(user_id) as store:
+        yield store
 
 def data_page_exists(user_id, data_id):
-    store = get_user_store(user_id)
-    exists = data_id in store
-    store.close()
-    return exists
-
-def get_data_page(user_id, data_id, create_if_missing=False):
-    store = get_user_store(user_id)
-    if data_id not in store:
-        store.close()
-        error(404, "unknown data_id {}".format(data_id))
-     
-    d = store[data_id]
-    store.close() 
+    """ whether the series has any points, stored or buffered.  Only
+    series missing from the catalog are looked up in the store """
+    if _catalog.get(user_id, data_id) is not None:
+        return True
+    return _store_has(user_id, data_id)
+
+@_snapshot
+def _store_has(user_id, data_id):
+    with _read_session(user_id) as store:
+        if store is not None and store.has(data_id):
+            return True
+        return _is_pending(user_id, data_id)
+
+def _with_pending(d, pending, data_id):
+    if d is None:
+        if pending is None:
+            error(404, "unknown data_id {}".format(data_id))
+        return pending
+    if pending is not None:
+        d = pd.concat([d, pending])
     return d
 
-def get_data_page_latest(user_id, data_id):
-    return get_data_page(user_id, data_id).tail()
+def query_data_page(user_id, data_id, start=None, end=None, limit=None, cursor=0):
+    """ the points with start <= t < end (epoch seconds, either may be
+    None), including points still in the ingest buffer.  Only matching
+    rows are read from the store.
 
-def create_data_page(user_id, data_id, freq=sstsp.DEFAULT_FREQ, start_time = None, start_val = None):
-    if user_store_exists(user_id):
-        store = get_user_store(user_id, 'r+')
+    Points come in write order (time order for in-order writes), at most
+    `limit` of them starting at row `cursor`.  Returns (series,
+    next_cursor); next_cursor is None once there are no more rows.
+
+    Whole series are kept in the series cache and queries on a cached
+    series don't read the store at all.
+    """
+    _sync_user(user_id)
+    key = (user_id, data_id)
+    cached = _series.get(key)
+    if cached is not None:
+        return _query_cached(cached, start, end, limit, cursor)
+    whole = start is None and end is None and limit is None and cursor == 0
+    if whole:
+        generation = _series.generation(key)
+
+    d, coords, nrows, pending = _query_store(user_id, data_id, start, end, limit, cursor)
+
+    if d is None and pending is None and nrows == 0:
+        error(404, "unknown data_id {}".format(data_id))
+
+    if pending is not None and (limit is None or len(coords) < limit):
+        p_coords = nrows + np.flatnonzero(in_range(pending, start, end))
+        p_coords = p_coords[p_coords >= cursor]
+        if limit is not None:
+            p_coords = p_coords[:limit - len(coords)]
+        pending = pending.iloc[p_coords - nrows]
+        coords = np.concatenate([coords, p_coords])
+    else:
+        pending = None
+
+    if d is None and pending is None:
+        d = _new_series(data_id, [], [])
     else:
-        store = create_user_store(user_id)
+        d = _with_pending(d, pending, data_id)
+
+    next_cursor = None
+    if limit is not None and len(coords) == limit:
+        next_cursor = int(coords[-1]) + 1
+    if whole:
+        _series.put(key, d, generation)
+        d = d.copy(deep=False)
+    return d, next_cursor
+
+@_snapshot
+def _query_store(user_id, data_id, start, end, limit, cursor):
+    """ the stored rows of query_data_page and the ingest buffer's points
+    of the series """
+    d, coords, nrows = None, np.zeros(0, dtype=np.int64), 0
+    with _read_session(user_id) as store:
+        if store is not None and store.has(data_id):
+            d, coords, nrows = store.select(data_id, start, end, limit, cursor)
+        pending = _pending_series(user_id, data_id)
+    return d, coords, nrows, pending
+
+def _query_cached(d, start, end, limit, cursor):
+    """ query_data_page on a cached series, whose positions are the row
+    coordinates """
+    if start is None and end is None and limit is None and cursor == 0:
+        return d, None
+    coords = np.flatnonzero(in_range(d, start, end))
+    coords = coords[coords >= cursor][:limit]
+    next_cursor = None
+    if limit is not None and len(coords) == limit:
+        next_cursor = int(coords[-1]) + 1
+    return d.iloc[coords], next_cursor
+
+def series_cache_stats():
+    return _series.stats()
+
+def iter_data_page(user_id, data_id, start=None, end=None, chunksize=None):
+    """ yield the points with start <= t < end as a sequence of series,
+    reading at most chunksize stored rows at a time so memory use doesn't
+    depend on the length of the series.  Points still in the ingest
+    buffer come last """
+    chunksize = chunksize or config.STREAM_CHUNKSIZE
+    _sync_user(user_id)
+    cached = _series.get((user_id, data_id))
+    if cached is not None:
+        cached = cached[in_range(cached, start, end)]
+        for i in range(0, len(cached), chunksize):
+            yield cached.iloc[i:i + chunksize]
+        return
+
+    cursor = 0
+    while True:
+        d, pending, cursor = _read_chunk(user_id, data_id, start, end, cursor, chunksize)
+        if d is not None:
+            if len(d):
+                yield d
+            continue
+        if pending is not None:
+            pending = pending[in_range(pending, start, end)]
+            for i in range(0, len(pending), chunksize):
+                yield pending.iloc[i:i + chunksize]
+        return
+
+@_snapshot
+def _read_chunk(user_id, data_id, start, end, cursor, chunksize):
+    """ (rows, None, next cursor) of iter_data_page from row cursor on, or
+    (None, pending points, cursor) once the stored rows are done """
+    d = pending = None
+    with _read_session(user_id) as store:
+        if store is not None and store.has(data_id):
+            d, cursor = store.read_chunk(data_id, start, end, cursor, chunksize)
+        if d is None:
+            # the buffer is read in the same session as the last rows
+            pending = _pending_series(user_id, data_id)
+    return d, pending, cursor
+
+def get_data_page(user_id, data_id, start=None, end=None):
+    """ the series, or the part of it with start <= t < end, including
+    points still in the ingest buffer """
+    d, _ = query_data_page(user_id, data_id, start, end)
+    return d
+
+def get_data_frame(user_id, data_ids, start=None, end=None, every=None, fn='mean'):
+    """ several series of a user as the columns of one frame, read in a
+    single store session.  Without `every` the columns are outer joined
+    on their timestamps (NaN where a series has no point), otherwise each
+    is reduced to fn (see rollup.FUNCTIONS) over buckets of `every`
+    seconds """
+    _sync_user(user_id)
+    series = {}
+    for data_id in data_ids:
+        cached = _series.get((user_id, data_id))
+        if cached is not None:
+            series[data_id] = cached[in_range(cached, start, end)]
+    missing = [data_id for data_id in data_ids if data_id not in series]
+    if missing:
+        series.update(_query_many(user_id, missing, start, end))
+    for data_id in data_ids:
+        if series[data_id] is None:
+            error(404, "unknown data_id {}".format(data_id))
+
+    columns = []
+    for data_id in data_ids:
+        s = series[data_id]
+        if every is not None:
+            s = rollup.finish(rollup.partials(s, every), [fn])[fn]
+        else:
+            # one row per timestamp, the last point written wins
+            s = s[~s.index.duplicated(keep='last')]
+        s.name = data_id
+        columns.append(s)
+    d = pd.concat(columns, axis=1, sort=True)
+    d.index.name = None
+    return d
+
+@_snapshot
+def _query_many(user_id, data_ids, start, end):
+    """ {data_id: points with start <= t < end} including the ingest
+    buffer's, None for unknown series """
+    out = {}
+    with _read_session(user_id) as store:
+        for data_id in data_ids:
+            d = None
+            known = store is not None and store.has(data_id)
+            if known:
+                d, _, _ = store.select(data_id, start, end)
+            pending = _pending_series(user_id, data_id)
+            if pending is not None:
+                pending = pending[in_range(pending, start, end)]
+            elif not known:
+                out[data_id] = None
+                continue
+            if d is None and pending is None:
+                d = _new_series(data_id, [], [])
+            out[data_id] = _with_pending(d, pending, data_id)
+    return out
+
+@_snapshot
+def _read_tail(user_id, data_id, n):
+    """ the last n points, reading only those rows from the store """
+    d = None
+    with _read_session(user_id) as store:
+        if store is not None and store.has(data_id):
+            d = store.tail(data_id, n)
+        pending = _pending_series(user_id, data_id)
+
+    return _with_pending(d, pending, data_id).tail(n)
+
+def get_data_page_latest(user_id, data_id, n=5):
+    """ the last n points, served from the in-memory tail of the series
+    when n fits in it """
+    _sync_user(user_id)
+    latest = _tails.latest((user_id, data_id), n,
+            lambda size: _read_tail(user_id, data_id, size))
+    if latest is None:
+        return _read_tail(user_id, data_id, n)
+
+    t, v = latest
+    d = pd.Series(v, index=pd.to_datetime(t))
+    d.name = data_id
+    return d
 
-    if data_id in store:
+def create_data_page(user_id, data_id, freq=sstsp.DEFAULT_FREQ, start_time = None, start_val = None):
+    if data_page_exists(user_id, data_id):
         internal_error("Error creating dataframe - already exists")
     
     if start_time is None: start_time = time.time()
     
-    idx = pd.to_datetime(start_time, unit='s')
-    s = pd.Series(data=[start_val], index=[idx])
-    s.name = data_id
-    
-    store[data_id] = s
+    write_points(user_id, {data_id: ([start_time], [start_val])}, {data_id: freq})
     log.debug("created dataframe {} freq={} start={} val={} for user {}".format(data_id, 
-        freq, idx, start_val, user_id))
-    
-    store.close() 
+        freq, start_time, start_val, user_id))
+
+def _new_series(data_id, t, v):
+    s = pd.Series(data=np.asarray(v, dtype=float), index=time_index(t))
+    s.name = data_id
+    return s
+
+def write_points(user_id, points, freqs=None):
+    """ store many points for many series of one user, creating the store
+    and any missing series.  With buffered ingest the points are
+    committed later by the flusher, otherwise right away.
+
+    points maps data_id to a (t, v) pair of epoch second and value arrays,
+    freqs optionally data_id to the sampling interval kept in the catalog.
+    With a writer process the points are forwarded to it and are readable
+    once this returns; the caches catch up on the next read
+    """
+    if config.WRITER_ADDRESS:
+        try:
+            writer_client().write([(user_id, points, freqs)])
+        except writer.WriterError as e:
+            internal_error("write of {} failed - {}".format(user_id, e))
+        _written(user_id, points, time.time())
+        return
+
+    buf = ingest_buffer()
+    # a rebuild reads the store, not under _write_lock
+    _catalog.load(user_id)
+    with _write_lock:
+        if buf is not None:
+            seq = buf.put(user_id, points, sync=False)
+        else:
+            _commit_points(user_id, points)
+
+        now = time.time()
+        horizon = now - config.AGG_CLOSE_DELAY
+        for data_id, (t, v) in points.items():
+            key = (user_id, data_id)
+            s = _new_series(data_id, t, v)
+            _tails.extend(key, epoch_ns(s.index), v)
+            _series.extend(key, s)
+            if len(t):
+                _aggs.invalidate(user_id, data_id, np.min(t), horizon)
+        _catalog.record(user_id, points, freqs, now)
+        _written(user_id, points, now)
+
+    # outside the lock so concurrent writers share an fsync
+    if buf is not None:
+        buf.sync(seq)
+
+def _written(user_id, points, now):
+    """ bump the versions of written series and push them to live
+    subscribers """
+    with _write_lock:
+        for data_id, (t, v) in points.items():
+            key = (user_id, data_id)
+            n, _ = _versions.get(key, (0, 0))
+            _versions[key] = (n + 1, now)
+            if _hub.subscribed(key):
+                _hub.publish(key, formats.sse_event(_new_series(data_id, t, v)))
+
+def writer_client():
+    global _writer
+    if _writer is None:
+        with _ingest_lock:
+            if _writer is None:
+                _writer = writer.WriterClient(config.WRITER_ADDRESS, config.WRITER_AUTHKEY)
+    return _writer
+
+def writer_catalog():
+    """ the catalog the writer process keeps for the workers, saved after
+    every commit """
+    global _writer_catalog
+    if _writer_catalog is None:
+        _writer_catalog = catalog.Catalog(_scan_catalog, save_interval=0)
+        atexit.register(_writer_catalog.close)
+    return _writer_catalog
+
+def commit_points(user_id, points, freqs=None):
+    """ _commit_points for the writer process, marking the commit in the
+    user's generation so readers in other processes retry around it """
+    # rebuilt, if need be, from the store as it was before this commit
+    writer_catalog().load(user_id)
+    _gens.begin(user_id)
+    try:
+        _commit_points(user_id, points)
+        writer_catalog().record(user_id, points, freqs)
+    finally:
+        _gens.end(user_id)
+
+def subscribe(user_id, data_id, on_publish=None):
+    """ context manager yielding a pubsub.Subscription to the points
+    written to a series through this process from now on.  Each message
+    is a server-sent event, see formats.sse_event """
+    return _hub.subscribe((user_id, data_id), on_publish)
+
+def live_stats():
+    return _hub.stats()
+
+def _commit_points(user_id, points, done=None):
+    """ write points to the user store in a single session.  done(data_id)
+    is called as each series is appended, before the session ends, see
+    ingest.IngestBuffer """
+    if not user_store_exists(user_id):
+        log.debug("creating data store for new user {}".format(user_id))
+
+    with get_user_store(user_id, 'a') as store:
+        for data_id, (t, v) in points.items():
+            store.append(data_id, _new_series(data_id, t, v))
+            if done is not None:
+                done(data_id)
+
+@_snapshot
+def get_rollup(user_id, data_id, tier, start=None, end=None):
+    """ count, sum, min, max, first and last per bucket of a rollup tier
+    for buckets overlapping start <= t < end, including points still in
+    the ingest buffer.  Series without rollups, kept from before there
+    were any, are bucketed from their raw points until a write builds
+    them """
+    if tier not in config.ROLLUP_TIERS:
+        error(400, "no {} rollup tier".format(tier))
+    seconds = rollup.tier_seconds(tier)
+    if start is not None:
+        # the whole bucket containing start
+        start = float(start) // seconds * seconds
+
+    p = None
+    raw = False
+    with _read_session(user_id) as store:
+        if store is not None and store.has(data_id):
+            if store.has_rollups(data_id):
+                p = store.rollup(data_id, tier, start, end)
+            else:
+                raw = True
+        pending = _pending_series(user_id, data_id)
+
+    if raw:
+        # whole buckets as read from a tier; the pending points are included
+        p = _chunk_partials(user_id, data_id, seconds, start,
+                None if end is None else _bucket_ceil(float(end), seconds))
+        pending = None
+    elif p is None and pending is None:
+        error(404, "unknown data_id {}".format(data_id))
+    if pending is not None:
+        pending = pending[in_range(pending, start, end)]
+        p = rollup.combine(p, rollup.partials(pending, seconds))
+    if p is None:
+        p = rollup.partials(_new_series(data_id, [], []), seconds)
+    return p
+
+def _raw_partials(user_id, data_id, seconds, start=None, end=None):
+    """ aggregation partials over start <= t < end, from a rollup tier
+    when one fits the bucket width and range, else from the raw points
+    read chunk by chunk """
+    tiers = [tier for tier in config.ROLLUP_TIERS
+            if seconds % rollup.tier_seconds(tier) == 0
+            and all(x is None or x % rollup.tier_seconds(tier) == 0 for x in (start, end))]
+    if tiers:
+        tier = max(tiers, key=rollup.tier_seconds)
+        return rollup.rebucket(get_rollup(user_id, data_id, tier, start, end), seconds)
+    return _chunk_partials(user_id, data_id, seconds, start, end)
+
+def _chunk_partials(user_id, data_id, seconds, start=None, end=None):
+    """ aggregation partials of the raw points over start <= t < end, read
+    chunk by chunk.  None if there are none """
+    parts = [rollup.partials(d, seconds) for d in iter_data_page(user_id, data_id, start, end)]
+    return rollup.combine(*parts)
+
+def _bucket_floor(t, step):
+    return t if np.isinf(t) else t // step * step
+
+def _bucket_ceil(t, step):
+    return t if np.isinf(t) else -(-t // step) * step
+
+def aggregate(user_id, data_id, seconds, fns=('mean',), start=None, end=None):
+    """ fns (see rollup.FUNCTIONS) over buckets of `seconds` for points with
+    start <= t < end.  Buckets that can no longer change are cached, so
+    repeated queries only compute the recent ones """
+    if not data_page_exists(user_id, data_id):
+        error(404, "unknown data_id {}".format(data_id))
+
+    _sync_user(user_id)
+    step = int(seconds)
+    key = (user_id, data_id, step)
+    generation = _aggs.generation(user_id, data_id)
+    # buckets ending before this are closed
+    closed = (time.time() - config.AGG_CLOSE_DELAY) // step * step
+
+    lo_q = -np.inf if start is None else start
+    hi_q = np.inf if end is None else end
+    parts = []
+    cached = _aggs.get(key)
+    if cached is not None:
+        lo, hi, p = cached
+        lo = -np.inf if lo is None else lo
+        # whole cached buckets inside the query
+        a = _bucket_ceil(lo_q, step)
+        b = min(hi, _bucket_floor(hi_q, step))
+        if lo > lo_q or a >= b:
+            cached = None
+    if cached is not None:
+        if lo_q < a:
+            parts.append(_raw_partials(user_id, data_id, step, start, a))
+        t = epoch_ns(p.index) / 1e9
+        parts.append(p[(t >= a) & (t < b)])
+        if b < hi_q:
+            parts.append(_raw_partials(user_id, data_id, step, b, end))
+    else:
+        parts.append(_raw_partials(user_id, data_id, step, start, end))
+
+    p = rollup.combine(*parts)
+    if p is None:
+        p = rollup.partials(_new_series(data_id, [], []), step)
+
+    # cache the whole buckets of the result that are closed, unless that
+    # would cover less than the entry already cached
+    lo_c = _bucket_ceil(lo_q, step)
+    hi_c = min(closed, _bucket_floor(hi_q, step))
+    if lo_c < hi_c and (cached is None or (lo_c <= lo and hi_c > hi)):
+        t = epoch_ns(p.index) / 1e9
+        _aggs.put(key, None if start is None else lo_c, hi_c,
+                p[(t >= lo_c) & (t < hi_c)], generation)
+
+    return rollup.finish(p, fns)
+
+def series_version(user_id, data_id):
+    """ (version, last modified epoch seconds) of a series, without
+    reading it.  The version changes whenever the series may have: on
+    writes through this process and on any change of the stored series, so
+    writes committed by other processes are seen too """
+    mtime_ns = _engine.version(user_id, data_id)
+    with _write_lock:
+        n, written = _versions.get((user_id, data_id), (0, 0))
+    version = "{:x}-{}-{}".format(mtime_ns, _boot, n)
+    return version, max(mtime_ns / 1e9, written)
+
+@_snapshot
+def count_points(user_id, data_id):
+    """ number of points in a series, without reading them """
+    n = 0
+    with _read_session(user_id) as store:
+        if store is not None and store.has(data_id):
+            n = store.nrows(data_id)
+        pending = _pending_series(user_id, data_id)
+    if pending is not None:
+        n += len(pending)
+    return n
+
+def count_range(user_id, data_id, start=None, end=None):
+    """ number of points with start <= t < end, from the finest rollup
+    tier for the whole buckets in the range and the raw points of the
+    part buckets at either end """
+    if start is None and end is None:
+        return count_points(user_id, data_id)
+    tier = min(config.ROLLUP_TIERS, key=rollup.tier_seconds)
+    step = rollup.tier_seconds(tier)
+    a = start if start is None else _bucket_ceil(start, step)
+    b = end if end is None else _bucket_floor(end, step)
+    if a is not None and b is not None and a >= b:
+        return len(get_data_page(user_id, data_id, start, end))
+    n = int(get_rollup(user_id, data_id, tier, a, b)['count'].sum())
+    if start is not None and start < a:
+        n += len(get_data_page(user_id, data_id, start, a))
+    if end is not None and b < end:
+        n += len(get_data_page(user_id, data_id, b, end))
+    return n
+
+def series_span(user_id, data_id):
+    """ (first, last) epoch seconds of the points of a series, from the
+    catalog.  Until the catalog knows the series, e.g. a worker's copy of
+    the writer's, the bounds of its coarsest rollup buckets """
+    e = _catalog.get(user_id, data_id)
+    if e is not None and e['first'] is not None:
+        return e['first'], e['last']
+    tier = max(config.ROLLUP_TIERS, key=rollup.tier_seconds)
+    p = get_rollup(user_id, data_id, tier)
+    if len(p) == 0:
+        return None, None
+    t = epoch_ns(p.index) / 1e9
+    return t.min(), t.max() + rollup.tier_seconds(tier)
+
+_retention_rules = retention.parse_rules(config.RETENTION, config.ROLLUP_TIERS)
+
+@contextmanager
+def _replacing(user_id):
+    """ around the replacing of a user's store by compaction, marked in
+    the user's generation like a commit """
+    if _gens is None:
+        yield
+        return
+    _gens.begin(user_id)
+    try:
+        yield
+    finally:
+        _gens.end(user_id)
+
+def compact_user(user_id, now=None):
+    """ remove the user's points expired by config.RETENTION, see
+    retention.py, and reclaim the space they and earlier rewrites took.
+    Ingest and reads go on meanwhile.  Returns the engine's report, see
+    engine.py.  Only the process writing the stores may call this """
+    now = time.time() if now is None else now
+    series_catalog = writer_catalog() if config.WRITER_ADDRESS else _catalog
+    series_catalog.load(user_id)
+
+    def cutoffs(data_id):
+        return retention.cutoffs(retention.policy(_retention_rules, data_id), now)
+
+    with metrics.timer('compaction_seconds'):
+        report = _engine.compact(user_id, cutoffs, lambda: _replacing(user_id))
+    with _write_lock:
+        _tails.discard_user(user_id)
+        _series.discard_user(user_id)
+        _aggs.discard_user(user_id)
+    for data_id, r in report['series'].items():
+        series_catalog.trim(user_id, data_id, r['removed'], r['first'])
+    log.info("compacted {}: removed {} points, {} -> {} bytes".format(user_id,
+        sum(r['removed'] for r in report['series'].values()),
+        report['bytes_before'], report['bytes_after']))
+    return report
+
+def start_compactor():
+    """ start compacting every store every config.COMPACT_INTERVAL
+    seconds in the background, see retention.Compactor.  Called once by
+    the process writing the stores: the writer process if there is one,
+    else the web server """
+    global _compactor
+    if config.COMPACT_INTERVAL <= 0:
+        return None
+    with _ingest_lock:
+        if _compactor is None:
+            _compactor = retention.Compactor(compact_user, _engine.users,
+                    config.COMPACT_INTERVAL)
+            _compactor.start()
+            atexit.register(_compactor.close)
+    return _compactor
+
+def compaction_stats():
+    return _compactor.stats() if _compactor is not None else {}
+
+# reported at /metrics
+metrics.add_stats('store', store_stats)
+metrics.add_stats('ingest', lambda: _ingest.stats() if _ingest is not None else {})
+metrics.add_stats('series_cache', series_cache_stats)
+metrics.add_stats('agg_cache', lambda: dict(_aggs.counters))
+metrics.add_stats('live', live_stats)
+metrics.add_stats('catalog', lambda: _catalog.stats())
+metrics.add_stats('compaction', compaction_stats)
 
 def append_data(user_id, data_id, t, val):
-    store = get_user_store(user_id, 'r+')
-    if data_id not in store:
+    if not data_page_exists(user_id, data_id):
         internal_error("{} not in store for {} as expected".format(data_id, user_id))
     
-    d = store[data_id]
-    idx = pd.to_datetime(t, unit='s')
-    new_s = pd.Series(data=[val], index=[idx])
-    new_s.name = data_id
-
-    store[data_id] = d.append(new_s)
-    store.close()
-
+    write_points(user_id, {data_id: ([t], [val])})
 
+if __name__ == '__main__':
+    import sys
+    log.basicConfig(level=log.INFO)
+    for user_id in sys.argv[1:]:
+        print("{}: migrated {}".format(user_id, migrate_user_store(user_id)))
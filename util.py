@@ -1,6 +1,10 @@
 import datetime
 import logging as log
 
+import numpy as np
+import pandas as pd
+from flask import abort
+
 def error(code, msg=""):
     log.info("{} error - {}".format(code, msg))
     raise abort(code)
@@ -23,3 +27,33 @@ def tz_offset_seconds(tz_str):
     
     delta = dt.utcoffset()
     return delta.total_seconds()
+
+def epoch_ns(index):
+    """ int64 nanoseconds since the epoch for a datetime index """
+    return np.asarray(pd.DatetimeIndex(index).astype('datetime64[ns]')).view(np.int64)
+
+def time_index(t):
+    """ epoch seconds (scalar or sequence) to a ns resolution DatetimeIndex """
+    idx = pd.to_datetime(np.atleast_1d(np.asarray(t, dtype=float)), unit='s')
+    return pd.DatetimeIndex(idx).astype('datetime64[ns]')
+
+def in_range(d, start=None, end=None):
+    """ mask of the points of d with start <= t < end, epoch seconds """
+    mask = np.ones(len(d), dtype=bool)
+    if start is not None:
+        mask &= d.index >= time_index(start)[0]
+    if end is not None:
+        mask &= d.index < time_index(end)[0]
+    return mask
+
+_INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+def parse_interval(s):
+    """ seconds in an interval like '15s', '5m', '1h', '1d' or '2w' """
+    s = str(s).strip().lower()
+    if not s or s[-1] not in _INTERVAL_UNITS:
+        raise ValueError("invalid interval {}".format(s))
+    n = int(s[:-1] or 1)
+    if n <= 0:
+        raise ValueError("invalid interval {}".format(s))
+    return n * _INTERVAL_UNITS[s[-1]]
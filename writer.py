@@ -0,0 +1,187 @@
+""" single writer storage service
+
+HDF5 files don't survive concurrent writers, so with several web worker
+processes only one process may write the user stores.  Run
+
+    SSTSP_WRITER_ADDRESS=sstsp-writer.sock python writer.py
+
+and start the workers with the same SSTSP_WRITER_ADDRESS.  The workers
+forward their writes over the local socket (user.write_points), and the
+writer commits whatever has arrived together in one store session per
+user.  A write is acknowledged once it is committed and readable.
+
+Readers in the workers take no lock the writer waits for.  Around each
+commit the writer bumps the user's generation (storepool.Generations)
+to odd and back to even; a read that saw it move is retried, seqlock
+style, and pooled read handles opened at an older generation are
+reopened.
+"""
+import os
+import queue
+import threading
+import logging as log
+from multiprocessing.connection import Listener, Client
+from multiprocessing import AuthenticationError
+
+import numpy as np
+
+
+class WriterError(Exception):
+    pass
+
+
+class WriterService(object):
+    def __init__(self, address, authkey, commit):
+        """ commit(user_id, points, freqs) writes {data_id: (t, v)} to the
+        user's store and raises if it fails.  freqs maps data_id to the
+        sampling interval the client gave, see user.write_points """
+        self.address = address
+        self.authkey = authkey.encode('utf-8')
+        self._commit = commit
+        self._queue = queue.Queue()
+        self.counters = {'writes': 0, 'commits': 0, 'errors': 0}
+
+    def serve_forever(self):
+        self._claim_address()
+        listener = Listener(self.address, authkey=self.authkey)
+        log.info("writer listening on {}".format(self.address))
+        committer = threading.Thread(target=self._commit_loop, name="writer-commit")
+        committer.daemon = True
+        committer.start()
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError) as e:
+                    log.warning("rejected writer connection - {}".format(e))
+                    continue
+                t = threading.Thread(target=self._serve, args=(conn,), name="writer-conn")
+                t.daemon = True
+                t.start()
+        finally:
+            listener.close()
+
+    def _claim_address(self):
+        """ remove the socket left by a writer that died, refuse to start
+        next to a live one """
+        if not os.path.exists(self.address):
+            return
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(self.address)
+            return
+        except (OSError, AuthenticationError):
+            pass
+        raise WriterError("another writer is serving {}".format(self.address))
+
+    def _serve(self, conn):
+        """ one worker connection: each message is a list of (user_id,
+        points, freqs) answered with ('ok', None) or ('error', reason) """
+        try:
+            while True:
+                writes = conn.recv()
+                done = threading.Event()
+                reply = []
+                self._queue.put((writes, done, reply))
+                done.wait()
+                conn.send(reply[0])
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _commit_loop(self):
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            group = {}
+            freqs = {}
+            for writes, done, reply in items:
+                for user_id, points, f in writes:
+                    _merge(group, user_id, points)
+                    freqs.setdefault(user_id, {}).update(f or {})
+                self.counters['writes'] += len(writes)
+
+            failed = {}
+            for user_id, series in group.items():
+                try:
+                    self._commit(user_id, {d: (np.concatenate(ts), np.concatenate(vs))
+                        for d, (ts, vs) in series.items()}, freqs[user_id])
+                    self.counters['commits'] += 1
+                except Exception as e:
+                    self.counters['errors'] += 1
+                    log.exception("commit for {} failed".format(user_id))
+                    failed[user_id] = str(e)
+
+            for writes, done, reply in items:
+                errors = [failed[u] for u, p, f in writes if u in failed]
+                reply.append(('error', "; ".join(errors)) if errors else ('ok', None))
+                done.set()
+
+
+class WriterClient(object):
+    """ a worker's connections to the writer service, one per thread """
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey.encode('utf-8')
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            try:
+                conn = self._local.conn = Client(self.address, authkey=self.authkey)
+            except (OSError, AuthenticationError) as e:
+                raise WriterError("can't connect to writer at {} - {}".format(self.address, e))
+        return conn
+
+    def _drop(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn.close()
+
+    def write(self, writes):
+        """ send [(user_id, {data_id: (t, v)}, {data_id: freq} or None),
+        ...] and wait until it is committed """
+        for attempt in range(2):
+            conn = self._conn()
+            try:
+                conn.send(writes)
+                break
+            except OSError as e:
+                # e.g. the writer restarted; nothing was sent, try once more
+                self._drop()
+                if attempt:
+                    raise WriterError("writer connection failed - {}".format(e))
+        try:
+            status, reason = conn.recv()
+        except (EOFError, OSError) as e:
+            self._drop()
+            raise WriterError("writer connection lost, write may not be committed - {}".format(e))
+        if status != 'ok':
+            raise WriterError(reason)
+
+
+def _merge(group, user_id, points):
+    series = group.setdefault(user_id, {})
+    for data_id, (t, v) in points.items():
+        ts, vs = series.setdefault(data_id, ([], []))
+        ts.append(np.asarray(t, dtype=float))
+        vs.append(np.asarray(v, dtype=float))
+
+
+if __name__ == '__main__':
+    import config
+    import user
+    log.basicConfig(level=log.INFO)
+    if not config.WRITER_ADDRESS:
+        raise SystemExit("set SSTSP_WRITER_ADDRESS to the socket to listen on")
+    user.start_compactor()
+    WriterService(config.WRITER_ADDRESS, config.WRITER_AUTHKEY, user.commit_points).serve_forever()